@@ -1,38 +1,601 @@
 __all__=["UserData","ChatSessionData","AS2CSData","CS2ASData"]
 import asyncio
+import functools
 import json
+import os
+import re
+import secrets
+import socket
 import time
-from abc import ABC
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from collections import OrderedDict, defaultdict
 from contextlib import asynccontextmanager, AbstractAsyncContextManager, AsyncExitStack
+from contextvars import ContextVar
 from copy import deepcopy
 from datetime import datetime, timezone
-from inspect import iscoroutine
+from inspect import getattr_static
 from json import JSONDecodeError
-from typing import Literal, Self, Awaitable, Any, Sequence, ClassVar, get_origin, get_args
-from uuid import UUID
+from types import UnionType
+from typing import Literal, Self, Awaitable, Any, Sequence, Iterable, ClassVar, Union, Callable, get_origin, get_args
+from uuid import UUID, uuid4
 
-from pydantic import Field, AnyUrl, PrivateAttr, BaseModel, ConfigDict, ValidationError
+from pydantic import Field, AnyUrl, PrivateAttr, BaseModel, ConfigDict, ValidationError, TypeAdapter
 from redis import WatchError
 from redis.asyncio import Redis
 from redis.asyncio.client import Pipeline
-from redis.exceptions import LockError
+from redis.exceptions import LockError, ResponseError
 
-from chatbone.settings import REDIS, CONFIG, get_redis
-from utilities.func import encrypt, decrypt, utc_now, dump_base_models
+from chatbone.settings import REDIS, CONFIG, TOKEN_SIGNING_KEY, get_redis
+from utilities.func import encrypt, decrypt, sign, unsign, utc_now
 from utilities.logger import logger
 
 LOCK_POSTFIX="<LOCK>"
+MIN_SIGNING_KEY_LENGTH = 32
+REGISTRY_POSTFIX="<sub_rkeys>"
+DATA_CHANGED_CHANNEL = f"{__name__}:<data_changed>"
+"""Every write to a main rkey publishes the main rkey to this channel, see 'UserDataCache'."""
+
+RkeySlotKind = Literal['property','model','sequence','dict']
+FieldKind = Literal['sequence','dict','other']
+
+FUNCTIONS_LIBRARY_VERSION = 4
+"""Bump with every change of 'FUNCTIONS_LIBRARY'. Library and function names carry it, so that processes of different
+releases sharing a Redis load their own library side by side instead of replacing each other's."""
+FUNCTIONS_LIBRARY_NAME = f"chatbone_v{FUNCTIONS_LIBRARY_VERSION}"
+
+def function_name(name:str)->str:
+	"""Registered name of a function of 'FUNCTIONS_LIBRARY', call functions with it."""
+	return f"{name}_v{FUNCTIONS_LIBRARY_VERSION}"
+
+FUNCTIONS_LIBRARY = f"""#!lua name={FUNCTIONS_LIBRARY_NAME}
+
+-- Cascade functions take KEYS[1] main rkey and KEYS[2] its sub rkeys registry (set).
+-- Registry members are not declared as KEYS, so this library only supports non-cluster deployment.
+
+local function register(name, fn)
+	redis.register_function(name .. '_v{FUNCTIONS_LIBRARY_VERSION}', fn)
+end
+
+-- Apply ttl (milliseconds) to keys[first..]. Non-positive ttl means persist.
+local function expire_keys(keys, first, ms)
+	local n = 0
+	for i = first, #keys do
+		if ms > 0 then
+			n = n + redis.call('PEXPIRE', keys[i], ms)
+		else
+			n = n + redis.call('PERSIST', keys[i])
+		end
+	end
+	return n
+end
+
+-- Main rkey, registry, registry members and the extra keys (KEYS[3..]).
+local function cascade_keys(keys)
+	local all = redis.call('SMEMBERS', keys[2])
+	for i = 1, #keys do
+		all[#all + 1] = keys[i]
+	end
+	return all
+end
+
+-- ARGV: seconds.
+register('cascade_expire', function(keys, args)
+	return expire_keys(cascade_keys(keys), 1, tonumber(args[1]) * 1000)
+end)
+
+register('cascade_persist', function(keys, args)
+	return expire_keys(cascade_keys(keys), 1, 0)
+end)
+
+-- Returns number of keys were removed.
+register('cascade_delete', function(keys, args)
+	return redis.call('DEL', unpack(cascade_keys(keys)))
+end)
+
+-- KEYS[3..]: keys to be synced with main rkey lifetime. Returns main rkey pttl.
+register('expire_sync', function(keys, args)
+	local ms = redis.call('PTTL', keys[1])
+	if ms ~= -2 then
+		expire_keys(keys, 2, ms)
+	end
+	return ms
+end)
+
+-- KEYS[3..]: new sub rkeys, added to registry and synced with main rkey lifetime.
+-- Nothing is registered if the main rkey does not exist. Returns main rkey pttl.
+register('register_sub_rkeys', function(keys, args)
+	local ms = redis.call('PTTL', keys[1])
+	if ms ~= -2 then
+		redis.call('SADD', keys[2], unpack(keys, 3))
+		expire_keys(keys, 2, ms)
+	end
+	return ms
+end)
+
+local function no_main_rkey(keys)
+	return redis.error_reply('NOKEY main rkey ' .. keys[1] .. ' does not exist')
+end
+
+-- KEYS[3] list key. ARGV: max length (0 means no cap), values...
+-- Append values, keep the latest ones and register the list key with main rkey lifetime.
+-- Returns the new length, error NOKEY if main rkey does not exist.
+register('list_append_capped', function(keys, args)
+	local ms = redis.call('PTTL', keys[1])
+	if ms == -2 then
+		return no_main_rkey(keys)
+	end
+	redis.call('RPUSH', keys[3], unpack(args, 2))
+	local max = tonumber(args[1])
+	if max > 0 then
+		redis.call('LTRIM', keys[3], -max, -1)
+	end
+	redis.call('SADD', keys[2], keys[3])
+	expire_keys(keys, 2, ms)
+	return redis.call('LLEN', keys[3])
+end)
+
+-- ARGV: legacy path of a JSON array in main rkey, max length (0 means no cap), JSON values...
+-- Append values and keep the latest ones. Returns the new length, error NOKEY if main rkey does not exist.
+register('json_append_capped', function(keys, args)
+	if redis.call('EXISTS', keys[1]) == 0 then
+		return no_main_rkey(keys)
+	end
+	local n = redis.call('JSON.ARRAPPEND', keys[1], args[1], unpack(args, 3))
+	local max = tonumber(args[2])
+	if max > 0 and n > max then
+		n = redis.call('JSON.ARRTRIM', keys[1], args[1], n - max, n - 1)
+	end
+	return n
+end)
+
+-- ARGV: expected version, number of notifications n, n (channel, message) pairs, then (legacy path, JSON value) pairs.
+-- Versioned write: set all paths if the version of main rkey ('__version__' at the json root, 0 if missing) is the expected one,
+-- increase the version and publish the notifications. Returns the new version, error VERSIONCONFLICT with the current
+-- version otherwise, nothing is published then.
+register('versioned_set', function(keys, args)
+	if redis.call('EXISTS', keys[1]) == 0 then
+		return no_main_rkey(keys)
+	end
+	local version = cjson.decode(redis.call('JSON.GET', keys[1], '$.__version__'))[1] or 0
+	if version ~= tonumber(args[1]) then
+		return redis.error_reply('VERSIONCONFLICT ' .. version)
+	end
+	local first = 3 + 2 * tonumber(args[2])
+	for i = first, #args, 2 do
+		redis.call('JSON.SET', keys[1], args[i], args[i + 1])
+	end
+	redis.call('JSON.SET', keys[1], '.__version__', version + 1)
+	for i = 3, first - 1, 2 do
+		redis.call('PUBLISH', args[i], args[i + 1])
+	end
+	return version + 1
+end)
+
+-- Stream write leases: lock keys hold the owner, the fence key holds the fencing token increased on every acquisition.
+-- KEYS[3] fence key, KEYS[4..] lock keys. ARGV: owner, lease milliseconds.
+-- All locks are taken or none. Returns the new fencing token, nil if any lock is held by another owner.
+register('stream_lock_acquire', function(keys, args)
+	for i = 4, #keys do
+		local owner = redis.call('GET', keys[i])
+		if owner and owner ~= args[1] then
+			return nil
+		end
+	end
+	for i = 4, #keys do
+		redis.call('SET', keys[i], args[1], 'PX', args[2])
+	end
+	local token = redis.call('INCR', keys[3])
+	local ms = redis.call('PTTL', keys[1])
+	if ms ~= -2 then
+		redis.call('SADD', keys[2], keys[3])
+		-- Only registry and fence key, lock keys keep their lease.
+		expire_keys({{keys[2], keys[3]}}, 1, ms)
+	end
+	return token
+end)
+
+-- KEYS: lock keys. ARGV: owner, lease milliseconds. Returns 0 and renews nothing if any lock is lost.
+register('stream_lock_renew', function(keys, args)
+	for i = 1, #keys do
+		if redis.call('GET', keys[i]) ~= args[1] then
+			return 0
+		end
+	end
+	for i = 1, #keys do
+		redis.call('PEXPIRE', keys[i], args[2])
+	end
+	return 1
+end)
+
+-- KEYS: lock keys. ARGV: owner. Returns number of released locks.
+register('stream_lock_release', function(keys, args)
+	local n = 0
+	for i = 1, #keys do
+		if redis.call('GET', keys[i]) == args[1] then
+			n = n + redis.call('DEL', keys[i])
+		end
+	end
+	return n
+end)
+
+-- User indexes: active users (sorted set of usernames by last seen timestamp) and username -> user id hash.
+-- KEYS[1] user main rkey, KEYS[2] active users, KEYS[3] usernames. The username is read from the user document,
+-- so that objects which are not loaded can be indexed. Both return 0 and change nothing if main rkey does not exist.
+local function document_username(keys)
+	local name = redis.call('JSON.GET', keys[1], '.username')
+	return name and cjson.decode(name)
+end
+
+-- ARGV: user id, last seen timestamp.
+register('user_index_touch', function(keys, args)
+	local name = document_username(keys)
+	if not name then
+		return 0
+	end
+	redis.call('ZADD', keys[2], args[2], name)
+	redis.call('HSET', keys[3], name, args[1])
+	return 1
+end)
+
+register('user_index_remove', function(keys, args)
+	local name = document_username(keys)
+	if not name then
+		return 0
+	end
+	redis.call('ZREM', keys[2], name)
+	redis.call('HDEL', keys[3], name)
+	return 1
+end)
+
+-- KEYS[1] active users, KEYS[2] usernames. ARGV: cutoff, limit.
+-- Remove at most limit users last seen before cutoff from both indexes. Returns removed usernames.
+register('user_index_evict', function(keys, args)
+	local names = redis.call('ZRANGEBYSCORE', keys[1], '-inf', '(' .. args[1], 'LIMIT', 0, tonumber(args[2]))
+	if #names > 0 then
+		redis.call('ZREM', keys[1], unpack(names))
+		redis.call('HDEL', keys[2], unpack(names))
+	end
+	return names
+end)
+
+-- True if stream entry id a is older than b.
+local function stream_id_less(a, b)
+	local a_ms, a_seq = string.match(a, '(%d+)-(%d+)')
+	local b_ms, b_seq = string.match(b, '(%d+)-(%d+)')
+	a_ms, b_ms = tonumber(a_ms), tonumber(b_ms)
+	return a_ms < b_ms or (a_ms == b_ms and tonumber(a_seq) < tonumber(b_seq))
+end
+
+-- KEYS[3] checkpoints hash. ARGV: field, stream entry id.
+-- Save the last delivered entry id if it is newer than the saved one, the hash is registered with main rkey lifetime.
+-- Returns 1 if saved, 0 if not newer or main rkey does not exist.
+register('stream_checkpoint_save', function(keys, args)
+	local ms = redis.call('PTTL', keys[1])
+	if ms == -2 then
+		return 0
+	end
+	local saved = redis.call('HGET', keys[3], args[1])
+	if saved and not stream_id_less(saved, args[2]) then
+		return 0
+	end
+	redis.call('HSET', keys[3], args[1], args[2])
+	redis.call('SADD', keys[2], keys[3])
+	expire_keys(keys, 3, ms)
+	return 1
+end)
+
+-- KEYS[1] fence key, KEYS[2] stream. ARGV: fencing token, maxlen ('' for no trim), approximate (1/0), limit ('' for none), fields...
+-- XADD NOMKSTREAM if the token is the current one, error STALEFENCE otherwise.
+register('fenced_xadd', function(keys, args)
+	if redis.call('GET', keys[1]) ~= args[1] then
+		return redis.error_reply('STALEFENCE fencing token ' .. args[1] .. ' of stream ' .. keys[2] .. ' is stale')
+	end
+	local cmd = {{'XADD', keys[2], 'NOMKSTREAM'}}
+	if args[2] ~= '' then
+		cmd[#cmd + 1] = 'MAXLEN'
+		if args[3] == '1' then
+			cmd[#cmd + 1] = '~'
+		end
+		cmd[#cmd + 1] = args[2]
+		if args[4] ~= '' then
+			cmd[#cmd + 1] = 'LIMIT'
+			cmd[#cmd + 1] = args[4]
+		end
+	end
+	cmd[#cmd + 1] = '*'
+	for i = 5, #args do
+		cmd[#cmd + 1] = args[i]
+	end
+	return redis.call(unpack(cmd))
+end)
+"""
+
+
+
+class PubSubHub:
+	"""One pub/sub connection per process, messages are dispatched to in-process waiters,
+	so that many coroutines can wait for notifications without each of them holding a connection or polling.
+	Notifications can be lost (connection broken, subscribe not processed yet), waiters must recheck the state themselves.
+	Handlers registered by 'add_handler' get the data of every message of the channel, and None when messages may have been lost.
+		Examples:
+			async with PUBSUB_HUB.subscription(channel) as event:
+				while not (await check_state()):
+					await asyncio.wait_for(event.wait(), timeout)
+					event.clear()
+	"""
+	base_channel = f"{__name__}:<pubsub_hub>"
+	"""Always subscribed, so that the connection keeps listening even when there is no waiter."""
+
+	def __init__(self):
+		self._pubsub = None
+		self._task:asyncio.Task|None = None
+		self._waiters:dict[str,set[asyncio.Event]] = {}
+		self._handlers:dict[str,list[Callable[[str|None],None]]] = {}
+		self._start_lock = asyncio.Lock()
+
+	async def _ensure_started(self):
+		if self._task is not None and not self._task.done():
+			return
+		async with self._start_lock: # Concurrent first callers must not open several connections and listeners.
+			if self._task is not None and not self._task.done():
+				return
+			if self._pubsub is not None:
+				await self._pubsub.aclose()
+			self._pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+			await self._pubsub.subscribe(self.base_channel, *(self._waiters.keys() | self._handlers.keys()))
+			self._task = asyncio.create_task(self._run())
+
+	def _subscribed(self, channel:str)->bool:
+		return channel in self._waiters or channel in self._handlers
+
+	async def _run(self):
+		while True:
+			try:
+				async for message in self._pubsub.listen():
+					self._dispatch(message['channel'], message['data'])
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				logger.error(f"Pub/sub listener error, retry in 1 second. {e!r}")
+				await asyncio.sleep(1)
+			# Notifications may be missed, wake all waiters to recheck. PubSub resubscribes channels on reconnect.
+			for channel in self._waiters.keys() | self._handlers.keys():
+				self._dispatch(channel, None)
+
+	def _dispatch(self, channel:str, data:str|None):
+		for event in self._waiters.get(channel, ()):
+			event.set()
+		for handler in self._handlers.get(channel, ()):
+			try:
+				handler(data)
+			except Exception as e:
+				logger.error(f"Pub/sub handler of channel '{channel}' error. {e!r}")
+
+	async def add_handler(self, channel:str, handler:Callable[[str|None],None]):
+		"""Call the handler (sync, must be fast) on every message of the channel until 'remove_handler'."""
+		subscribed = self._subscribed(channel)
+		self._handlers.setdefault(channel, []).append(handler)
+		await self._ensure_started()
+		if not subscribed:
+			await self._pubsub.subscribe(channel)
+
+	async def remove_handler(self, channel:str, handler:Callable[[str|None],None]):
+		handlers = self._handlers[channel]
+		handlers.remove(handler)
+		if not handlers:
+			del self._handlers[channel]
+			if not self._subscribed(channel) and self._pubsub is not None:
+				await self._pubsub.unsubscribe(channel)
+
+	@asynccontextmanager
+	async def subscription(self, channel:str)->AbstractAsyncContextManager[asyncio.Event]:
+		"""Subscribe to the channel while in context, the yielded event is set on every message of the channel."""
+		event = asyncio.Event()
+		new_channel = not self._subscribed(channel)
+		self._waiters.setdefault(channel, set()).add(event)
+		try:
+			await self._ensure_started()
+			if new_channel:
+				await self._pubsub.subscribe(channel)
+			yield event
+		finally:
+			waiters = self._waiters[channel]
+			waiters.discard(event)
+			if not waiters:
+				del self._waiters[channel]
+				if not self._subscribed(channel) and self._pubsub is not None:
+					await self._pubsub.unsubscribe(channel)
+
+	async def close(self):
+		if self._task is not None:
+			self._task.cancel()
+			try:
+				await self._task
+			except asyncio.CancelledError:
+				pass
+			self._task = None
+		if self._pubsub is not None:
+			await self._pubsub.aclose()
+			self._pubsub = None
+
+PUBSUB_HUB = PubSubHub()
+
+
+class Histogram:
+	"""Cumulative histogram with fixed buckets, Prometheus style."""
+	def __init__(self, buckets:Sequence[float]):
+		self.buckets = tuple(buckets)
+		self.counts = [0]*(len(self.buckets)+1) # last one is +Inf
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value:float):
+		self.counts[bisect_left(self.buckets, value)] += 1
+		self.sum += value
+		self.count += 1
+
+	def export(self, name:str, labels:str)->list[str]:
+		lines, cumulative = [], 0
+		for le, n in zip((*self.buckets, "+Inf"), self.counts):
+			cumulative += n
+			lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+		lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+		lines.append(f"{name}_count{{{labels}}} {self.count}")
+		return lines
+
+_CURRENT_OPERATION: ContextVar[str|None] = ContextVar("chatbone_broker_operation", default=None)
+
+class BrokerMetrics:
+	"""In-process metrics of broker operations: latency histograms, Redis commands, round trips and request bytes
+	issued inside each operation, lock wait and hold times. Export with 'export_prometheus'.
+	Recording is a few dict updates per operation and per command, commands outside broker operations are not recorded.
+	Redis commands are counted, attributed to the innermost running operation, only after 'install' is called at startup of
+	the application, importing the broker leaves redis-py untouched.
+		Examples:
+			BROKER_METRICS.install() # at startup
+
+			@instrumented("save")
+			async def save(self, ...): ...
 
+			text = BROKER_METRICS.export_prometheus()
+	"""
+	latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+	prefix = "chatbone_broker"
+
+	def __init__(self, enabled:bool=True):
+		self.enabled = enabled
+		self._installed = False
+		self.reset()
+
+	def reset(self):
+		self.operation_seconds:dict[str,Histogram] = defaultdict(lambda: Histogram(self.latency_buckets))
+		self.operation_errors:dict[str,int] = defaultdict(int)
+		self.commands:dict[tuple[str,str],int] = defaultdict(int)
+		self.roundtrips:dict[str,int] = defaultdict(int)
+		self.request_bytes:dict[str,int] = defaultdict(int)
+		self.lock_wait_seconds:dict[str,Histogram] = defaultdict(lambda: Histogram(self.latency_buckets))
+		self.lock_hold_seconds:dict[str,Histogram] = defaultdict(lambda: Histogram(self.latency_buckets))
+
+	def observe_lock(self, lock:str, wait:float|None=None, hold:float|None=None):
+		if not self.enabled:
+			return
+		if wait is not None:
+			self.lock_wait_seconds[lock].observe(wait)
+		if hold is not None:
+			self.lock_hold_seconds[lock].observe(hold)
+
+	def _record_commands(self, commands:Sequence[Sequence[Any]]):
+		if (op := _CURRENT_OPERATION.get()) is None:
+			return
+		self.roundtrips[op] += 1
+		size = 0
+		for args in commands:
+			self.commands[(op, str(args[0]).upper())] += 1
+			for arg in args:
+				size += len(arg) if isinstance(arg, (str, bytes)) else 8
+		self.request_bytes[op] += size
+
+	def install(self):
+		"""Wrap redis-py 'Redis.execute_command', 'Pipeline.immediate_execute_command' and 'Pipeline.execute' to count
+		commands. This affects every redis-py client of the process, so it is left to the application, idempotent,
+		nothing is done if metrics are disabled."""
+		if self._installed or not self.enabled:
+			return
+		self._installed = True
+		metrics = self
+		execute_command, immediate_execute_command, execute = \
+			Redis.execute_command, Pipeline.immediate_execute_command, Pipeline.execute
+
+		@functools.wraps(execute_command)
+		async def redis_execute_command(self, *args, **options):
+			metrics._record_commands((args,))
+			return await execute_command(self, *args, **options)
+
+		@functools.wraps(immediate_execute_command)
+		async def pipeline_immediate_execute_command(self, *args, **options):
+			metrics._record_commands((args,))
+			return await immediate_execute_command(self, *args, **options)
+
+		@functools.wraps(execute)
+		async def pipeline_execute(self, *args, **kwargs):
+			if self.command_stack:
+				metrics._record_commands([cmd for cmd, _ in self.command_stack])
+			return await execute(self, *args, **kwargs)
+
+		Redis.execute_command = redis_execute_command
+		Pipeline.immediate_execute_command = pipeline_immediate_execute_command
+		Pipeline.execute = pipeline_execute
+
+	def export_prometheus(self)->str:
+		"""Metrics in Prometheus text exposition format."""
+		p = self.prefix
+		lines = [f"# HELP {p}_operation_seconds Latency of broker operations.", f"# TYPE {p}_operation_seconds histogram"]
+		for op, h in sorted(self.operation_seconds.items()):
+			lines += h.export(f"{p}_operation_seconds", f'op="{op}"')
+		lines += [f"# HELP {p}_operation_errors_total Broker operations raised an error.", f"# TYPE {p}_operation_errors_total counter"]
+		lines += [f'{p}_operation_errors_total{{op="{op}"}} {n}' for op, n in sorted(self.operation_errors.items())]
+		lines += [f"# HELP {p}_redis_commands_total Redis commands issued by broker operations.", f"# TYPE {p}_redis_commands_total counter"]
+		lines += [f'{p}_redis_commands_total{{op="{op}",command="{cmd}"}} {n}' for (op, cmd), n in sorted(self.commands.items())]
+		lines += [f"# HELP {p}_redis_roundtrips_total Redis round trips (commands or pipelines) of broker operations.",
+		          f"# TYPE {p}_redis_roundtrips_total counter"]
+		lines += [f'{p}_redis_roundtrips_total{{op="{op}"}} {n}' for op, n in sorted(self.roundtrips.items())]
+		lines += [f"# HELP {p}_redis_request_bytes_total Approximate request payload of broker operations.",
+		          f"# TYPE {p}_redis_request_bytes_total counter"]
+		lines += [f'{p}_redis_request_bytes_total{{op="{op}"}} {n}' for op, n in sorted(self.request_bytes.items())]
+		for name, hs, doc in (("lock_wait_seconds", self.lock_wait_seconds, "Time to acquire locks."),
+		                      ("lock_hold_seconds", self.lock_hold_seconds, "Time locks were held.")):
+			lines += [f"# HELP {p}_{name} {doc}", f"# TYPE {p}_{name} histogram"]
+			for lock, h in sorted(hs.items()):
+				lines += h.export(f"{p}_{name}", f'lock="{lock}"')
+		return "\n".join(lines) + "\n"
+
+BROKER_METRICS = BrokerMetrics(CONFIG.metrics_enabled)
+
+def instrumented(op:str):
+	"""Record latency, errors and Redis commands of an async broker operation in BROKER_METRICS."""
+	def decorator(fn):
+		@functools.wraps(fn)
+		async def wrapper(*args, **kwargs):
+			if not BROKER_METRICS.enabled:
+				return await fn(*args, **kwargs)
+			token = _CURRENT_OPERATION.set(op)
+			start = time.perf_counter()
+			try:
+				return await fn(*args, **kwargs)
+			except BaseException:
+				BROKER_METRICS.operation_errors[op] += 1
+				raise
+			finally:
+				BROKER_METRICS.operation_seconds[op].observe(time.perf_counter() - start)
+				_CURRENT_OPERATION.reset(token)
+		return wrapper
+	return decorator
+
+def reload_functions_on_missing(fn):
+	"""Reload 'FUNCTIONS_LIBRARY' and call 'fn' again once, when Redis lost it (FLUSHALL, FUNCTION FLUSH, failover to a
+	replica without it). A transaction may be partly applied before the error, so 'fn' must be safe to repeat."""
+	@functools.wraps(fn)
+	async def wrapper(*args, **kwargs):
+		try:
+			return await fn(*args, **kwargs)
+		except ResponseError as e:
+			if "Function not found" not in str(e):
+				raise
+			logger.warning(f"Redis functions library '{FUNCTIONS_LIBRARY_NAME}' is missing, reload and retry. {e!r}")
+			await ChatboneData.load_functions()
+			return await fn(*args, **kwargs)
+	return wrapper
 
 
 class ChatboneData(BaseModel,ABC):
 	"""This class for data work with Redis.
 	All Redis keys are very important for cascade deleting or expiring, they must:
 
-		1. Be defined as property, method name ends with '_rkey' and returns string. See the 'all_rkeys' method.
+		1. Be defined as property, method name ends with '_rkey' and returns string. See the '_build_rkey_schema' method.
 		2. Have its own id, so that each instance has separate rkey.
 	    3. All keys need to be static (constant, or bound with the top level key (with id)), dynamic case should raise when not available.
-	    4. Ensure all rkey always exist at the time of expiring or deleting.
+	    4. Be registered with 'register_sub_rkeys' when created, cascade expiring and deleting work from the registry set.
 
 	static means
 
@@ -59,7 +622,20 @@ class ChatboneData(BaseModel,ABC):
 	"""This attribute is used by embedding Model, and created by the model hold redis key."""
 	_refresh_include_default:set[str] = PrivateAttr(default_factory=set)
 
-	async def refresh(self, exclude:set[str]|None=None, include:set[str]|None=None)->Self:
+	_field_adapters: ClassVar[dict[str,TypeAdapter]] = {}
+	"""Field name -> TypeAdapter of its annotation, built per subclass."""
+	_field_kinds: ClassVar[dict[str,FieldKind]] = {}
+	_rkey_schema: ClassVar[tuple[tuple[str, RkeySlotKind], ...]] = ()
+	"""Where sub rkeys live, built once per class at definition time. See '_build_rkey_schema'."""
+	_functions_loaded: ClassVar[bool] = False
+	_json_mset_supported: ClassVar[bool|None] = None
+	"""None means not checked yet, see '_probe_json_mset'."""
+	_notify_fields: ClassVar[frozenset[str]] = frozenset()
+	"""Fields publish a notification to 'field_channel' when they are written, see '_publish_changed'."""
+
+	@instrumented("refresh")
+	async def refresh(self, exclude:set[str]|None=None, include:set[str]|None=None,
+	                  mode:Literal['rebuild','copy','inplace']='rebuild')->Self:
 		"""Refresh fields. If both 'exclude' and 'include' are None, refresh the default,
 		typically information for resolving dynamic redis keys.
 
@@ -69,9 +645,13 @@ class ChatboneData(BaseModel,ABC):
 		Args:
 			exclude: Refresh field includes all available fields that not this set. Set this blank set to refresh all.
 			include: Refresh field includes all available fields that in this set.
+			mode:
+				- 'rebuild': dump the whole object, update with fetched fields and validate the entire model again.
+				- 'copy': validate only fetched fields and assign them to a shallow copy, untouched sub-models are kept by reference.
+				- 'inplace': like 'copy' but assign to this object.
 
 		Returns:
-			New refreshed object of this class.
+			New refreshed object of this class (or this object in 'inplace' mode).
 		"""
 		def resolve_fields(exclude:set[str]|None, include:set[str]|None)->set[str]:
 			if include is not None and exclude is not None:
@@ -88,16 +668,33 @@ class ChatboneData(BaseModel,ABC):
 		if len(fields)==0:
 			return self
 
-		if (r:= await self.redis.json().get(self.rkey,*[f"{self._jsonpath}.{field}" for field in fields])) is None:
+		paths = self._refresh_paths(fields)
+		if (r:= await self.redis.json().get(self.rkey,*paths)) is None:
 			raise KeyError("User data doesn't exist. Call 'save' first.")
-		if len(fields)==1:
-			r = {fields.pop(): r}
-		else:
-			r = {k[1:]:v for k,v in r.items()}
-		assert isinstance(r,dict)
-		# TODO: maybe it somehow not effective to create new object, test and compare performance of update vs create new one.
-
-		logger.debug(f"Update attributes with dict:\n {json.dumps(r, indent=4)}")
+		return self._apply_refresh(paths, r, mode)
+
+	def _refresh_paths(self, fields:set[str])->dict[str,str]:
+		"""Map json paths of fields to fetch to their field names."""
+		return {f"{self._jsonpath}.{field}": field for field in fields}
+
+	@staticmethod
+	def _refreshed_fields(paths:dict[str,str], r:Any)->dict[str,Any]:
+		"""Map the 'JSON.GET' result of paths to field values."""
+		if len(paths)==1:
+			return {next(iter(paths.values())): r}
+		return {paths[k]:v for k,v in r.items()}
+
+	def _apply_refresh(self, paths:dict[str,str], r:Any, mode:Literal['rebuild','copy','inplace'])->Self:
+		"""Apply the 'JSON.GET' result of paths, see 'refresh'."""
+		r = self._refreshed_fields(paths, r)
+
+		if mode != 'rebuild':
+			obj = self if mode == 'inplace' else self.model_copy()
+			for field, value in r.items():
+				setattr(obj, field, value) # validate_assignment validates this field only.
+			return obj
+
+		logger.opt(lazy=True).debug("Update attributes with dict:\n {}", lambda: json.dumps(r, indent=4))
 		obj_dict = self.model_dump()
 		obj_dict.update(r) # Note: swallow update is intentional.
 		new_object = self.__class__.model_validate(obj_dict)
@@ -119,7 +716,19 @@ class ChatboneData(BaseModel,ABC):
 				raise ValueError("This embedding object haven't bound any base rkey.")
 			else:
 				return self._base_rkey
-		return f"{self.rkey_prefix}:{self.id}"
+		return self.make_rkey(self.id)
+
+	@classmethod
+	def make_rkey(cls, id: UUID|str) -> str:
+		"""Main rkey of the non-embedding object with this id."""
+		return f"{cls.rkey_prefix}:{id}"
+
+	@property
+	def registry_rkey(self) -> str:
+		"""Redis set of all sub rkeys created under the main rkey. Cascade operations work from this set,
+		so that they don't need to resolve sub rkeys from the object (see 'register_sub_rkeys').
+		Embedding objects share the registry of the main rkey they bound with."""
+		return f"{self.rkey}:{REGISTRY_POSTFIX}"
 
 
 	def bind_rkey_and_json_path(self, rkey:str, jsonpath:str):
@@ -133,69 +742,80 @@ class ChatboneData(BaseModel,ABC):
 
 
 	def get_all_sub_rkeys(self)->list[str]:
-		"""Get sub rkeys, which is the property method with name end with '_rkey' and return string.
-		Notes:
-			This attribute will block cpu.
-		"""
+		"""Get sub rkeys, resolved from the class rkey schema (see '_build_rkey_schema')."""
 		rkeys:list[str] = []
-		fields = self.model_fields
-
-		for name in dir(self):
-			if 	name.startswith('__') or name in ['rkey','all_sub_rkeys','get_all_sub_rkeys','is_bounded']:
-				continue
-
-			f = fields.get(name)
-			if not isinstance(getattr(self.__class__, name,None), property) and f is None:
-				# if not a property or a field
-				continue
-
-			# Field case: Field exist, and a field value type must be ChatboneData,
-			# list[ChatBoneData], Tuple[ChatBoneData,...] and dict[Any, ChatBoneData]
-			if isinstance(attr:=getattr(self, name),(ChatboneData, list,dict,tuple) ) and f is not None :
-				org = get_origin(f.annotation)
-
-				if org is None:
-					# Not any container or implicit container typehint case. We have to detect that because when implicit,
-					# We do not know what exactly it stores, can be ChatboneData or not. Missing will lead to leak redis keys.
-					try:
-						assert isinstance(attr, ChatboneData)
-					except AssertionError:
-						raise SyntaxError(f"Type hint of all container in pydantic model must be explicit. "
-						                  f"Ex: list[str], dict[str,str] not list or dict."
-						                  f" Got {f.annotation}.")
+		for name, kind in self._rkey_schema:
+			attr = getattr(self, name)
+			if kind == 'property':
+				if not isinstance(attr, str):
+					raise SyntaxError(f"rkey property method {name} must return value type string, got {type(attr)}")
+				rkeys.append(attr)
+			elif kind == 'model':
+				if isinstance(attr, ChatboneData):
 					rkeys.extend(attr.get_all_sub_rkeys())
-
-				elif issubclass(org,list) and issubclass(get_args(f.annotation)[0],ChatboneData):
-					assert isinstance(attr,list)
-					for cbd in attr:
-						assert isinstance(cbd,ChatboneData)
-						rkeys.extend(cbd.get_all_sub_rkeys())
-				elif issubclass(org,tuple):
-					assert isinstance(attr,tuple)
-					try:
-						cbd:ChatboneData = attr[attr.index(ChatboneData)]
-						rkeys.extend(cbd.get_all_sub_rkeys())
-					except ValueError:
-						continue
-				elif issubclass(org,dict):
-					assert isinstance(attr,dict)
-					for cbd in attr.values():
-						assert isinstance(cbd,ChatboneData)
+			else:
+				for cbd in (attr.values() if kind == 'dict' else attr):
+					if isinstance(cbd, ChatboneData):
 						rkeys.extend(cbd.get_all_sub_rkeys())
+		return rkeys
 
-			# Property case exists only name is not in field case.
-			elif (iscoroutine(attr) or callable(attr)) or (not name.endswith('_rkey')):
-				# Filter properties or field.
-				continue
+	@classmethod
+	def __pydantic_init_subclass__(cls, **kwargs):
+		super().__pydantic_init_subclass__(**kwargs)
+		cls._rkey_schema = cls._build_rkey_schema()
+		cls._field_adapters, cls._field_kinds = cls._build_field_adapters()
 
-			else:
-				try:
-					assert isinstance(attr,str)
-					rkeys.append(attr)
-				except AssertionError:
-					raise SyntaxError(f"rkey property method {name} must return value type string, got {type(attr)}")
+	@classmethod
+	def _build_field_adapters(cls)->tuple[dict[str,TypeAdapter], dict[str,FieldKind]]:
+		"""Compile once per class the validators used by the modify methods, see '_validate_field'."""
+		adapters, kinds = {}, {}
+		for name, f in cls.model_fields.items():
+			adapters[name] = TypeAdapter(f.annotation)
+			org = get_origin(f.annotation)
+			kinds[name] = 'other' if not isinstance(org, type) \
+				else 'dict' if issubclass(org, dict) else 'sequence' if issubclass(org, Sequence) else 'other'
+		return adapters, kinds
 
-		return rkeys
+	@classmethod
+	def _build_rkey_schema(cls)->tuple[tuple[str, RkeySlotKind], ...]:
+		"""Resolve once per class where the sub rkeys live, so that 'get_all_sub_rkeys' does not need reflection.
+		Slots are:
+			1. 'property': property method with name ends with '_rkey' and returns string.
+			2. 'model', 'sequence', 'dict': field holds ChatboneData, list[ChatboneData] (or tuple) or dict[Any, ChatboneData].
+		Raises:
+			SyntaxError: Implicit container type hint, we cannot know if it stores ChatboneData or not, missing will lead to leak redis keys.
+		"""
+		schema:list[tuple[str, RkeySlotKind]] = []
+		for name in dir(cls):
+			if name.endswith('_rkey') and not name.startswith('__') and name != 'registry_rkey' \
+					and isinstance(getattr_static(cls, name, None), property):
+				schema.append((name, 'property'))
+
+		def is_cbd(tp: Any) -> bool:
+			return isinstance(tp, type) and issubclass(tp, ChatboneData)
+
+		for name, f in cls.model_fields.items():
+			ann = f.annotation
+			org = get_origin(ann)
+			args = get_args(ann)
+			if org is None:
+				if ann in (list, tuple, dict, set):
+					raise SyntaxError(f"Type hint of all container in pydantic model must be explicit. "
+					                  f"Ex: list[str], dict[str,str] not list or dict. Got {ann} for field '{name}'.")
+				if is_cbd(ann):
+					schema.append((name, 'model'))
+			elif org in (Union, UnionType):
+				if any(is_cbd(a) for a in args):
+					schema.append((name, 'model'))
+			elif not isinstance(org, type):
+				continue
+			elif issubclass(org, dict):
+				if is_cbd(args[1]):
+					schema.append((name, 'dict'))
+			elif issubclass(org, (list, tuple)):
+				if any(is_cbd(a) for a in args):
+					schema.append((name, 'sequence'))
+		return tuple(schema)
 
 	@property
 	def is_bounded(self)->bool:
@@ -205,10 +825,12 @@ class ChatboneData(BaseModel,ABC):
 
 	@property
 	async def all_sub_rkeys(self)->list[str]:
-		return await asyncio.to_thread(self.get_all_sub_rkeys)
+		return self.get_all_sub_rkeys()
 
+	@instrumented("expire")
+	@reload_functions_on_missing
 	async def expire(self, num_seconds: int, redis_or_pipeline: Redis | None = None):
-		"""Expire all keys of this object.
+		"""Expire main rkey and all registered sub rkeys of this object. Object doesn't need to be refreshed.
 		Args:
 			num_seconds:
 			redis_or_pipeline:
@@ -216,27 +838,62 @@ class ChatboneData(BaseModel,ABC):
 		if self.embedding:
 			raise ValueError("Embedding model cannot do this operation .")
 		async with self._get_transaction_pipeline(redis_or_pipeline) as pipeline:
-			await self.expire_cascade(num_seconds, (await self.all_sub_rkeys) + [self.rkey], pipeline)
+			await self.expire_cascade(num_seconds, [], pipeline)
+			await self._update_indexes(pipeline, self.id)
 
+	@instrumented("expire_sync")
+	@reload_functions_on_missing
 	async def expire_sync(self, keys: list[str], redis_or_pipeline: Redis | None = None) -> None:
-		"""Expire all Models sync with this object's main rkey lifetime (with 'rkey' key)."""
+		"""Expire all Models sync with this object's main rkey lifetime (with 'rkey' key).
+		TTL of the main rkey is read on the server side, in the same call that expires the keys.
+		If the main rkey does not exist, keys are left untouched.
+		"""
+		await self.load_functions(skip_if_loaded=True)
 		async with self._get_transaction_pipeline(redis_or_pipeline) as pipeline:
-			num_seconds = await self.redis.ttl(self.rkey)
-			keys = deepcopy(keys)
-			keys.append(self.rkey)
-			await self.expire_cascade(num_seconds, keys, pipeline)
+			await pipeline.fcall(function_name('expire_sync'), len(keys)+2, self.rkey, self.registry_rkey, *keys)
 
+	@instrumented("expire_cascade")
+	@reload_functions_on_missing
 	async def expire_cascade(self, num_seconds: int, keys: list[str], redis_or_pipeline: Redis | None = None):
-		"""Expire all keys with the same num_seconds. Negative value means persist (Note that in raw redis, negative means delete)."""
+		"""Expire main rkey, registered sub rkeys and 'keys' with the same num_seconds.
+		Negative value means persist (Note that in raw redis, negative means delete)."""
 		assert isinstance(num_seconds,int)
+		await self.load_functions(skip_if_loaded=True)
 		async with self._get_transaction_pipeline(redis_or_pipeline) as pipeline:
 			if num_seconds>0:
-				for k in keys:
-					await pipeline.expire(k, num_seconds)
+				await pipeline.fcall(function_name('cascade_expire'), len(keys)+2, self.rkey, self.registry_rkey, *keys, num_seconds)
 			else:
-				for k in keys:
-					await pipeline.persist(k)
+				await pipeline.fcall(function_name('cascade_persist'), len(keys)+2, self.rkey, self.registry_rkey, *keys)
+
+	@reload_functions_on_missing
+	async def register_sub_rkeys(self, keys: list[str], redis_or_pipeline: Redis | None = None) -> None:
+		"""Add newly created sub rkeys to the registry and expire them sync with the main rkey lifetime.
+		Every dynamic sub rkey must be registered here, or it will be leaked by cascade operations."""
+		await self.load_functions(skip_if_loaded=True)
+		async with self._get_transaction_pipeline(redis_or_pipeline) as pipeline:
+			await pipeline.fcall(function_name('register_sub_rkeys'), len(keys)+2, self.rkey, self.registry_rkey, *keys)
+
+	async def rebuild_registry(self, redis_or_pipeline: Redis | None = None) -> None:
+		"""Register all sub rkeys resolved from this object (see 'get_all_sub_rkeys'), for data created before the registry exists.
+		Object must be refreshed to resolve dynamic rkeys."""
+		if self.embedding:
+			raise ValueError("Embedding model cannot do this operation .")
+		if keys := self.get_all_sub_rkeys():
+			await self.register_sub_rkeys(keys, redis_or_pipeline)
+
+	@classmethod
+	async def load_functions(cls, redis: Redis | None = None, skip_if_loaded: bool = False) -> None:
+		"""Register the broker Redis Functions library (see 'FUNCTIONS_LIBRARY'). Should be called at startup,
+		cascade methods also call it lazily once per process, and again if Redis lost it (see 'reload_functions_on_missing').
+		"""
+		if skip_if_loaded and ChatboneData._functions_loaded:
+			return
+		await (redis or cls.redis).function_load(FUNCTIONS_LIBRARY, replace=True)
+		ChatboneData._functions_loaded = True
+		logger.debug(f"Redis functions library '{FUNCTIONS_LIBRARY_NAME}' loaded.")
 
+	@instrumented("save")
+	@reload_functions_on_missing
 	async def save(self,expire_seconds:int|None=None, refresh:bool=True )->bool|None|Self:
 		"""Save data with self.rkey. Skip if existed. If you want to save a new one, 'delete' first.
 		Args:
@@ -248,21 +905,53 @@ class ChatboneData(BaseModel,ABC):
 		# TODO: support skip and update in save ?, careful handle cascade keys.
 		if self.embedding:
 			raise ValueError("Embedding model cannot do this operation .")
-		_ =  await self.redis.json().set(self.rkey,'.',self.model_dump(mode='json'),nx=True)
-		obj = (await self.refresh()) if refresh else self
+		self._check_document()
+		await self.load_functions(skip_if_loaded=True)
+		async with self._get_transaction_pipeline(execute=False) as pipeline:
+			await pipeline.json().set(self.rkey,'.',self.model_dump(mode='json'),nx=True)
+			await self._publish_changed(pipeline)
+			await self._update_indexes(pipeline, self.id)
+			_ = await pipeline.execute()
+		obj = (await self.refresh(mode='copy')) if refresh else self
 		if expire_seconds is not None:
 			await obj.expire(expire_seconds)
 		return obj
 
+	@instrumented("delete")
+	@reload_functions_on_missing
 	async def delete(self)->int:
-		"""Cascading delete for all redis keys. Note again that this method deletes all redis keys, not the JSON keys.
+		"""Cascading delete for main rkey and all registered sub rkeys. Note again that this method deletes all redis keys, not the JSON keys.
+		Object doesn't need to be refreshed.
 		Returns:
 			Number of keys were removed.
 		"""
 		if self.embedding:
 			raise ValueError("Embedding model cannot do this operation .")
-		return await self.redis.delete(self.rkey, *(await self.all_sub_rkeys))
+		await self.load_functions(skip_if_loaded=True)
+		async with self._get_transaction_pipeline(execute=False) as pipeline:
+			await self._update_indexes(pipeline, self.id, deleted=True)
+			await pipeline.fcall(function_name('cascade_delete'), 2, self.rkey, self.registry_rkey)
+			await self._publish_changed(pipeline)
+			*_, n, _ = await pipeline.execute()
+		return n
+
+	async def _publish_changed(self, pipeline:Pipeline, fields:Iterable[str]=()):
+		"""Queue the notification of DATA_CHANGED_CHANNEL, must be called by every write to the main rkey.
+		Written 'fields' in '_notify_fields' are also notified to their 'field_channel'."""
+		for channel, message in self._changed_notifications(fields):
+			await pipeline.publish(channel, message)
+
+	def _changed_notifications(self, fields:Iterable[str]=())->list[tuple[str,str|int]]:
+		"""(channel, message) published by '_publish_changed'."""
+		return [(DATA_CHANGED_CHANNEL, self.rkey)] + [(self.field_channel(field), 1) for field in self._notify_fields.intersection(fields)]
+
+	@classmethod
+	async def _update_indexes(cls, pipeline:Pipeline, id:UUID, deleted:bool=False):
+		"""Queue the updates of secondary indexes of the object with this id, called by 'save', 'expire' and 'delete'
+		(and TTLHeartbeat, which does not keep the object) in their pipelines, before the main rkey is deleted.
+		Functions library must be loaded. Nothing by default."""
 
+	@instrumented("append")
 	async def append(self, field: str, values: list[Any],redis_or_pipeline: Redis | None = None):
 		"""Append to a JSON list.
 		Args:
@@ -274,16 +963,18 @@ class ChatboneData(BaseModel,ABC):
 			If the pipeline is given, return None.
 		"""
 		# TODO, append to instance also ? not only on server. or let the client do refresh ?
-		await asyncio.to_thread(self._check_list_params,field, values)
+		self._check_list_params(field, values)
 
 		async with self._get_transaction_pipeline(redis_or_pipeline,  execute=False) as pipeline:
 			coro: Awaitable[list[int | None]] = pipeline.json().arrappend(self.rkey, f"{self._jsonpath}.{field}",
-			                                                              *(await asyncio.to_thread(dump_base_models,values,'json')))
+			                                                              *self._field_adapters[field].dump_python(values, mode='json'))
 			await coro
+			await self._publish_changed(pipeline, (field,))
 			if not redis_or_pipeline:
 				return (await pipeline.execute())[0]
 		return None
 
+	@instrumented("trim")
 	async def trim(self, field:str, start:int, stop:int,redis_or_pipeline: Redis | None = None) ->int:
 		"""
 		Keep the range of value
@@ -296,29 +987,54 @@ class ChatboneData(BaseModel,ABC):
 		Returns:
 			Number of values remain.
 		"""
-		await asyncio.to_thread(self._check_list_params,field)
+		self._check_list_params(field)
 		async with self._get_transaction_pipeline(redis_or_pipeline,  execute=False) as pipeline:
 			coro: Awaitable[list[int | None]] = pipeline.json().arrtrim(self.rkey,f"{self._jsonpath}.{field}", start,stop)
 			await coro
+			await self._publish_changed(pipeline, (field,))
 			if not redis_or_pipeline:
 				return (await pipeline.execute())[0]
 		return None
 
+	@instrumented("update")
 	async def update(self, field:str, values:dict[Any,Any],redis_or_pipeline: Redis | None = None):
-		"""Update the dict with keys and values.
+		"""Update the dict with keys and values. All keys are written by one 'JSON.MSET' if the server supports it,
+		otherwise by one 'JSON.SET' per key in the same transaction.
 		Args:
 			field: typehint of field must be a dict[Any,Any]
 			values: must be type dict that match the field.
 			redis_or_pipeline:
 		Returns:
 		"""
-		await asyncio.to_thread(self._check_dict_params,field,values)
+		self._check_dict_params(field,values)
+		if not values:
+			return
+		triplets = [(self.rkey, f"{self._jsonpath}.{field}.{k}", v)
+		            for k,v in self._field_adapters[field].dump_python(values, mode='json').items()]
+		if ChatboneData._json_mset_supported is None:
+			await self._probe_json_mset()
 		async with self._get_transaction_pipeline(redis_or_pipeline) as pipeline:
+			await self._publish_changed(pipeline, (field,))
+			if self._json_mset_supported:
+				return await pipeline.json().mset(triplets)
 			coros:list[Awaitable[list[int | None]]] = []
-			for k,v in values.items():
-				coros.append(pipeline.json().set(self.rkey, f"{self._jsonpath}.{field}.{k}",v) )
+			for rkey, path, v in triplets:
+				coros.append(pipeline.json().set(rkey, path, v) )
 			return await asyncio.gather(*coros)
 
+	@classmethod
+	async def _probe_json_mset(cls):
+		"""Check once per process whether the server has 'JSON.MSET' (RedisJSON 2.6+): a call without arguments
+		fails with an arity error if the command exists, so nothing is written."""
+		try:
+			await cls.redis.execute_command("JSON.MSET")
+			supported = True
+		except ResponseError as e:
+			supported = "unknown command" not in str(e).lower()
+		ChatboneData._json_mset_supported = supported
+		logger.debug(f"JSON.MSET supported: {supported}.")
+
+	@instrumented("set")
 	async def set(self, field: str, value: Any,redis_or_pipeline: Redis | None = None):
 		""" Override the attributes to entirely new one.
 		Args:
@@ -327,60 +1043,152 @@ class ChatboneData(BaseModel,ABC):
 			redis_or_pipeline:
 		Returns:
 		"""
-		await asyncio.to_thread(self._check_params,field,value)
+		self._check_params(field,value)
 		async with self._get_transaction_pipeline(redis_or_pipeline) as pipeline:
-			if isinstance(value,BaseModel):
-				value = value.model_dump(mode='json')
+			value = self._field_adapters[field].dump_python(value, mode='json')
 			coro: Awaitable[list[int | None]] = pipeline.json().set(self.rkey,f"{self._jsonpath}.{field}",value)
-			return await coro
+			r = await coro
+			await self._publish_changed(pipeline, (field,))
+			return r
+
+	def field_channel(self, field:str)->str:
+		"""Pub/sub channel notified when the field is written, see '_notify_fields'."""
+		return f"{self.rkey}:<changed>{self._jsonpath}.{field}"
 
+	@instrumented("clear")
 	async def clear(self, field: str, value: Any, redis_or_pipeline: Redis | None = None):
 		"""Clear container values (arrays/objects) and set numeric values to 0"""
-		await asyncio.to_thread(self._check_params,field,value)
+		self._check_params(field,value)
 		async with self._get_transaction_pipeline(redis_or_pipeline) as pipeline:
+			await self._publish_changed(pipeline, (field,))
 			coro: Awaitable[list[int | None]] = pipeline.json().clear(self.rkey,f"{self._jsonpath}.{field}")
 			return await coro
 
+	@instrumented("refresh_versioned")
+	async def refresh_versioned(self, include:"set[str]", mode:Literal['rebuild','copy','inplace']='copy')->tuple[Self,int]:
+		"""Refresh fields in 'include' together with the version of the main rkey, in one round trip.
+		Returns:
+			(refreshed object, version), see 'refresh' and 'versioned_set'.
+		"""
+		paths = self._refresh_paths({field for field in include if field in type(self).model_fields})
+		async with self.redis.pipeline(transaction=False) as pipeline:
+			await pipeline.json().get(self.rkey, "$.__version__")
+			if paths:
+				await pipeline.json().get(self.rkey, *paths)
+			version, *r = await pipeline.execute()
+		if version is None or (paths and r[0] is None):
+			raise KeyError("User data doesn't exist. Call 'save' first.")
+		obj = self._apply_refresh(paths, r[0], mode) if paths else self
+		return obj, (version[0] if version else 0)
+
+	@instrumented("versioned_set")
+	@reload_functions_on_missing
+	async def versioned_set(self, values:dict[str,Any], expected_version:int)->int:
+		"""Optimistic concurrency: set fields only if no other versioned write happened since 'expected_version' was read
+		(by 'refresh_versioned'), in one atomic call and without any lock. The version is kept at '__version__' of the
+		main rkey JSON document, it is shared by the whole document (embedding objects included).
+		Notes:
+			Only versioned writes increase the version, changes by 'set', 'update', ... are not detected.
+		Args:
+			values: field -> new value.
+			expected_version:
+		Returns:
+			New version.
+		Raises:
+			VersionConflictError, RedisKeyError
+		"""
+		args = []
+		for field, value in values.items():
+			self._check_params(field, value)
+			args += [f"{self._jsonpath}.{field}", self._field_adapters[field].dump_json(value).decode()]
+		# Notifications are published by the function, only if the write happens.
+		notifications = [x for item in self._changed_notifications(values) for x in item]
+		await self.load_functions(skip_if_loaded=True)
+		try:
+			return await self.redis.fcall(function_name('versioned_set'), 2, self.rkey, self.registry_rkey, expected_version,
+			                              len(notifications)//2, *notifications, *args)
+		except ResponseError as e:
+			if "VERSIONCONFLICT" in str(e):
+				raise VersionConflictError(expected_version, int(re.search(r"VERSIONCONFLICT (\d+)", str(e))[1])) from e
+			if "NOKEY main rkey" in str(e):
+				raise RedisKeyError("User data doesn't exist. Call 'save' first.") from e
+			raise
+
+	async def versioned_modify(self, include:"set[str]", modify:Callable[[Self], dict[str,Any]],
+	                           max_retries:int=5, backoff:float=0.01)->tuple[Self,int]:
+		"""Read-modify-write with retry on conflict: refresh 'include' fields and the version, get the new values by
+		'modify' on the refreshed object, then 'versioned_set' them.
+		Args:
+			include: fields that 'modify' reads.
+			modify: returns field -> new value, must have no side effects since it may be called many times.
+			max_retries:
+			backoff: seconds, doubled after every conflict.
+		Returns:
+			(refreshed object with new values, new version)
+		Raises:
+			VersionConflictError: still conflict after 'max_retries'.
+		"""
+		for attempt in range(max_retries+1):
+			obj, version = await self.refresh_versioned(include)
+			values = modify(obj)
+			try:
+				version = await obj.versioned_set(values, version)
+			except VersionConflictError as e:
+				if attempt == max_retries:
+					raise
+				logger.debug(f"{e} Retry {attempt+1}/{max_retries}.")
+				await asyncio.sleep(backoff * 2**attempt)
+				continue
+			for field, value in values.items():
+				setattr(obj, field, value)
+			return obj, version
+
 	def _check_params(self,field:str ,value:Any):
 		assert field not in ["id","redis","_jsonpath"]
-		ann = self.model_fields[field].annotation
-		org = get_origin(ann)
-		if org is None:
-			if not isinstance(value, ann):
-				raise ValueError(f"Field '{field}' type is '{ann}' but input value is '{type(value)}'.")
-			return
-		if issubclass(org,Sequence):
-			self._check_list_params(field,value)
-		if issubclass(org,dict):
-			self._check_dict_params(field,value)
-		raise ValueError(f"Type {value} is not supported.")
+		self._validate_field(field, value)
 
 	def _check_dict_params(self,field:str , values:dict):
-		ann = self.model_fields[field].annotation
-		org = get_origin(ann)
-		kt,vt = get_args(ann)
-		if not issubclass(org,dict):
-			raise ValueError(f"The field must be a dict. Got {get_origin(ann)}.")
-		for k,v in values.items():
-			if not isinstance(k,kt) or not isinstance(v,vt):
-				raise ValueError(f"KeyType must be {kt} and ValueType must be {vt}.")
+		if self._field_kinds[field] != 'dict':
+			raise ValueError(f"The field must be a dict. Got {type(self).model_fields[field].annotation}.")
+		self._validate_field(field, values)
 
 	def _check_list_params(self, field:str, values: list[Any]|None=None):
-		ann = self.model_fields[field].annotation
-		if not issubclass(get_origin(ann), Sequence):
-			raise ValueError(f"The field must be a Sequence. Got {get_origin(ann)} .")
+		if self._field_kinds[field] != 'sequence':
+			raise ValueError(f"The field must be a Sequence. Got {type(self).model_fields[field].annotation} .")
 		if values is not None:
-			for v in values:
-				if not isinstance(v, get_args(ann)[0]):
-					raise ValueError(f"Value to append in this field must be type {get_args(ann)[0]}. Got {type(values)} .")
+			self._validate_field(field, values)
+
+	def _check_document(self):
+		"""Called by 'save' before the whole object is written as the JSON document.
+		Raises:
+			ValueError
+		"""
+		pass
+
+	def _validate_field(self, field:str, value:Any):
+		"""Strict validation (no coercion, like isinstance checks) of the value (or values of a partial update/append)
+		against the field annotation, by the precompiled adapter.
+		Raises:
+			ValueError
+		"""
+		try:
+			self._field_adapters[field].validate_python(value, strict=True)
+		except ValidationError as e:
+			raise ValueError(f"Invalid value for field '{field}' of type '{type(self).model_fields[field].annotation}'. {e}") from e
 
 
 	@asynccontextmanager
 	async def _lock_modify(self,key:str,timeout:int|None=None, blocking_timeout:int|None=None):
 		timeout = timeout or CONFIG.redis_lock_timeout
 		blocking_timeout = blocking_timeout or CONFIG.redis_acquire_lock_timeout
+		start = time.perf_counter()
 		async with self.redis.lock(key,timeout=timeout,blocking_timeout=blocking_timeout) as lock:
-			yield lock
+			acquired = time.perf_counter()
+			BROKER_METRICS.observe_lock("modify", wait=acquired-start)
+			try:
+				yield lock
+			finally:
+				BROKER_METRICS.observe_lock("modify", hold=time.perf_counter()-acquired)
 
 	@asynccontextmanager
 	async def _get_transaction_pipeline(self, redis_or_pipeline: Redis | None = None, *,
@@ -427,7 +1235,7 @@ class StreamData(BaseModel):
 	def _encode(self):
 		encoder_data:dict[str,int|float|str|bytes] = {}
 		for field,value in self.model_dump(mode='json',exclude_none=True,exclude_defaults=True).items():
-			if not isinstance(value, (bytes, str, int, float)):
+			if isinstance(value, bool) or not isinstance(value, (bytes, str, int, float)): # Redis does not take bools.
 				encoder_data[field] = json.dumps(value)
 			else:
 				encoder_data[field] = value
@@ -450,6 +1258,42 @@ class StreamData(BaseModel):
 	async def decode(cls,data: dict[str,int|float|str|bytes])->Self:
 		return await asyncio.to_thread(cls._decode,data)
 
+PACKED_FIELD_PREFIX = "__packed_v"
+PACKED_FIELD = f"{PACKED_FIELD_PREFIX}1__"
+"""Stream entry field holding the whole packed StreamData, the field name is also the schema version tag."""
+
+class StreamCodec(ABC):
+	"""Convert StreamData to stream entry fields and back. Decoding detects the format of the entry,
+	so readers can read entries written by any codec."""
+
+	@abstractmethod
+	def encode(self, data: StreamData) -> dict[str,int|float|str|bytes]:
+		pass
+
+	@staticmethod
+	def decode[D: StreamData](datatype: type[D], fields: dict[str,int|float|str|bytes]) -> D:
+		if (payload := fields.get(PACKED_FIELD)) is not None:
+			return datatype.model_validate_json(payload)
+		for k in fields:
+			if k.startswith(PACKED_FIELD_PREFIX):
+				raise ValueError(f"Unsupported stream data schema version field '{k}', expect '{PACKED_FIELD}'.")
+		return datatype._decode(fields)
+
+class FieldsStreamCodec(StreamCodec):
+	"""One entry field per model field, nested values are json dumped. This is the original format."""
+	def encode(self, data: StreamData) -> dict[str,int|float|str|bytes]:
+		return data._encode()
+
+class PackedStreamCodec(StreamCodec):
+	"""The whole model is dumped as one compact json field (see 'PACKED_FIELD'), both ways run in pydantic core,
+	cheap enough to be done inline without thread hop."""
+	def encode(self, data: StreamData) -> dict[str,int|float|str|bytes]:
+		return {PACKED_FIELD: data.model_dump_json(exclude_none=True, exclude_defaults=True)}
+
+STREAM_CODECS:dict[str,type[StreamCodec]] = {'fields': FieldsStreamCodec, 'packed': PackedStreamCodec}
+DEFAULT_STREAM_CODEC:StreamCodec = STREAM_CODECS[CONFIG.stream_codec]()
+"""Codec of writers without an explicit one, see 'stream_codec' setting. Readers decode both formats."""
+
 class TextUrlsFormat(BaseModel):
 	# both fields are required
 	# TODO: make validation methods for the format.
@@ -473,6 +1317,7 @@ class AS2CSData(StreamData):
 	state: Literal['processing','done'] = Field(description="'done' means assistant reach its final phase and start stream out the result."
 	                                                        "And 'done' should be along with result_form, this is the result we show directly to user. "
 	                                                        "Also, when parse meet 'done' for the first time, all data after should be considered as done.")
+	end: bool = Field(False, description="Last entry of the reply, see StreamMaterializer.")
 
 class CS2ASData(StreamData):
 	type: Literal['supply','refuse'] =Field(description="Whether user supply more information or refuse to give any.")
@@ -480,18 +1325,32 @@ class CS2ASData(StreamData):
 	response: TextUrlsFormat|None=Field(None)
 #ckptr
 class Stream[T: (AS2CSData,CS2ASData) ]:
-	def __init__(self,stream_key:str, datatype: type[T]):
+	def __init__(self,stream_key:str, datatype: type[T], codec:StreamCodec|None=None):
 		self.datatype:type[T]  = datatype
 		self.key = stream_key
+		self.codec:StreamCodec = codec or DEFAULT_STREAM_CODEC
 
 	@classmethod
-	async def _create(cls, stream_key:str, stream_type:Literal['as2cs','cs2as'])->Self:
+	async def _create(cls, stream_key:str, stream_type:Literal['as2cs','cs2as'], **kwargs)->Self:
 		datatype: type[T] = AS2CSData if stream_type=="as2cs" else CS2ASData
 		assert (await get_redis().exists(stream_key))
-		return cls(stream_key, datatype)
+		return cls(stream_key, datatype, **kwargs)
 
 class WriteStream[T: (AS2CSData,CS2ASData) ](Stream):
+	def __init__(self,stream_key:str, datatype: type[T], codec:StreamCodec|None=None, *, fence:tuple[str,int]|None=None):
+		"""
+		Args:
+			stream_key:
+			datatype:
+			codec:
+			fence: (fence key, fencing token) of the StreamLease held by the writer. If provided, every XADD is
+				rejected with FencingTokenError once the lease has been taken over by another writer.
+		"""
+		super().__init__(stream_key, datatype, codec)
+		self.fence = fence
 
+	@instrumented("stream_write")
+	@reload_functions_on_missing
 	async def write(self, data: T, maxlen:int|None=None, approximate:bool=True, limit:int|None=None)->str:
 		""" Write to the stream and optionally trim stream after adding.
 		Args:
@@ -506,11 +1365,158 @@ class WriteStream[T: (AS2CSData,CS2ASData) ](Stream):
 			Trim feature should be used by chat service, not by assistant. Assistant instances just give only data.
 		"""
 		assert isinstance(data,self.datatype)
-		flag = await get_redis().xadd(self.key,await data.encode(),maxlen=maxlen, nomkstream=True,approximate=approximate, limit=limit)
+		try:
+			flag = await self._xadd(get_redis(), data, maxlen, approximate, limit)
+		except ResponseError as e:
+			self._raise_fencing_error(e)
+		return self._check_added(flag)
+
+	async def _xadd(self, redis_or_pipeline: Redis|Pipeline, data: T, maxlen:int|None, approximate:bool, limit:int|None):
+		if self.fence is None:
+			return await redis_or_pipeline.xadd(self.key,self.codec.encode(data),maxlen=maxlen, nomkstream=True,approximate=approximate, limit=limit)
+		fence_key, token = self.fence
+		fields = [x for item in self.codec.encode(data).items() for x in item]
+		return await redis_or_pipeline.fcall(function_name('fenced_xadd'), 2, fence_key, self.key, token,
+		                                     '' if maxlen is None else maxlen, int(approximate), '' if limit is None else limit, *fields)
+
+	@staticmethod
+	def _raise_fencing_error(e:ResponseError):
+		if "STALEFENCE" in str(e):
+			raise FencingTokenError(str(e)) from e
+		raise e
+
+	@staticmethod
+	def _check_added(flag:str|None)->str:
 		if flag is None:
 			raise KeyError("Stream key doesn't exist. You should create stream using 'create' class method.")
 		return flag
 
+class BufferedWriteStream[T: (AS2CSData,CS2ASData) ](WriteStream):
+	"""Buffer written data and send them in one pipeline of XADDs, for LLM token streaming.
+	Consecutive AS2CSData 'stream_token' chunks of the same phase (same 'phase_id', 'phase_info' and 'state') are merged into one entry.
+	Buffer is flushed when 'flush_interval' passed since the first buffered data, when it reaches 'max_buffered' entries,
+	or immediately on AS2CSData with state 'done'.
+	Must be closed (or used as async context manager) to flush the remaining data.
+		Examples:
+			async with BufferedWriteStream(key, AS2CSData) as stream:
+				async for token in llm.astream(...):
+					await stream.write(AS2CSData(result=ResultForm(phase_id=phase_id, stream_token=TextUrlsFormat(text_fmt=token)), state='processing'))
+	"""
+	def __init__(self,stream_key:str, datatype: type[T], codec:StreamCodec|None=None, *, fence:tuple[str,int]|None=None,
+	             flush_interval:float=0.02, max_buffered:int=64, max_merged_chars:int=4096):
+		"""
+		Args:
+			stream_key:
+			datatype:
+			codec:
+			fence: see WriteStream.
+			flush_interval: seconds, time budget that data can wait in buffer.
+			max_buffered: maximum buffered entries (after merging) before flushing.
+			max_merged_chars: chunks are not merged into an entry which text reaches this length.
+		"""
+		super().__init__(stream_key, datatype, codec, fence=fence)
+		self.flush_interval = flush_interval
+		self.max_buffered = max_buffered
+		self.max_merged_chars = max_merged_chars
+		self._init_buffer()
+
+	def _init_buffer(self):
+		self._buffer:list[tuple[T, tuple[int|None,bool,int|None]]] = []
+		self._flush_lock = asyncio.Lock()
+		self._flush_task:asyncio.Task|None = None
+		self._error:BaseException|None = None
+
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		for k in ("_buffer", "_flush_lock", "_flush_task", "_error"):
+			state.pop(k)
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._init_buffer()
+
+	async def write(self, data: T, maxlen:int|None=None, approximate:bool=True, limit:int|None=None)->None:
+		"""Buffer the data. Arguments are the same as WriteStream.write, trimming is applied when the entry is added.
+		Raises:
+			Error of the previous background flush, if any.
+		"""
+		assert isinstance(data,self.datatype)
+		self._raise_error()
+		trim = (maxlen, approximate, limit)
+		if not (self._buffer and self._buffer[-1][1]==trim and (merged := self._merge(self._buffer[-1][0], data)) is not None):
+			self._buffer.append((data, trim))
+		else:
+			self._buffer[-1] = (merged, trim)
+
+		if getattr(data, 'state', None) == 'done' or getattr(data, 'end', False) or len(self._buffer)>=self.max_buffered:
+			await self.flush()
+		elif self._flush_task is None:
+			self._flush_task = asyncio.create_task(self._flush_later())
+
+	def _merge(self, last: T, data: T) -> T|None:
+		"""Merge 'data' into 'last' if both are stream token chunks of the same phase, return None if they cannot be merged."""
+		if not isinstance(data, AS2CSData) or data.request is not None or last.request is not None \
+				or data.result is None or last.result is None or data.state != last.state or data.end or last.end:
+			return None
+		lr, dr = last.result, data.result
+		if lr.phase_id != dr.phase_id or lr.phase_info != dr.phase_info \
+				or len(lr.stream_token.text_fmt) >= self.max_merged_chars:
+			return None
+		token = TextUrlsFormat(text_fmt=lr.stream_token.text_fmt+dr.stream_token.text_fmt,
+		                       fmt_data=lr.stream_token.fmt_data | dr.stream_token.fmt_data)
+		return last.model_copy(update={"result": lr.model_copy(update={"stream_token": token})})
+
+	async def _flush_later(self):
+		await asyncio.sleep(self.flush_interval)
+		self._flush_task = None # flush must not cancel this task itself.
+		try:
+			await self.flush()
+		except Exception as e:
+			logger.error(f"Background flush of stream '{self.key}' fail: {e!r}")
+			self._error = e
+
+	@instrumented("stream_flush")
+	async def flush(self)->list[str]:
+		"""Send all buffered data in one pipeline.
+		Returns:
+			Stream ids of added entries.
+		"""
+		if self._flush_task is not None:
+			self._flush_task.cancel()
+			self._flush_task = None
+		async with self._flush_lock:
+			buffer, self._buffer = self._buffer, []
+			if not buffer:
+				return []
+			return await self._send(buffer)
+
+	@reload_functions_on_missing
+	async def _send(self, buffer:list[tuple[T,tuple[int|None,bool,int|None]]])->list[str]:
+		async with get_redis().pipeline(transaction=False) as pipeline:
+			for data, (maxlen, approximate, limit) in buffer:
+				await self._xadd(pipeline, data, maxlen, approximate, limit)
+			try:
+				flags = await pipeline.execute()
+			except ResponseError as e:
+				self._raise_fencing_error(e)
+		return [self._check_added(flag) for flag in flags]
+
+	def _raise_error(self):
+		if self._error is not None:
+			error, self._error = self._error, None
+			raise error
+
+	async def aclose(self):
+		await self.flush()
+		self._raise_error()
+
+	async def __aenter__(self)->Self:
+		return self
+
+	async def __aexit__(self, exc_type, exc_val, exc_tb):
+		await self.aclose()
+
 class ReadStream[T: (AS2CSData,CS2ASData) ](Stream):
 	"""Stateless object stream, it stores state to know what to retrieve next.
 	Default for async for is block and wait for the newest data coming.
@@ -523,8 +1529,8 @@ class ReadStream[T: (AS2CSData,CS2ASData) ](Stream):
 				if data.state=="done":
 
 	"""
-	def __init__(self,stream_key:str, datatype: type[T]):
-		super().__init__(stream_key, datatype)
+	def __init__(self,stream_key:str, datatype: type[T], codec:StreamCodec|None=None):
+		super().__init__(stream_key, datatype, codec)
 
 		self._checkpoint_id:str = "$"
 		self._count:int = 1
@@ -538,13 +1544,16 @@ class ReadStream[T: (AS2CSData,CS2ASData) ](Stream):
 			save_checkpoint:
 		Returns:
 			New object of ReadStream.
+		Raises:
+			TypeError: position of the stream is not held by the object (resumable, multiplexed and broadcast streams).
 		"""
-		new_obj= self.__class__(self.key,self.datatype)
+		new_obj= self.__class__(self.key,self.datatype,self.codec)
 		new_obj._checkpoint_id = checkpoint or self._checkpoint_id
 		new_obj._count = count or self._count
 		new_obj._save_checkpoint = save_checkpoint or self._save_checkpoint
 		return new_obj
 
+	@instrumented("stream_read")
 	async def read(self,checkpoint:str|None=None,count:int|None=None,*,block:int|None=None )-> list[T]:
 		"""
 		Args:
@@ -556,6 +1565,10 @@ class ReadStream[T: (AS2CSData,CS2ASData) ](Stream):
 		Notes:
 			read method does not check if the stream key exists. So either does not exist or exist with blank data will return [].
 		"""
+		return [d for _, d in await self.read_entries(checkpoint, count, block=block)]
+
+	async def read_entries(self,checkpoint:str|None=None,count:int|None=None,*,block:int|None=None )-> list[tuple[str,T]]:
+		"""Same as 'read' but each data is returned along with its stream id."""
 		"""Raw data from redis stream has the form like this:
 			[['test_stream', [('1747389494281-0', {'user_input': '', 'addition_info': 'null', 'data': '{"id":"068270c0-14f2-700c-8000-22a71d11823c","created_at":"2025-05-16T09:57:21.309097Z","dump":"edaede"}'}), ('1747389494418-0', {'user_input': '', 'addition_info': 'null', 'data': '{"id":"068270c0-14f2-700c-8000-22a71d11823c","created_at":"2025-05-16T09:57:21.309097Z","dump":"edaede"}'})]]]' 
 			So data extract be like: data[0][1][:][1], with : is data.
@@ -564,31 +1577,726 @@ class ReadStream[T: (AS2CSData,CS2ASData) ](Stream):
 		count = count or self._count
 		data= await get_redis().xread({self.key:checkpoint},count,block)
 		if data:
-			decoded_data = []
-			for d in data[0][1]:
-				decoded_data.append(await self.datatype.decode(d[1]))
+			entries = self._decode_entries(data[0][1])
 			if self._save_checkpoint:
 				self._checkpoint_id = data[0][1][-1][0]
-			return decoded_data
+			return entries
 		else:
 			return data # []
+
+	def _decode_entries(self, raw_entries: list[tuple[str, dict|None]]) -> list[tuple[str,T]]:
+		return [(sid, self.codec.decode(self.datatype, fields)) for sid, fields in raw_entries if fields]
+
 	def __aiter__(self)->Self:
 		return self
 
 	async def __anext__(self)->list[T]:
 		return await self.read(block=0) # block forever.
 
-AnyStream = ReadStream[AS2CSData]|ReadStream[CS2ASData] |WriteStream[AS2CSData] |WriteStream[CS2ASData]
+class GroupReadStream[T: (AS2CSData,CS2ASData) ](ReadStream):
+	"""Consumer group reader with at-least-once delivery, several consumers of the same group share the stream entries.
+	Delivered entries stay pending until they are acknowledged, by 'ack' or by the next read (acknowledge the previous batch
+	and read are sent in one round trip). Pending entries of dead consumers are reclaimed after 'min_idle_ms'.
+	On start, consumer replays its own pending entries first, so a reconnect with the same consumer name resumes where it stopped.
+		Examples:
+			async for data in group_read_stream: # previous batch is acknowledged when the next one is requested.
+				...
+	"""
+	def __init__(self,stream_key:str, datatype: type[T], group:str, consumer:str, *,
+	             group_start_id:str="0", min_idle_ms:int=30_000, ack_on_next:bool=True, codec:StreamCodec|None=None):
+		"""
+		Args:
+			stream_key:
+			datatype:
+			group: consumer group name, created if not exist.
+			consumer: consumer name, must be unique in the group.
+			group_start_id: first entry id the group delivers if the group is created by this consumer.
+			min_idle_ms: pending entries of other consumers idle longer than this are claimed by this consumer.
+			ack_on_next: acknowledge the previous delivered batch when reading next one.
+			codec:
+		"""
+		super().__init__(stream_key, datatype, codec)
+		self.group = group
+		self.consumer = consumer
+		self.group_start_id = group_start_id
+		self.min_idle_ms = min_idle_ms
+		self.ack_on_next = ack_on_next
+
+		self._checkpoint_id = "0" # Own pending entries first, then '>' for never delivered ones.
+		self._group_created:bool = False
+		self._last_claim:float = 0
+		self._last_read_id:str|None = None
+		self._unacked:list[str] = []
+
+	def bind(self,checkpoint:str|None=None,count:int|None=None, save_checkpoint:bool|None=None)->Self:
+		new_obj= self.__class__(self.key,self.datatype,self.group,self.consumer,group_start_id=self.group_start_id,
+		                        min_idle_ms=self.min_idle_ms, ack_on_next=self.ack_on_next, codec=self.codec)
+		new_obj._checkpoint_id = checkpoint or self._checkpoint_id
+		new_obj._count = count or self._count
+		new_obj._group_created = self._group_created
+		return new_obj
+
+	async def create_group(self) -> bool:
+		"""Create the consumer group if it does not exist. Returns True if a new group is created."""
+		try:
+			await get_redis().xgroup_create(self.key, self.group, id=self.group_start_id)
+			created = True
+		except ResponseError as e:
+			if "BUSYGROUP" not in str(e):
+				raise
+			created = False
+		self._group_created = True
+		return created
+
+	async def read_entries(self,checkpoint:str|None=None,count:int|None=None,*,block:int|None=None )-> list[tuple[str,T]]:
+		"""Read entries for this consumer, in order: own pending entries, claimed idle entries of other consumers, new entries.
+		Args:
+			checkpoint: '0' to replay own pending entries or '>' for new ones. Default is the current state.
+			count:
+			block: only used when reading new entries.
+		"""
+		if not self._group_created:
+			await self.create_group()
+		count = count or self._count
+		checkpoint = checkpoint or self._checkpoint_id
+
+		while checkpoint != ">":
+			entries = await self._read_group(checkpoint, count, None)
+			if self._last_read_id is None:
+				checkpoint = self._checkpoint_id = ">" # Own pending entries are all replayed.
+			else:
+				checkpoint = self._checkpoint_id = self._last_read_id
+				if entries:
+					return entries
+
+		if time.monotonic()-self._last_claim > self.min_idle_ms/1000:
+			if entries := await self.claim(count=count):
+				return entries
+		return await self._read_group(">", count, block)
+
+	async def _read_group(self, checkpoint:str, count:int, block:int|None) -> list[tuple[str,T]]:
+		async with get_redis().pipeline(transaction=False) as pipeline:
+			await self._ack_previous(pipeline)
+			await pipeline.xreadgroup(self.group, self.consumer, {self.key: checkpoint}, count, block)
+			data = (await pipeline.execute())[-1]
+		if not data or not (raw_entries := data[0][1]):
+			self._last_read_id = None
+			return []
+		self._last_read_id = raw_entries[-1][0]
+		deleted = [sid for sid, fields in raw_entries if not fields] # Trimmed while pending.
+		if deleted:
+			await get_redis().xack(self.key, self.group, *deleted)
+		entries = self._decode_entries(raw_entries)
+		self._unacked.extend(sid for sid, _ in entries)
+		return entries
+
+	async def _ack_previous(self, pipeline:Pipeline):
+		"""Queue acknowledgement of the previous delivered batch, so that it is sent along with the next read."""
+		if self.ack_on_next and self._unacked:
+			await pipeline.xack(self.key, self.group, *self._unacked)
+			self._unacked = []
+
+	async def claim(self, min_idle_ms:int|None=None, count:int|None=None) -> list[tuple[str,T]]:
+		"""Claim pending entries of other consumers that are idle longer than 'min_idle_ms'. Claimed entries are delivered to this consumer."""
+		self._last_claim = time.monotonic()
+		async with get_redis().pipeline(transaction=False) as pipeline:
+			await self._ack_previous(pipeline)
+			await pipeline.xautoclaim(self.key, self.group, self.consumer, min_idle_ms or self.min_idle_ms, count=count or self._count)
+			_, raw_entries, *deleted = (await pipeline.execute())[-1]
+		if deleted and deleted[0]: # Redis >= 7 returns ids of the entries that no longer exist.
+			await get_redis().xack(self.key, self.group, *deleted[0])
+		raw_entries = [(sid, fields) for sid, fields in raw_entries if sid is not None]
+		entries = self._decode_entries(raw_entries)
+		if entries:
+			logger.debug(f"Consumer '{self.consumer}' claimed {len(entries)} idle entries of stream '{self.key}'.")
+		self._unacked.extend(sid for sid, _ in entries)
+		return entries
+
+	async def ack(self, ids:list[str]|None=None) -> int:
+		"""Acknowledge entries, default is all delivered entries which are not acknowledged yet.
+		Returns:
+			Number of entries were acknowledged.
+		"""
+		if ids is None:
+			ids, self._unacked = self._unacked, []
+		else:
+			self._unacked = [sid for sid in self._unacked if sid not in ids]
+		if not ids:
+			return 0
+		return await get_redis().xack(self.key, self.group, *ids)
+
+class ResumableReadStream[T: (AS2CSData,CS2ASData) ](ReadStream):
+	"""Read stream of one client whose position is persisted in the chat session checkpoints hash
+	(see ChatSessionData 'stream_checkpoints_rkey'), so a client reconnecting with the same id continues after the last
+	delivered entry instead of '$' and the answer does not need to be generated again.
+	A batch counts as delivered when the next one is requested (or 'commit' is called), its checkpoint is saved along with
+	the next read in one round trip. So delivery is at-least-once, a client may get the last batch again after reconnect.
+	On resume at most 'max_backlog' missed entries are replayed, older ones are skipped and 'truncated' is set, the client
+	should then reload the stored messages instead of relying on the stream.
+		Examples:
+			stream = await ResumableReadStream(key, AS2CSData, client_id, (cs.rkey, cs.registry_rkey, cs.stream_checkpoints_rkey),
+			                                   'as2cs').resume()
+			async for data in stream:
+				...
+	"""
+	def __init__(self,stream_key:str, datatype: type[T], client_id:str, checkpoint_keys:tuple[str,str,str],
+	             stream_type:Literal['as2cs','cs2as'], *, max_backlog:int|None=None, codec:StreamCodec|None=None):
+		"""
+		Args:
+			stream_key:
+			datatype:
+			client_id: id of the client (e.g. browser tab), unique per reader of the stream.
+			checkpoint_keys: main rkey, its registry and the checkpoints hash, the hash shares the main rkey lifetime.
+			stream_type: checkpoints of both streams of a session are kept in the same hash.
+			max_backlog: default is 'stream_resume_max_backlog'.
+			codec:
+		"""
+		super().__init__(stream_key, datatype, codec)
+		self.client_id = client_id
+		self.checkpoint_keys = checkpoint_keys
+		self.field = f"{client_id}:{stream_type}"
+		self.max_backlog = max_backlog or CONFIG.stream_resume_max_backlog
+		self.truncated:bool = False
+		self._backlog:list[tuple[str,T]] = []
+		self._delivered_id:str|None = None
+
+	@classmethod
+	async def _create(cls, stream_key:str, stream_type:Literal['as2cs','cs2as'], **kwargs)->Self:
+		datatype: type[T] = AS2CSData if stream_type=="as2cs" else CS2ASData
+		return await cls(stream_key, datatype, stream_type=stream_type, **kwargs).resume()
+
+	def bind(self,checkpoint:str|None=None,count:int|None=None, save_checkpoint:bool|None=None)->Self:
+		raise TypeError("Resumable stream position is persisted per client, create a new one instead.")
+
+	async def resume(self)->Self:
+		"""Continue after the saved checkpoint of this client, after the current last entry if there is none.
+		Missed entries (at most 'max_backlog' latest ones) are returned first by the next reads."""
+		await ChatboneData.load_functions(skip_if_loaded=True)
+		async with get_redis().pipeline(transaction=False) as pipeline:
+			await pipeline.hget(self.checkpoint_keys[2], self.field)
+			await pipeline.xrevrange(self.key, count=1)
+			saved, last = await pipeline.execute()
+		if saved is None:
+			# Pin '$' now, entries written before the first read are not missed.
+			self._checkpoint_id = last[0][0] if last else "0-0"
+			return self
+		raw_entries = await get_redis().xrevrange(self.key, "+", f"({saved}", count=self.max_backlog+1)
+		self.truncated = len(raw_entries) > self.max_backlog
+		raw_entries = raw_entries[:self.max_backlog][::-1]
+		if self.truncated:
+			logger.warning(f"Client '{self.client_id}' missed more than {self.max_backlog} entries of stream '{self.key}', "
+			               f"older ones are skipped.")
+		self._backlog = self._decode_entries(raw_entries)
+		self._checkpoint_id = raw_entries[-1][0] if raw_entries else saved
+		return self
+
+	@reload_functions_on_missing
+	async def read_entries(self,checkpoint:str|None=None,count:int|None=None,*,block:int|None=None )-> list[tuple[str,T]]:
+		"""Replayed backlog first, then new entries. Checkpoint of the previous batch is saved in the same round trip.
+		Args:
+			checkpoint: not supported, position is the saved checkpoint.
+			count:
+			block:
+		"""
+		count = count or self._count
+		if self._backlog:
+			entries, self._backlog = self._backlog[:count], self._backlog[count:]
+			self._delivered_id = entries[-1][0] # Saved along with the next read of new entries.
+			return entries
+		async with get_redis().pipeline(transaction=False) as pipeline:
+			await self._save_delivered(pipeline)
+			await pipeline.xread({self.key:self._checkpoint_id}, count, block)
+			data = (await pipeline.execute())[-1]
+		if not data or not (raw_entries := data[0][1]):
+			return []
+		self._checkpoint_id = self._delivered_id = raw_entries[-1][0]
+		return self._decode_entries(raw_entries)
+
+	async def _save_delivered(self, pipeline:Pipeline|Redis):
+		if self._delivered_id is not None:
+			await pipeline.fcall(function_name('stream_checkpoint_save'), 3, *self.checkpoint_keys, self.field, self._delivered_id)
+			self._delivered_id = None
+
+	@reload_functions_on_missing
+	async def commit(self):
+		"""Save the checkpoint of the last delivered batch now, e.g. when the client disconnects."""
+		await self._save_delivered(get_redis())
+
+class MultiplexedReadStream[T: (AS2CSData,CS2ASData) ](ReadStream):
+	"""Read stream served by a StreamMultiplexer instead of its own XREAD, so it does not pin a Redis connection while waiting.
+	Stream position is managed by the multiplexer, entries are delivered in order through a bounded in-process queue
+	(see StreamMultiplexer 'queue_size'), a slow reader leaves the rest of its entries in Redis.
+	Must be closed (or get through 'get_streams') to be removed from the multiplexer.
+	"""
+	def __init__(self,stream_key:str, datatype: type[T], multiplexer:"StreamMultiplexer"):
+		super().__init__(stream_key, datatype)
+		self._multiplexer = multiplexer
+		self._queue:asyncio.Queue[list[tuple[str,dict]]] = asyncio.Queue(multiplexer.queue_size)
+		self._buffer:list[tuple[str,dict]] = []
+		self._last_id:str = "0-0"
+
+	@classmethod
+	async def _create(cls, stream_key:str, stream_type:Literal['as2cs','cs2as'], multiplexer:"StreamMultiplexer|None"=None,
+	                  checkpoint:str="$")->Self:
+		datatype: type[T] = AS2CSData if stream_type=="as2cs" else CS2ASData
+		return await (multiplexer or STREAM_MULTIPLEXER).subscribe(stream_key, datatype, checkpoint)
+
+	def bind(self,checkpoint:str|None=None,count:int|None=None, save_checkpoint:bool|None=None)->Self:
+		raise TypeError("Multiplexed stream is bound to its multiplexer, subscribe a new one instead.")
+
+	async def read_entries(self,checkpoint:str|None=None,count:int|None=None,*,block:int|None=None )-> list[tuple[str,T]]:
+		"""
+		Args:
+			checkpoint: not supported, position is managed by the multiplexer.
+			count:
+			block: milliseconds to wait for entries, 0 means forever, None means not block.
+		"""
+		if checkpoint is not None:
+			raise ValueError("Multiplexed stream position is managed by the multiplexer, checkpoint is not supported.")
+		count = count or self._count
+		was_full = self._queue.full()
+		if not self._buffer:
+			try:
+				if block is None:
+					batch = self._queue.get_nowait()
+				elif block == 0:
+					batch = await self._queue.get()
+				else:
+					batch = await asyncio.wait_for(self._queue.get(), block/1000)
+			except (asyncio.QueueEmpty, asyncio.TimeoutError):
+				return []
+			self._buffer.extend(batch)
+		while len(self._buffer)<count and not self._queue.empty():
+			self._buffer.extend(self._queue.get_nowait())
+		if was_full:
+			await self._multiplexer._resume(self)
+		raw_entries, self._buffer = self._buffer[:count], self._buffer[count:]
+		return self._decode_entries(raw_entries)
+
+	async def close(self):
+		await self._multiplexer.unsubscribe(self)
+
+class _MultiplexerShard:
+	"""One XREAD loop over at most 'max_keys' streams. Subscription changes wake the blocked XREAD
+	through a private wake stream, which is read along with the others."""
+	def __init__(self, multiplexer:"StreamMultiplexer"):
+		self.multiplexer = multiplexer
+		self.streams:dict[str, MultiplexedReadStream] = {}
+		self.wake_key = f"{StreamMultiplexer.rkey_prefix}:<wake>:{uuid4()}"
+		self._wake_id = "0-0"
+		self._task = asyncio.create_task(self._run())
+
+	async def wake(self):
+		async with get_redis().pipeline(transaction=False) as pipeline:
+			await pipeline.xadd(self.wake_key, {"wake": 1}, maxlen=1, approximate=False)
+			await pipeline.pexpire(self.wake_key, max(self.multiplexer.block_ms*10, 60_000))
+			await pipeline.execute()
+
+	async def _run(self):
+		redis = get_redis()
+		while True:
+			# Streams with a full queue are left out until their reader catches up, see 'StreamMultiplexer._resume'.
+			streams = {key: stream._last_id for key, stream in self.streams.items() if not stream._queue.full()}
+			streams[self.wake_key] = self._wake_id
+			try:
+				data = await redis.xread(streams, self.multiplexer.count, self.multiplexer.block_ms)
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				logger.error(f"Stream multiplexer read error, retry in 1 second. {e!r}")
+				await asyncio.sleep(1)
+				continue
+			for key, raw_entries in data:
+				if key == self.wake_key:
+					self._wake_id = raw_entries[-1][0]
+				elif (stream := self.streams.get(key)) is not None:
+					stream._last_id = raw_entries[-1][0]
+					stream._queue.put_nowait(raw_entries)
+
+	async def close(self):
+		self._task.cancel()
+		try:
+			await self._task
+		except asyncio.CancelledError:
+			pass
+		await get_redis().delete(self.wake_key)
+
+class StreamMultiplexer:
+	"""Serve many read streams of this process with one blocking XREAD per 'max_keys' stream keys,
+	instead of one blocking connection per stream. Entries are dispatched to the per stream queues,
+	stream keys are added or removed as read streams are subscribed or closed, a shard is closed with its last stream.
+	Use the process-wide 'STREAM_MULTIPLEXER'. A stream key can only be subscribed once at a time, see 'StreamBroadcaster' for fan-out.
+		Examples:
+			stream = await STREAM_MULTIPLEXER.subscribe(cs.as2cs_stream_rkey, AS2CSData)
+			try:
+				async for data in stream:
+					...
+			finally:
+				await stream.close()
+	"""
+	rkey_prefix = f"{__name__}:StreamMultiplexer"
+
+	def __init__(self, max_keys:int=1000, count:int=100, block_ms:int=5000, queue_size:int=10):
+		"""
+		Args:
+			max_keys: maximum stream keys served by one XREAD.
+			count: maximum entries read per stream key in one XREAD.
+			block_ms: block time of XREAD, subscription changes wake it up anyway.
+			queue_size: XREAD batches buffered per read stream, a stream with a full queue is not read until its reader
+				catches up.
+		"""
+		self.max_keys = max_keys
+		self.count = count
+		self.block_ms = block_ms
+		self.queue_size = queue_size
+		self._shards:list[_MultiplexerShard] = []
+		self._key2shard:dict[str,_MultiplexerShard] = {}
+
+	async def subscribe[T: (AS2CSData,CS2ASData)](self, stream_key:str, datatype:type[T], checkpoint:str="$") -> MultiplexedReadStream[T]:
+		"""
+		Args:
+			stream_key:
+			datatype:
+			checkpoint: deliver entries after this id, '$' means entries added after subscribing.
+		Returns:
+			MultiplexedReadStream of the stream key.
+		"""
+		if stream_key in self._key2shard:
+			raise ValueError(f"Stream '{stream_key}' was already subscribed.")
+		stream = MultiplexedReadStream(stream_key, datatype, self)
+		if checkpoint == "$":
+			# Resolve now, '$' at the time the shard reads would miss entries added in between.
+			last = await get_redis().xrevrange(stream_key, count=1)
+			checkpoint = last[0][0] if last else "0-0"
+		stream._last_id = checkpoint
+
+		shard = next((shard for shard in self._shards if len(shard.streams)<self.max_keys), None)
+		if shard is None:
+			shard = _MultiplexerShard(self)
+			self._shards.append(shard)
+		shard.streams[stream_key] = stream
+		self._key2shard[stream_key] = shard
+		await shard.wake()
+		return stream
+
+	async def unsubscribe(self, stream:MultiplexedReadStream):
+		if (shard := self._key2shard.get(stream.key)) is None or shard.streams.get(stream.key) is not stream:
+			return
+		del shard.streams[stream.key]
+		del self._key2shard[stream.key]
+		if shard.streams:
+			await shard.wake()
+		else: # Removed before closing, so that subscribers don't pick it meanwhile.
+			self._shards.remove(shard)
+			await shard.close()
+
+	async def _resume(self, stream:MultiplexedReadStream):
+		"""Wake the shard of a stream whose full queue was read, so that it reads the stream again."""
+		if (shard := self._key2shard.get(stream.key)) is not None and shard.streams.get(stream.key) is stream:
+			await shard.wake()
+
+	@property
+	def num_streams(self) -> int:
+		return len(self._key2shard)
+
+	async def close(self):
+		await asyncio.gather(*[shard.close() for shard in self._shards])
+		self._shards.clear()
+		self._key2shard.clear()
+
+STREAM_MULTIPLEXER = StreamMultiplexer()
+
+SlowConsumerPolicy = Literal['drop_oldest','drop_newest','disconnect']
+
+class BroadcastReadStream[T: (AS2CSData,CS2ASData) ](ReadStream):
+	"""Local subscriber of a StreamBroadcaster, entries are decoded once by the broadcaster and delivered through a bounded queue.
+	When the queue is full, 'policy' decides: 'drop_oldest' or 'drop_newest' entry ('dropped' counts them), or 'disconnect'
+	the subscriber, its next read raises SlowConsumerError and the client should resume with a ResumableReadStream.
+	Must be closed (or get through 'get_streams') to be removed from the broadcaster.
+	"""
+	def __init__(self,stream_key:str, datatype: type[T], broadcaster:"StreamBroadcaster", *,
+	             maxsize:int|None=None, policy:SlowConsumerPolicy|None=None):
+		super().__init__(stream_key, datatype)
+		self._broadcaster = broadcaster
+		self.policy:SlowConsumerPolicy = policy or CONFIG.stream_broadcast_slow_consumer_policy
+		self.dropped:int = 0
+		self._queue:asyncio.Queue[tuple[str,T]|None] = asyncio.Queue(maxsize or CONFIG.stream_broadcast_queue_size)
+		self._error:Exception|None = None
+
+	@classmethod
+	async def _create(cls, stream_key:str, stream_type:Literal['as2cs','cs2as'], broadcaster:"StreamBroadcaster|None"=None,
+	                  **kwargs)->Self:
+		datatype: type[T] = AS2CSData if stream_type=="as2cs" else CS2ASData
+		return await (broadcaster or STREAM_BROADCASTER).subscribe(stream_key, datatype, **kwargs)
+
+	def bind(self,checkpoint:str|None=None,count:int|None=None, save_checkpoint:bool|None=None)->Self:
+		raise TypeError("Broadcast stream is bound to its broadcaster, subscribe a new one instead.")
+
+	def _deliver(self, entries:list[tuple[str,T]]):
+		for entry in entries:
+			if self._error is not None:
+				return
+			if self._queue.full():
+				if self.policy == 'drop_newest':
+					self.dropped += 1
+					continue
+				if self.policy == 'drop_oldest':
+					self._queue.get_nowait()
+					self.dropped += 1
+				else:
+					self._fail(SlowConsumerError(f"Subscriber of stream '{self.key}' is too slow, "
+					                             f"{self._queue.maxsize} entries are not read."))
+					self._broadcaster._detach(self)
+					return
+			self._queue.put_nowait(entry)
+
+	def _fail(self, error:Exception):
+		"""Stop delivering, the next read raises 'error'."""
+		self._error = error
+		while not self._queue.empty():
+			self._queue.get_nowait()
+		self._queue.put_nowait(None)
+
+	async def read_entries(self,checkpoint:str|None=None,count:int|None=None,*,block:int|None=None )-> list[tuple[str,T]]:
+		"""
+		Args:
+			checkpoint: not supported, entries are delivered from the time of subscribing.
+			count:
+			block: milliseconds to wait for entries, 0 means forever, None means not block.
+		Raises:
+			SlowConsumerError: disconnected by the 'disconnect' policy.
+		"""
+		if checkpoint is not None:
+			raise ValueError("Broadcast stream position is managed by the broadcaster, checkpoint is not supported.")
+		if self._error is not None:
+			raise self._error
+		count = count or self._count
+		entries = []
+		try:
+			if block is None:
+				entries.append(self._queue.get_nowait())
+			elif block == 0:
+				entries.append(await self._queue.get())
+			else:
+				entries.append(await asyncio.wait_for(self._queue.get(), block/1000))
+		except (asyncio.QueueEmpty, asyncio.TimeoutError):
+			return []
+		while len(entries)<count and not self._queue.empty():
+			entries.append(self._queue.get_nowait())
+		if entries[-1] is None:
+			raise self._error
+		return entries
+
+	async def close(self):
+		await self._broadcaster.unsubscribe(self)
+
+class _BroadcastChannel:
+	"""One multiplexed reader of a stream key, its entries are fanned out to all local subscribers.
+	If reading fails, every subscriber gets the error on its next read and the channel is removed from the broadcaster,
+	so the next subscriber of the key starts a new reader."""
+	def __init__(self, source:MultiplexedReadStream, count:int, broadcaster:"StreamBroadcaster"):
+		self.source = source
+		self.count = count
+		self.broadcaster = broadcaster
+		self.subscribers:set[BroadcastReadStream] = set()
+		self._task = asyncio.create_task(self._run())
+
+	async def _run(self):
+		try:
+			while True:
+				entries = await self.source.read_entries(count=self.count, block=0)
+				for subscriber in list(self.subscribers):
+					subscriber._deliver(entries)
+		except Exception as e:
+			logger.error(f"Broadcast reader of stream '{self.source.key}' fail, disconnect {len(self.subscribers)} subscribers. {e!r}")
+			for subscriber in self.subscribers:
+				subscriber._fail(e)
+			self.subscribers.clear()
+			self.broadcaster._remove(self)
+			await self.source.close()
+
+	async def close(self):
+		self._task.cancel()
+		try:
+			await self._task
+		except asyncio.CancelledError:
+			pass
+		await self.source.close()
+
+class StreamBroadcaster:
+	"""Fan out a stream key to any number of subscribers in this process with a single reader per key (served by the
+	StreamMultiplexer), so Redis read load does not grow with the number of viewers of a session.
+	Subscribers get entries added after they subscribe, to replay missed entries use ResumableReadStream.
+	The reader of a key is closed with its last subscriber.
+	Use the process-wide 'STREAM_BROADCASTER'.
+		Examples:
+			stream = await STREAM_BROADCASTER.subscribe(cs.as2cs_stream_rkey, AS2CSData)
+			try:
+				async for data in stream:
+					...
+			finally:
+				await stream.close()
+	"""
+	def __init__(self, multiplexer:StreamMultiplexer|None=None):
+		self.multiplexer = multiplexer or STREAM_MULTIPLEXER
+		self._channels:dict[str,_BroadcastChannel] = {}
+		self._lock = asyncio.Lock()
+
+	async def subscribe[T: (AS2CSData,CS2ASData)](self, stream_key:str, datatype:type[T], *, maxsize:int|None=None,
+	                                               policy:SlowConsumerPolicy|None=None) -> BroadcastReadStream[T]:
+		"""
+		Args:
+			stream_key:
+			datatype:
+			maxsize: queue size of the subscriber, default is 'stream_broadcast_queue_size'.
+			policy: when the queue is full, default is 'stream_broadcast_slow_consumer_policy'.
+		Returns:
+			BroadcastReadStream of the stream key.
+		"""
+		stream = BroadcastReadStream(stream_key, datatype, self, maxsize=maxsize, policy=policy)
+		async with self._lock:
+			if (channel := self._channels.get(stream_key)) is None:
+				source = await self.multiplexer.subscribe(stream_key, datatype)
+				channel = self._channels[stream_key] = _BroadcastChannel(source, self.multiplexer.count, self)
+			channel.subscribers.add(stream)
+		return stream
+
+	def _detach(self, stream:BroadcastReadStream):
+		if (channel := self._channels.get(stream.key)) is not None:
+			channel.subscribers.discard(stream)
+
+	def _remove(self, channel:_BroadcastChannel):
+		if self._channels.get(channel.source.key) is channel:
+			del self._channels[channel.source.key]
+
+	async def unsubscribe(self, stream:BroadcastReadStream):
+		async with self._lock:
+			self._detach(stream)
+			if (channel := self._channels.get(stream.key)) is not None and not channel.subscribers:
+				del self._channels[stream.key]
+				await channel.close()
+
+	@property
+	def num_subscribers(self) -> int:
+		return sum(len(channel.subscribers) for channel in self._channels.values())
+
+	async def close(self):
+		async with self._lock:
+			await asyncio.gather(*[channel.close() for channel in self._channels.values()])
+			self._channels.clear()
+
+STREAM_BROADCASTER = StreamBroadcaster()
+
+AnyStream = ReadStream[AS2CSData]|ReadStream[CS2ASData] |WriteStream[AS2CSData] |WriteStream[CS2ASData] \
+            |BufferedWriteStream[AS2CSData] |BufferedWriteStream[CS2ASData] |GroupReadStream[AS2CSData] |GroupReadStream[CS2ASData] \
+            |MultiplexedReadStream[AS2CSData] |MultiplexedReadStream[CS2ASData] |ResumableReadStream[AS2CSData] \
+            |ResumableReadStream[CS2ASData] |BroadcastReadStream[AS2CSData] |BroadcastReadStream[CS2ASData]
+
+class StreamLease:
+	"""Lease of the write role over several stream keys. All lock keys are acquired at once by one function call,
+	then renewed in background every third of the lease, so that a long generation keeps the lease while a crashed holder
+	releases it after 'lease_ms'.
+	Every acquisition increases the fencing token in 'fence_key'. Write streams carrying the token (see WriteStream 'fence')
+	are rejected once the lease is lost and taken by another writer.
+		Examples:
+			async with StreamLease(cs.rkey, cs.registry_rkey, cs.stream_fence_rkey, keys, blocking_timeout=10) as lease:
+				stream = WriteStream(key, AS2CSData, fence=(cs.stream_fence_rkey, lease.token))
+	"""
+	def __init__(self, root_rkey:str, registry_rkey:str, fence_key:str, keys:list[str], *,
+	             lease_ms:int|None=None, blocking_timeout:float|None=None, sleep:float=0.1):
+		"""
+		Args:
+			root_rkey: main rkey, the fence key is registered as its sub rkey and shares its lifetime.
+			registry_rkey:
+			fence_key:
+			keys: keys to be locked, lock keys are '{key}:{LOCK_POSTFIX}'.
+			lease_ms: default is 'redis_lock_timeout'.
+			blocking_timeout: seconds, None means wait forever.
+			sleep: seconds between acquire attempts.
+		"""
+		self.root_rkey = root_rkey
+		self.registry_rkey = registry_rkey
+		self.fence_key = fence_key
+		self.lock_keys = [f"{key}:{LOCK_POSTFIX}" for key in keys]
+		self.lease_ms = lease_ms or CONFIG.redis_lock_timeout*1000
+		self.blocking_timeout = blocking_timeout
+		self.sleep = sleep
+		self.owner = str(uuid4())
+		self.token:int|None = None
+		self.lost:bool = False
+		self._acquired_at:float = 0.0
+		self._renew_task:asyncio.Task|None = None
+
+	@reload_functions_on_missing
+	async def acquire(self)->int:
+		"""
+		Returns:
+			Fencing token.
+		Raises:
+			LockError: timeout.
+		"""
+		start = time.monotonic()
+		while (token := await get_redis().fcall(function_name('stream_lock_acquire'), 3+len(self.lock_keys),
+		                                         self.root_rkey, self.registry_rkey, self.fence_key, *self.lock_keys,
+		                                         self.owner, self.lease_ms)) is None:
+			if self.blocking_timeout is not None and time.monotonic()-start+self.sleep>self.blocking_timeout:
+				raise LockError(f"Unable to acquire lease of {self.lock_keys} in {self.blocking_timeout} seconds.")
+			await asyncio.sleep(self.sleep)
+		self.token, self.lost = int(token), False
+		self._acquired_at = time.monotonic()
+		BROKER_METRICS.observe_lock("stream_lease", wait=self._acquired_at-start)
+		self._renew_task = asyncio.create_task(self._renew())
+		return self.token
+
+	async def _renew(self):
+		while True:
+			await asyncio.sleep(self.lease_ms/3000)
+			try:
+				if not await self._renew_once():
+					self.lost = True
+					logger.error(f"Lease of {self.lock_keys} with fencing token {self.token} was lost.")
+					return
+			except Exception as e:
+				logger.error(f"Renew lease of {self.lock_keys} fail, retry later. {e!r}")
+
+	@reload_functions_on_missing
+	async def _renew_once(self)->bool:
+		return bool(await get_redis().fcall(function_name('stream_lock_renew'), len(self.lock_keys), *self.lock_keys,
+		                                    self.owner, self.lease_ms))
+
+	@reload_functions_on_missing
+	async def release(self):
+		if self._renew_task is not None:
+			self._renew_task.cancel()
+			self._renew_task = None
+		await get_redis().fcall(function_name('stream_lock_release'), len(self.lock_keys), *self.lock_keys, self.owner)
+		if self.token is not None:
+			BROKER_METRICS.observe_lock("stream_lease", hold=time.monotonic()-self._acquired_at)
+		self.token = None
+
+	async def __aenter__(self)->Self:
+		await self.acquire()
+		return self
+
+	async def __aexit__(self, exc_type, exc_val, exc_tb):
+		await self.release()
 
 class Message(BaseModel):
 	role: Literal['user', 'system', 'assistant']
 	content: str
+	fmt_data: dict[str,AnyUrl] = Field(default_factory=dict, description="Urls of the place holders in 'content', see TextUrlsFormat.")
 
 class ChatSessionData(ChatboneData):
 	"""
 	This class has two modes:
 		1. Init value to add to UserData.
 		2. After added to UserData and refresh, it will bind with user data, now it can interact with server data.
+	Messages are stored depending on 'session_messages_layout' config:
+		- 'document': in 'messages' field of the user JSON document.
+		- 'list': in the list key 'messages_rkey' of this session (capped at 'session_max_messages'), 'messages' field is only
+		  filled by 'load_messages'. This keeps the user document small however long sessions grow.
+	Use 'append_messages', 'get_messages' and 'load_messages' to work with both layouts. In 'list' layout, writing non-empty
+	'messages' into the document ('save', 'set', 'update', ...) raises ValueError.
 	"""
 	embedding = True
 
@@ -597,10 +2305,24 @@ class ChatSessionData(ChatboneData):
 	urls: list[AnyUrl] = Field(default_factory=list,
 	                           description="Addition data should be store in object storage and provide url.")
 
+	@staticmethod
+	def _check_document_messages(messages:list[Message]):
+		if messages and CONFIG.session_messages_layout == 'list':
+			raise ValueError("Messages are stored in their own list key ('session_messages_layout' is 'list'), "
+			                 "use 'append_messages' instead of writing them into the document.")
+
+	def _validate_field(self, field:str, value:Any):
+		super()._validate_field(field, value)
+		if field == 'messages':
+			self._check_document_messages(value)
+
 	@asynccontextmanager
 	async def get_streams(self,*, write_only:bool=False, read_only:bool=False,
 	                     write_streams_acquire_timeout:int|None=None,
-	                     raise_on_write_streams_acquire_fail:bool=True
+	                     raise_on_write_streams_acquire_fail:bool=True,
+	                     read_group:str|None=None, read_consumer:str|None=None,
+	                     read_multiplexed:bool=False, buffered_write:bool=False,
+	                     read_client_id:str|None=None, read_max_backlog:int|None=None, read_broadcast:bool=False,
 	                     )->AbstractAsyncContextManager[dict[Literal['as2cs','cs2as'],list[WriteStream|ReadStream|None] ]]:
 		"""
 		Args:
@@ -608,6 +2330,16 @@ class ChatSessionData(ChatboneData):
 			read_only:
 			write_streams_acquire_timeout:
 			raise_on_write_streams_acquire_fail
+			read_group: if provided, read streams are GroupReadStream of this consumer group.
+			read_consumer: consumer name of read streams in the group, default is unique per call (host, pid and a random
+				suffix). Pass a stable name to resume its own pending entries after a reconnect.
+			read_multiplexed: if True, read streams are served by the process-wide STREAM_MULTIPLEXER and closed on exit.
+			buffered_write: if True, write streams are BufferedWriteStream, flushed on exit before the locks are released.
+			read_client_id: if provided, read streams are ResumableReadStream of this client, resumed from its saved checkpoints
+				and committed on exit.
+			read_max_backlog: maximum entries replayed by resumable read streams, default is 'stream_resume_max_backlog'.
+			read_broadcast: if True, read streams are BroadcastReadStream of the process-wide STREAM_BROADCASTER, sharing one
+				reader with the other viewers of the session in this process, and closed on exit.
 		Returns:
 			dict of as2cs and cs2as streams with value is (write stream, read stream).
 		Raises:
@@ -618,35 +2350,64 @@ class ChatSessionData(ChatboneData):
 				assert isinstance(streams['as2cs'][0],WriteStream) and isinstance(streams['as2cs'][1],ReadStream)
 		"""
 		assert not ( write_only and read_only)
+		assert sum(map(bool, (read_group, read_multiplexed, read_client_id, read_broadcast))) <= 1
 		await self.init_stream_keys()
 		get_all = (not write_only and not read_only)
 		keys = [self.cs2as_stream_rkey, self.as2cs_stream_rkey]
 		locked:bool=False
 
 		ret_streams= dict(as2cs=[], cs2as=[])
-		async def _append_streams(stream_cls: WriteStream|ReadStream|None):
+		async def _append_streams(stream_cls: WriteStream|ReadStream|None, **kwargs):
 			streams = [None,None] if stream_cls is None \
-				else [await stream_cls._create(self.as2cs_stream_rkey,'as2cs'),await stream_cls._create(self.cs2as_stream_rkey,'cs2as')]
+				else [await stream_cls._create(self.as2cs_stream_rkey,'as2cs',**kwargs),await stream_cls._create(self.cs2as_stream_rkey,'cs2as',**kwargs)]
 			ret_streams['as2cs'].append(streams[0])
 			ret_streams['cs2as'].append(streams[1])
 
 		stream_cls = [None,None]
+		write_kwargs = {}
 		async with AsyncExitStack() as stack:
 			try:
 				if write_only or get_all:
 					acquire_timeout = write_streams_acquire_timeout or CONFIG.redis_acquire_lock_timeout
-					_ = [await stack.enter_async_context(self.redis.lock(f"{key}:{LOCK_POSTFIX}", blocking_timeout=acquire_timeout)) for key in keys]
+					lease = await stack.enter_async_context(StreamLease(self.rkey, self.registry_rkey, self.stream_fence_rkey, keys,
+					                                                    blocking_timeout=acquire_timeout))
 					locked=True
-					logger.debug(f"Write streams pair of chat session '{self.id}' were acquired.")
-					stream_cls[0] = WriteStream
-				await _append_streams(stream_cls[0])
-
+					logger.debug(f"Write streams pair of chat session '{self.id}' were acquired with fencing token {lease.token}.")
+					stream_cls[0] = BufferedWriteStream if buffered_write else WriteStream
+					write_kwargs = dict(fence=(self.stream_fence_rkey, lease.token))
+				await _append_streams(stream_cls[0], **write_kwargs)
+				if buffered_write and stream_cls[0] is not None:
+					for stream in (ret_streams['as2cs'][0], ret_streams['cs2as'][0]):
+						stack.push_async_callback(stream.aclose)
+
+				read_kwargs = {}
 				if read_only or get_all:
-					stream_cls[1] = ReadStream
-				await _append_streams(stream_cls[1])
+					if read_group is not None:
+						stream_cls[1] = GroupReadStream
+						read_kwargs = dict(group=read_group, consumer=read_consumer or f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}")
+					elif read_multiplexed:
+						stream_cls[1] = MultiplexedReadStream
+					elif read_broadcast:
+						stream_cls[1] = BroadcastReadStream
+					elif read_client_id is not None:
+						stream_cls[1] = ResumableReadStream
+						read_kwargs = dict(client_id=read_client_id, max_backlog=read_max_backlog,
+						                   checkpoint_keys=(self.rkey, self.registry_rkey, self.stream_checkpoints_rkey))
+					else:
+						stream_cls[1] = ReadStream
+				await _append_streams(stream_cls[1], **read_kwargs)
+				if (read_multiplexed or read_broadcast) and stream_cls[1] is not None:
+					for stream in (ret_streams['as2cs'][1], ret_streams['cs2as'][1]):
+						stack.push_async_callback(stream.close)
+				if read_client_id is not None and stream_cls[1] is not None:
+					for stream in (ret_streams['as2cs'][1], ret_streams['cs2as'][1]):
+						stack.push_async_callback(stream.commit)
 
 				yield ret_streams
 
+			except FencingTokenError as e:
+				logger.error(e)
+				raise
 			except LockError:
 				logger.debug(
 					f"Chat session '{self.id}' write stream acquired locks fail after trying for {acquire_timeout} seconds.")
@@ -659,6 +2420,8 @@ class ChatSessionData(ChatboneData):
 				if locked:
 					logger.debug(f"Write streams of chat session '{self.id}' were released.")
 
+	@instrumented("init_stream_keys")
+	@reload_functions_on_missing
 	async def init_stream_keys(self, raise_if_only_one_key_exists:bool=True, max_retry:int=3):
 		"""Create and expire a stream key if it does not exist.
 		Args:
@@ -676,6 +2439,8 @@ class ChatSessionData(ChatboneData):
 					e0,e1 = [await pipeline.exists(k) for k in keys]
 					pipeline.multi()
 					if e0 and e1:
+						# Register again (idempotent), in case a previous call created the keys but failed to register them.
+						await self.register_sub_rkeys(keys, pipeline)
 						logger.debug(f"Stream keys pair {keys} already created.")
 						return
 					elif not e0 and not e1:
@@ -699,7 +2464,7 @@ class ChatSessionData(ChatboneData):
 	async def _init_stream_keys(self,keys:list[str],pipeline:Pipeline):
 		assert pipeline.is_transaction or pipeline.explicit_transaction
 		[await pipeline.xadd(k, {"__init__stream_key": "__init__stream_key"}, maxlen=0) for k in keys]
-		await self.expire_sync(keys, pipeline)
+		await self.register_sub_rkeys(keys, pipeline)
 
 	@property
 	def cs2as_stream_rkey(self)->str:
@@ -709,6 +2474,167 @@ class ChatSessionData(ChatboneData):
 	def as2cs_stream_rkey(self)->str:
 		return f"{self.rkey_prefix}:{self.id}:<as2cs_stream>"
 
+	@property
+	def messages_rkey(self)->str:
+		"""List of JSON messages, used in 'list' layout, see class docstring."""
+		return f"{self.rkey_prefix}:{self.id}:<messages>"
+
+	@instrumented("append_messages")
+	@reload_functions_on_missing
+	async def append_messages(self, messages:list[Message], max_messages:int|None=None)->int:
+		"""Append messages and keep only the latest 'max_messages' ones in one atomic call, the messages key (in 'list' layout)
+		also gets the lifetime of the main rkey.
+		Args:
+			messages:
+			max_messages: 0 means no cap, default (None) is 'session_max_messages'.
+		Returns:
+			Number of messages remain.
+		Raises:
+			RedisKeyError: User data doesn't exist.
+		"""
+		if not messages: # RPUSH and JSON.ARRAPPEND need at least one value.
+			return await self.count_messages()
+		max_messages = (CONFIG.session_max_messages if max_messages is None else max_messages) or 0
+		values = [m.model_dump_json() for m in messages]
+		await self.load_functions(skip_if_loaded=True)
+		try:
+			if CONFIG.session_messages_layout == 'list':
+				return await self.redis.fcall(function_name('list_append_capped'), 3, self.rkey, self.registry_rkey, self.messages_rkey,
+				                              max_messages, *values)
+			async with self._get_transaction_pipeline(execute=False) as pipeline:
+				await pipeline.fcall(function_name('json_append_capped'), 2, self.rkey, self.registry_rkey,
+				                     f"{self._jsonpath}.messages", max_messages, *values)
+				await self._publish_changed(pipeline)
+				n, _ = await pipeline.execute()
+			return n
+		except ResponseError as e:
+			if "NOKEY main rkey" in str(e):
+				raise RedisKeyError("User data doesn't exist. Call 'save' first.") from e
+			raise
+
+	async def count_messages(self)->int:
+		"""
+		Raises:
+			RedisKeyError: User data doesn't exist ('document' layout only).
+		"""
+		if CONFIG.session_messages_layout == 'list':
+			return await self.redis.llen(self.messages_rkey)
+		if (n := await self.redis.json().arrlen(self.rkey, f"{self._jsonpath}.messages")) is None:
+			raise RedisKeyError("User data doesn't exist. Call 'save' first.")
+		return n
+
+	@instrumented("get_messages")
+	async def get_messages(self, start:int=0, stop:int=-1)->list[Message]:
+		"""Get messages in range, both ends are inclusive like 'LRANGE'."""
+		if CONFIG.session_messages_layout == 'list':
+			values = await self.redis.lrange(self.messages_rkey, start, stop)
+			return [Message.model_validate_json(v) for v in values]
+		if (values := await self.redis.json().get(self.rkey, f"{self._jsonpath}.messages")) is None:
+			raise KeyError("User data doesn't exist. Call 'save' first.")
+		return [Message.model_validate(v) for v in values[start: None if stop == -1 else stop+1]]
+
+	async def load_messages(self)->list[Message]:
+		"""Set 'messages' field with all stored messages."""
+		self.messages = await self.get_messages()
+		return self.messages
+
+	@property
+	def stream_fence_rkey(self)->str:
+		"""Fencing token of the write streams lease, see StreamLease."""
+		return f"{self.rkey_prefix}:{self.id}:<stream_fence>"
+
+	@property
+	def stream_checkpoints_rkey(self)->str:
+		"""Hash of the last delivered stream entry ids per client, see ResumableReadStream."""
+		return f"{self.rkey_prefix}:{self.id}:<stream_checkpoints>"
+
+	async def delete_stream_checkpoints(self, client_id:str)->int:
+		"""Forget the stream positions of a client, e.g. when it closes the session. Returns number of removed checkpoints."""
+		return await self.redis.hdel(self.stream_checkpoints_rkey, f"{client_id}:as2cs", f"{client_id}:cs2as")
+
+class StreamMaterializer:
+	"""Compact finished replies of the 'as2cs' stream of a chat session into messages.
+	'stream_token' of result entries is concatenated per 'phase_id' as entries arrive. The reply is the phase streamed with
+	state 'done', it ends with the entry marked 'end', when an entry of another phase (or not 'done') follows it, or when
+	the stream is idle for 'idle_timeout' in 'run'. Its text (with 'fmt_data') is then appended to the session messages
+	(see 'append_messages') as one assistant message, and the stream is trimmed up to the last entry of the reply, so
+	persisting a reply does not re-read the stream and the stream does not grow with the history. Texts of the other
+	phases (thinking, searching, ...) are dropped.
+	The message is appended before trimming, a failure in between leaves the entries in the stream (nothing is lost),
+	readers behind the trimmed range should reload the messages (see ResumableReadStream 'truncated').
+		Examples:
+			materializer = StreamMaterializer(cs)
+			async for entries in read_stream:   # or feed entries already read to send to the client
+				await materializer.feed(entries)
+			await materializer.flush()
+	"""
+	def __init__(self, chat_session:ChatSessionData, *, trim:bool=True, idle_timeout:float=5):
+		"""
+		Args:
+			chat_session: bound chat session.
+			trim: trim the stream up to the last entry of the reply after persisting the message.
+			idle_timeout: seconds, 'run' ends the pending reply when no entry came for that long.
+		"""
+		self.chat_session = chat_session
+		self.stream_key = chat_session.as2cs_stream_rkey
+		self.trim = trim
+		self.idle_timeout = idle_timeout
+		self._phases:dict[UUID,tuple[list[str],dict[str,AnyUrl]]] = {}
+		self._reply:tuple[str,UUID]|None = None
+		"""(last stream id, phase id) of the reply being streamed."""
+
+	async def feed(self, entries:list[tuple[str,AS2CSData]])->list[Message]:
+		"""
+		Args:
+			entries: (stream id, data) in stream order, as returned by 'read_entries'.
+		Returns:
+			Messages persisted by this call.
+		"""
+		messages = []
+		for sid, data in entries:
+			phase_id = data.result.phase_id if data.result is not None else None
+			if self._reply is not None and (data.state != 'done' or phase_id not in (None, self._reply[1])):
+				messages.append(await self.flush())
+			if data.result is not None:
+				texts, fmt_data = self._phases.setdefault(phase_id, ([], {}))
+				texts.append(data.result.stream_token.text_fmt)
+				fmt_data.update(data.result.stream_token.fmt_data)
+				if data.state == 'done':
+					self._reply = (sid, phase_id)
+			if data.end and self._reply is not None:
+				self._reply = (sid, self._reply[1])
+				messages.append(await self.flush())
+		return messages
+
+	async def flush(self)->Message|None:
+		"""Persist the pending reply, if any."""
+		if self._reply is None:
+			return None
+		last_id, phase_id = self._reply
+		self._reply = None
+		return await self._persist(last_id, phase_id)
+
+	@instrumented("stream_materialize")
+	async def _persist(self, last_id:str, phase_id:UUID)->Message:
+		texts, fmt_data = self._phases.pop(phase_id)
+		self._phases.clear()
+		message = Message(role='assistant', content="".join(texts), fmt_data=fmt_data)
+		await self.chat_session.append_messages([message])
+		if self.trim:
+			ms, seq = last_id.split("-")
+			await get_redis().xtrim(self.stream_key, minid=f"{ms}-{int(seq)+1}", approximate=False)
+		return message
+
+	async def run(self, stream:ReadStream[AS2CSData], count:int=100):
+		"""Materialize entries of 'stream' until cancelled. The stream must keep its position between reads
+		(e.g. resumable, group, multiplexed or broadcast read stream)."""
+		while True:
+			block = int(self.idle_timeout*1000) if self._reply is not None else 0
+			if entries := await stream.read_entries(count=count, block=block):
+				await self.feed(entries)
+			else:
+				await self.flush()
+
 
 class UserNotFoundError(Exception):
 	pass
@@ -718,6 +2644,20 @@ class EncryptedTokenError(Exception):
 	pass
 class RedisKeyError(KeyError):
 	pass
+class VersionConflictError(Exception):
+	def __init__(self, expected_version:int, current_version:int):
+		super().__init__(f"Expected version {expected_version} but current version is {current_version}.")
+		self.expected_version = expected_version
+		self.current_version = current_version
+class SlowConsumerError(Exception):
+	"""Broadcast subscriber was disconnected because it did not keep up with the stream."""
+	pass
+class SigningKeyError(RuntimeError):
+	"""Signed tokens are used without a proper 'token_signing_key' setting."""
+	pass
+class FencingTokenError(LockError):
+	"""Write with a fencing token of a lease which was taken over by another writer."""
+	pass
 
 class UserToken(BaseModel):
 	"""Oauth2 bearer token"""
@@ -730,6 +2670,12 @@ MIN_UUID = UUID(int=0)
 def default_user_token_factory():
 	return UserToken(id = MIN_UUID, created_at= MIN_DATATIME, expires_at= MIN_DATATIME)
 
+def _token_signing_key()->str:
+	if TOKEN_SIGNING_KEY is None or len(TOKEN_SIGNING_KEY) < MIN_SIGNING_KEY_LENGTH:
+		raise SigningKeyError(f"Setting 'token_signing_key' is missing or shorter than {MIN_SIGNING_KEY_LENGTH} characters, "
+		                      f"signed tokens are refused.")
+	return TOKEN_SIGNING_KEY
+
 class UserData(ChatboneData):
 	"""UserData support lazy load ChatSessionData.
 	There are two ways to retrieve data:
@@ -749,6 +2695,9 @@ class UserData(ChatboneData):
 
 	_refresh_include_default: set[str] = PrivateAttr(default_factory=lambda : {"encrypted_secret_token"})
 	"""Attributes in this set will be refresh by default when call 'refresh'. These Attributes must not be passed as init."""
+	_notify_fields = frozenset({"user_token"})
+	_signed_token_cache: ClassVar[OrderedDict[str, tuple[UUID, str, float]]] = OrderedDict()
+	"""LRU of recently verified signed tokens: token -> (user id, nonce, expires at timestamp)."""
 
 	@property
 	def encrypted_secret_rkey(self):
@@ -756,6 +2705,7 @@ class UserData(ChatboneData):
 			raise RedisKeyError("Cannot resolve 'encrypted_secret_rkey', you must 'refresh' default mode to load dynamic rkeys first.  ")
 		return f"{self.rkey_prefix}:<encrypted_token>:{self.encrypted_secret_token}"
 
+	@instrumented("get_encrypted_token")
 	async def get_encrypted_token(self, skip_if_exist:bool=True) -> str:
 		"""Get an encrypted token and return to the user.
 		Notes:
@@ -770,25 +2720,33 @@ class UserData(ChatboneData):
 					logger.debug("Return old token.")
 					return self.encrypted_secret_token
 				else:
-					d = await self.redis.delete(self.encrypted_secret_rkey)
+					async with self._get_transaction_pipeline(execute=False) as pipeline:
+						await pipeline.delete(self.encrypted_secret_rkey)
+						await pipeline.srem(self.registry_rkey, self.encrypted_secret_rkey)
+						d, _ = await pipeline.execute()
 					assert d==1
 
 		key = str(self.id)+'@'+self.username+'@'+self.password
 		secret_key, token = await asyncio.to_thread(encrypt,key )
 		self.encrypted_secret_token=token # this must be set first for self.encrypted_secret_rkey
+		await self._store_encrypted_secret(secret_key, token)
+		logger.debug("Create new token.")
 
+		return self.encrypted_secret_token
+
+	@reload_functions_on_missing
+	async def _store_encrypted_secret(self, secret_key:str, token:str):
 		async with self._get_transaction_pipeline() as pipeline:
 			await pipeline.set(self.encrypted_secret_rkey,secret_key)
 
 			# UserData need to know the key for retrieve it by this method instead of always create new one.
 			# Note: Not use self.set but instead pipeline.json().set() because it not in class fields.
 			await pipeline.json().set(self.rkey,f"{self._jsonpath}.encrypted_secret_token", token)
-			await self.expire_sync([self.encrypted_secret_rkey],pipeline)
-		logger.debug("Create new token.")
-
-		return self.encrypted_secret_token
+			await self._publish_changed(pipeline)
+			await self.register_sub_rkeys([self.encrypted_secret_rkey],pipeline)
 
 	@classmethod
+	@instrumented("verify_encrypted_token")
 	async def verify_encrypted_token(cls, encrypted_token:str, lazy_load_chat_sessions:bool=True) -> Self | None:
 		"""Redis memory:
 		token: secret_key
@@ -808,26 +2766,277 @@ class UserData(ChatboneData):
 		key:str = await asyncio.to_thread(decrypt,encrypted_token,secret_key)
 
 		uid, username, password = key.split("@")
-		userdata = UserData(id=uid,username=username,password=password)
+		await USERDATA_CACHE.start()
+		if (userdata := USERDATA_CACHE.get(uid, lazy_load_chat_sessions)) is None:
+			generation = USERDATA_CACHE.generation
+			userdata = UserData(id=uid,username=username,password=password)
 
-		exclude = set()
-		if lazy_load_chat_sessions:
-			exclude.add('chat_sessions')
+			exclude = set()
+			if lazy_load_chat_sessions:
+				exclude.add('chat_sessions')
 
-		userdata = await userdata.refresh(exclude)
-		await asyncio.to_thread(userdata._bound_cs,userdata.chat_sessions)
+			userdata = await userdata.refresh(exclude, mode='inplace')
+			await asyncio.to_thread(userdata._bound_cs,userdata.chat_sessions)
+			USERDATA_CACHE.put(userdata, not lazy_load_chat_sessions, generation)
 
 		userdata.encrypted_secret_token = encrypted_token
 
 		return userdata
 
-	async def verify_valid_user(self, timeout: int=15, sleep:int=1)->UserToken:
+	@classmethod
+	def _load_paths(cls, lazy_load_chat_sessions:bool)->dict[str,str]:
+		"""Paths of all fields except 'id' (and 'chat_sessions' if lazy). UserData is not embedded, fields are at the json root."""
+		return {f".{field}": field for field in cls.model_fields
+		        if field != 'id' and not (lazy_load_chat_sessions and field == 'chat_sessions')}
+
+	@classmethod
+	@instrumented("load_many")
+	async def load_many(cls, ids:Sequence[UUID|str], lazy_load_chat_sessions:bool=True)->list[Self|None]:
+		"""Load many users in one round trip: 'JSON.MGET' of whole documents, or pipelined 'JSON.GET' of all fields except
+		'chat_sessions' if lazy.
+		Returns:
+			Users in order of ids, None for the ones which don't exist.
+		"""
+		if not ids:
+			return []
+		rkeys = [cls.make_rkey(id) for id in ids]
+		if lazy_load_chat_sessions:
+			paths = cls._load_paths(True)
+			async with cls.redis.pipeline(transaction=False) as pipeline:
+				for rkey in rkeys:
+					await pipeline.json().get(rkey, *paths)
+				results = await pipeline.execute()
+			docs = [None if r is None else cls._refreshed_fields(paths, r) | {"id": id} for id, r in zip(ids, results)]
+		else:
+			docs = await cls.redis.json().mget(rkeys, '.')
+
+		def validate_all()->list[Self|None]:
+			users = [cls.model_validate(doc) if doc else None for doc in docs]
+			for user in users:
+				if user is not None:
+					user._bound_cs(user.chat_sessions)
+			return users
+		return await asyncio.to_thread(validate_all)
+
+	@classmethod
+	@instrumented("verify_many_encrypted_tokens")
+	async def verify_many_encrypted_tokens(cls, encrypted_tokens:Sequence[str], lazy_load_chat_sessions:bool=True)->list[Self|None]:
+		"""Bulk version of 'verify_encrypted_token': secrets are fetched by one 'MGET', decrypted in one thread hop,
+		then users are fetched by 'load_many'.
+		Returns:
+			Users in order of tokens, None for invalid tokens or users which don't exist.
+		"""
+		if not encrypted_tokens:
+			return []
+		secret_keys = await cls.redis.mget([f"{cls.rkey_prefix}:<encrypted_token>:{token}" for token in encrypted_tokens])
+
+		def decrypt_all()->list[str|None]:
+			uids = []
+			for token, secret_key in zip(encrypted_tokens, secret_keys):
+				try:
+					uids.append(None if secret_key is None else decrypt(token, secret_key).split("@")[0])
+				except Exception as e:
+					logger.debug(f"Cannot decrypt token {token}: {e!r}")
+					uids.append(None)
+			return uids
+		uids = await asyncio.to_thread(decrypt_all)
+
+		valid = [i for i, uid in enumerate(uids) if uid is not None]
+		users:list[Self|None] = [None]*len(encrypted_tokens)
+		for i, user in zip(valid, await cls.load_many([uids[i] for i in valid], lazy_load_chat_sessions)):
+			if user is not None:
+				user.encrypted_secret_token = encrypted_tokens[i]
+				users[i] = user
+		return users
+
+	@classmethod
+	@property
+	def active_users_rkey(cls)->str:
+		"""Sorted set of usernames scored by their last seen timestamp (last 'save', 'expire' or TTL heartbeat)."""
+		return f"{cls.rkey_prefix}:<active_users>"
+
+	@classmethod
+	@property
+	def usernames_rkey(cls)->str:
+		"""Hash of username -> user id."""
+		return f"{cls.rkey_prefix}:<usernames>"
+
+	def _check_document(self):
+		for cs in self.chat_sessions.values():
+			ChatSessionData._check_document_messages(cs.messages)
+
+	def _validate_field(self, field:str, value:Any):
+		super()._validate_field(field, value)
+		if field == 'chat_sessions':
+			for cs in value.values():
+				ChatSessionData._check_document_messages(cs.messages)
+
+	@classmethod
+	async def _update_indexes(cls, pipeline:Pipeline, id:UUID, deleted:bool=False):
+		keys = (cls.make_rkey(id), cls.active_users_rkey, cls.usernames_rkey)
+		if deleted:
+			await pipeline.fcall(function_name('user_index_remove'), 3, *keys)
+		else:
+			await pipeline.fcall(function_name('user_index_touch'), 3, *keys, str(id), time.time())
+
+	@classmethod
+	async def get_user_id(cls, username:str)->UUID|None:
+		return UUID(uid) if (uid := await cls.redis.hget(cls.usernames_rkey, username)) is not None else None
+
+	@classmethod
+	async def get_active_users(cls, since_seconds:float|None=None, offset:int=0, count:int=100)->list[tuple[str,UUID,float]]:
+		"""Users by last seen time, most recent first.
+		Args:
+			since_seconds: only users seen in the last 'since_seconds', None means all.
+			offset:
+			count:
+		Returns:
+			list of (username, user id, last seen timestamp).
+		"""
+		min_score = "-inf" if since_seconds is None else time.time()-since_seconds
+		users = await cls.redis.zrevrangebyscore(cls.active_users_rkey, "+inf", min_score, start=offset, num=count,
+		                                         withscores=True)
+		if not users:
+			return []
+		uids = await cls.redis.hmget(cls.usernames_rkey, [username for username, _ in users])
+		return [(username, UUID(uid), last_seen) for (username, last_seen), uid in zip(users, uids) if uid is not None]
+
+	@classmethod
+	async def count_active_users(cls, since_seconds:float|None=None)->int:
+		min_score = "-inf" if since_seconds is None else time.time()-since_seconds
+		return await cls.redis.zcount(cls.active_users_rkey, min_score, "+inf")
+
+	@classmethod
+	@reload_functions_on_missing
+	async def evict_inactive_users(cls, idle_seconds:float, limit:int=1000)->list[str]:
+		"""Remove users not seen for 'idle_seconds' from the indexes, their data is left to expire.
+		Every 'expire' and TTL heartbeat refreshes the last seen time, so with 'idle_seconds' not less than the user data
+		lifetime, evicted users are the expired ones.
+		Returns:
+			Evicted usernames, at most 'limit'.
+		"""
+		await cls.load_functions(skip_if_loaded=True)
+		return await cls.redis.fcall(function_name('user_index_evict'), 2, cls.active_users_rkey, cls.usernames_rkey,
+		                             time.time()-idle_seconds, limit)
+
+	@classmethod
+	async def get_chat_session_ids(cls, uid:UUID|str)->list[UUID]:
+		"""Ids of chat sessions of a user without loading them.
+		Sessions live in the user document, so its 'chat_sessions' keys are the user -> sessions index: one 'JSON.OBJKEYS',
+		always in sync with the writes, unlike a separate index key which every write of 'chat_sessions' should maintain.
+		Raises:
+			UserNotFoundError:
+		"""
+		if (keys := await cls.redis.json().objkeys(cls.make_rkey(uid), ".chat_sessions")) is None:
+			raise UserNotFoundError(f"User data of user '{uid}' doesn't exist.")
+		return [UUID(k) for k in keys]
+
+	@classmethod
+	@property
+	def revoked_tokens_rkey(cls)->str:
+		"""Sorted set of revoked signed token nonces, scored by their expiry timestamp."""
+		return f"{cls.rkey_prefix}:<revoked_tokens>"
+
+	def get_signed_token(self, expire_seconds:int|None=None)->str:
+		"""Alternative of 'get_encrypted_token'. The token carries user id, expiry and a nonce, signed with the server
+		'token_signing_key', so it's verified without any redis key of its own. Use 'revoke_signed_token' to invalidate it before expiry.
+		Args:
+			expire_seconds: default is 'signed_token_expire_seconds'.
+		Raises:
+			SigningKeyError: signing key is not configured or too weak.
+		"""
+		expires_at = int(time.time()) + (expire_seconds or CONFIG.signed_token_expire_seconds)
+		return sign(f"{self.id}:{expires_at}:{secrets.token_urlsafe(12)}", _token_signing_key())
+
+	@classmethod
+	def _verify_signature(cls, signed_token:str)->tuple[UUID, str, float]:
+		"""
+		Returns:
+			(user id, nonce, expires at timestamp)
+		Raises:
+			EncryptedTokenError
+			SigningKeyError: signing key is not configured or too weak.
+		"""
+		key = _token_signing_key()
+		cache = cls._signed_token_cache
+		if (r := cache.get(signed_token)) is not None:
+			cache.move_to_end(signed_token)
+		else:
+			try:
+				uid, expires_at, nonce = unsign(signed_token, key).split(":")
+				r = (UUID(uid), nonce, float(expires_at))
+			except ValueError as e:
+				raise EncryptedTokenError("Invalid signed token.") from e
+			cache[signed_token] = r
+			if len(cache) > CONFIG.signed_token_cache_size:
+				cache.popitem(last=False)
+		if r[2] < time.time():
+			cache.pop(signed_token, None)
+			raise EncryptedTokenError("Signed token expired.")
+		return r
+
+	@classmethod
+	@instrumented("verify_signed_token")
+	async def verify_signed_token(cls, signed_token:str, lazy_load_chat_sessions:bool=True) -> Self:
+		"""Verify a token of 'get_signed_token' and load the user data.
+		The signature is checked in process (cached in an LRU), the revocation check and the user data load are sent in one round trip.
+		Raises:
+			EncryptedTokenError, UserNotFoundError
+		"""
+		uid, nonce, _ = cls._verify_signature(signed_token)
+		paths = cls._load_paths(lazy_load_chat_sessions)
+		await USERDATA_CACHE.start()
+		cached = USERDATA_CACHE.get(uid, lazy_load_chat_sessions)
+		generation = USERDATA_CACHE.generation
+
+		async with cls.redis.pipeline(transaction=False) as pipeline:
+			await pipeline.zscore(cls.revoked_tokens_rkey, nonce)
+			if cached is None:
+				await pipeline.json().get(cls.make_rkey(uid), *paths)
+			revoked, *r = await pipeline.execute()
+		if revoked is not None:
+			cls._signed_token_cache.pop(signed_token, None)
+			raise EncryptedTokenError("Signed token was revoked.")
+		if cached is not None:
+			return cached
+		if r[0] is None:
+			raise UserNotFoundError(f"User data of user '{uid}' doesn't exist.")
+
+		userdata = cls.model_validate(cls._refreshed_fields(paths, r[0]) | {"id": uid})
+		userdata._bound_cs(userdata.chat_sessions)
+		USERDATA_CACHE.put(userdata, not lazy_load_chat_sessions, generation)
+		return userdata
+
+	@classmethod
+	@instrumented("revoke_signed_token")
+	async def revoke_signed_token(cls, signed_token:str):
+		"""Reject the token until its expiry, expired revocations are removed on the way.
+		Raises:
+			EncryptedTokenError: invalid or expired token, nothing to revoke.
+		"""
+		_, nonce, expires_at = cls._verify_signature(signed_token)
+		cls._signed_token_cache.pop(signed_token, None)
+		async with cls.redis.pipeline(transaction=True) as pipeline:
+			await pipeline.zremrangebyscore(cls.revoked_tokens_rkey, "-inf", time.time())
+			await pipeline.zadd(cls.revoked_tokens_rkey, {nonce: expires_at})
+			await pipeline.execute()
+
+	async def verify_valid_user(self, timeout: int=15, sleep:int=1, mode:Literal['notify','poll']='notify',
+	                            fallback:float=3)->UserToken:
 		""" This method is used for check if user is valid to make further request to business service. If user is not valid now
 		because of a token, use 'update_token' to make it valid.
 		User is considered valid when:
 			1. User exists in server.
 			2. User has the non-expired token.
 		If (1) fails, raise the error for the app to shut down. If (2) fails, wait until timeout the token exist, raise when timeout.
+		Args:
+			timeout:
+			sleep: poll interval in 'poll' mode.
+			mode:
+				- 'notify': wait for the notification published when 'user_token' is set (see 'field_channel'), check again on wake.
+				- 'poll': check every 'sleep' seconds.
+			fallback: 'notify' mode only, check again after this many seconds without notification, in case one was missed.
+				Should be well under 'timeout'.
 		Returns:
 			valid UserToken object.
 		Raises:
@@ -839,21 +3048,51 @@ class UserData(ChatboneData):
 		def time_remain():
 			return timeout - (time.time()-start)
 
-		while time_remain()>0:
-			if (token:= await self.redis.json().get(self.rkey,f"{self._jsonpath}.user_token")) is None:
-				raise UserNotFoundError("User data doesn't exist. Call 'save' first.")
-			try:
-				ut =  UserToken.model_validate(token)
-				if ut.expires_at<utc_now():
-					raise ValueError
-				return ut
-			except (ValidationError,ValueError):
-				logger.debug(f"User '{self.id}' does not have valid token, got token: {token}.\n"
-				             f"Waiting time remain: {time_remain()} seconds.")
-				await asyncio.sleep(sleep)
+		async def wait_poll(remain:float):
+			await asyncio.sleep(min(sleep, remain))
+
+		async with AsyncExitStack() as stack:
+			if mode == 'notify':
+				# Subscribe before checking, so that a token set in between is not missed.
+				event = await stack.enter_async_context(PUBSUB_HUB.subscription(self.field_channel("user_token")))
+				async def wait_notify(remain:float):
+					try:
+						await asyncio.wait_for(event.wait(), min(fallback, remain))
+					except asyncio.TimeoutError:
+						pass
+					event.clear()
+				wait = wait_notify
+			else:
+				wait = wait_poll
+
+			while (remain := time_remain())>0:
+				if (ut := await self._get_valid_user_token()) is not None:
+					return ut
+				logger.debug(f"User '{self.id}' does not have valid token. Waiting time remain: {remain} seconds.")
+				await wait(time_remain())
 
+		# Last check at the deadline, the notification of a token set while waiting may have been missed.
+		if (ut := await self._get_valid_user_token()) is not None:
+			return ut
 		raise NoValidTokenError(f"There is no valid token for user with id {self.id}. Timeout for {timeout} seconds.")
 
+	async def _get_valid_user_token(self)->UserToken|None:
+		"""
+		Raises:
+			UserNotFoundError
+		"""
+		if (token:= await self.redis.json().get(self.rkey,f"{self._jsonpath}.user_token")) is None:
+			raise UserNotFoundError("User data doesn't exist. Call 'save' first.")
+		try:
+			ut =  UserToken.model_validate(token)
+			if ut.expires_at<utc_now():
+				raise ValueError
+			return ut
+		except (ValidationError,ValueError):
+			logger.debug(f"Got invalid token {token}.")
+			return None
+
+	@instrumented("get_chat_sessions")
 	async def get_chat_sessions(self,session_ids: list[UUID])->dict[UUID,ChatSessionData]:
 		"""For lazy get chat_sessions.
 		Args:
@@ -883,6 +3122,181 @@ class UserData(ChatboneData):
 	# 		await self.update('chat_sessions',cs_dict,pipeline)
 
 
+class UserDataCache:
+	"""Per-process LRU of UserData, so that repeat logins of the same users don't read redis again.
+	Entries are invalidated by DATA_CHANGED_CHANNEL messages (every broker write publishes its main rkey) through PUBSUB_HUB,
+	the whole cache is cleared when messages may have been lost. Entries also expire after 'ttl' seconds, which bounds staleness
+	for missed messages and expired main rkeys.
+	Objects are copied in and out with their chat sessions, but field values (messages, summaries, ...) are shared, so that
+	a hit costs O(sessions) instead of O(messages). Callers may assign fields (and add or remove chat sessions) freely,
+	but must not mutate field values in place, e.g. assign 'cs.messages = [*cs.messages, message]' instead of appending.
+		Examples:
+			await USERDATA_CACHE.start()
+			if (user := USERDATA_CACHE.get(uid)) is None:
+				generation = USERDATA_CACHE.generation # taken before loading
+				user = ... # load from redis
+				USERDATA_CACHE.put(user, complete=False, generation=generation)
+	"""
+	def __init__(self, maxsize:int|None=None, ttl:float|None=None):
+		"""
+		Args:
+			maxsize: default is 'userdata_cache_size', 0 disables the cache.
+			ttl: seconds, default is 'userdata_cache_ttl'.
+		"""
+		self.maxsize = CONFIG.userdata_cache_size if maxsize is None else maxsize
+		self.ttl = ttl or CONFIG.userdata_cache_ttl
+		self._entries:OrderedDict[str, tuple[UserData, bool, float]] = OrderedDict()
+		"""main rkey -> (user, complete (chat sessions are loaded), expires at (monotonic))"""
+		self._generation:int = 0
+		self._invalidated:OrderedDict[str, int] = OrderedDict()
+		"""main rkey -> generation of its last invalidation, the oldest are forgotten beyond 'maxsize'."""
+		self._invalidated_before:int = 0
+		"""Generation of the last clear or forgotten invalidation, it applies to every rkey."""
+		self._started:bool = False
+		self.hits:int = 0
+		self.misses:int = 0
+
+	async def start(self):
+		"""Subscribe to invalidations, nothing is cached before."""
+		if not self._started and self.maxsize > 0:
+			self._started = True
+			await PUBSUB_HUB.add_handler(DATA_CHANGED_CHANNEL, self._on_changed)
+
+	def _on_changed(self, rkey:str|None):
+		self._generation += 1
+		if rkey is None:
+			self._entries.clear()
+			self._invalidated.clear()
+			self._invalidated_before = self._generation
+		else:
+			self._entries.pop(rkey, None)
+			self._invalidated[rkey] = self._generation
+			self._invalidated.move_to_end(rkey)
+			while len(self._invalidated) > self.maxsize:
+				self._invalidated_before = self._invalidated.popitem(last=False)[1]
 
+	@property
+	def generation(self)->int:
+		"""Increased on every invalidation."""
+		return self._generation
 
+	def get(self, id:UUID|str, lazy_load_chat_sessions:bool=True)->UserData|None:
+		"""
+		Args:
+			id:
+			lazy_load_chat_sessions: if False, only entries with chat sessions are returned.
+		"""
+		rkey = UserData.make_rkey(id)
+		if (entry := self._entries.get(rkey)) is not None:
+			user, complete, expires_at = entry
+			if expires_at < time.monotonic():
+				del self._entries[rkey]
+			elif complete or lazy_load_chat_sessions:
+				self._entries.move_to_end(rkey)
+				self.hits += 1
+				return self._copy(user)
+		self.misses += 1
+		return None
 
+	def put(self, user:UserData, complete:bool, generation:int):
+		"""
+		Args:
+			user:
+			complete: whether chat sessions were loaded.
+			generation: 'generation' taken before loading the user. The user is not cached if it was invalidated since,
+				because it may have been loaded before that write.
+		"""
+		if (not self._started or generation < self._invalidated_before
+				or generation < self._invalidated.get(user.rkey, 0)):
+			return
+		self._entries[user.rkey] = (self._copy(user), complete, time.monotonic()+self.ttl)
+		self._entries.move_to_end(user.rkey)
+		while len(self._entries) > self.maxsize:
+			self._entries.popitem(last=False)
+
+	@staticmethod
+	def _copy(user:UserData)->UserData:
+		"""Shallow copy of the user and its chat sessions, their bindings are kept."""
+		return user.model_copy(update={"chat_sessions": {id: cs.model_copy() for id, cs in user.chat_sessions.items()}})
+
+	def stats(self)->dict[str,int|float]:
+		total = self.hits + self.misses
+		return dict(hits=self.hits, misses=self.misses, size=len(self._entries), hit_ratio=self.hits/total if total else 0.0)
+
+	async def close(self):
+		if self._started:
+			await PUBSUB_HUB.remove_handler(DATA_CHANGED_CHANNEL, self._on_changed)
+			self._started = False
+		self._entries.clear()
+		self._invalidated.clear()
+		self._invalidated_before = self._generation
+
+USERDATA_CACHE = UserDataCache()
+
+
+class TTLHeartbeat:
+	"""Per-process scheduler coalescing TTL extensions of active users, instead of one 'expire' call per touch.
+	Touched objects are deduplicated by main rkey and flushed every 'interval' seconds as 'cascade_expire' calls,
+	'batch_size' per pipeline, so thousands of users cost a few round trips per interval.
+		Examples:
+			TTL_HEARTBEAT.touch(userdata, CONFIG.userdata_expire_seconds)
+	"""
+	def __init__(self, interval:float=15, batch_size:int=1000):
+		self.interval = interval
+		self.batch_size = batch_size
+		self._touched:dict[str, tuple[str, int, type[ChatboneData], UUID]] = {}
+		"""main rkey -> (registry rkey, expire seconds, class and id for '_update_indexes'), touched objects are not kept."""
+		self._task:asyncio.Task|None = None
+
+	def touch(self, data:ChatboneData, expire_seconds:int):
+		"""Schedule the cascade expire of a non-embedding object, repeated touches before the flush are merged.
+		Must be called in a running event loop."""
+		if data.embedding:
+			raise ValueError("Embedding model cannot do this operation .")
+		self._touched[data.rkey] = (data.registry_rkey, expire_seconds, type(data), data.id)
+		if self._task is None or self._task.done():
+			self._task = asyncio.create_task(self._run())
+
+	async def _run(self):
+		while True:
+			await asyncio.sleep(self.interval)
+			try:
+				await self.flush()
+			except Exception as e:
+				logger.error(f"TTL heartbeat flush fail. {e!r}")
+
+	@instrumented("ttl_heartbeat_flush")
+	@reload_functions_on_missing
+	async def flush(self)->int:
+		"""Send all pending touches now.
+		Returns:
+			Number of objects were expired.
+		"""
+		touched, self._touched = self._touched, {}
+		if not touched:
+			return 0
+		items = list(touched.items())
+		i = 0
+		try:
+			await ChatboneData.load_functions(skip_if_loaded=True)
+			for i in range(0, len(items), self.batch_size):
+				async with get_redis().pipeline(transaction=False) as pipeline:
+					for rkey, (registry_rkey, expire_seconds, cls, id) in items[i:i+self.batch_size]:
+						await pipeline.fcall(function_name('cascade_expire'), 2, rkey, registry_rkey, expire_seconds)
+						await cls._update_indexes(pipeline, id)
+					await pipeline.execute()
+		except Exception:
+			# Retry the rest with the next flush, unless touched again meanwhile.
+			self._touched = dict(items[i:]) | self._touched
+			raise
+		logger.debug(f"TTL heartbeat expired {len(items)} objects.")
+		return len(items)
+
+	async def close(self):
+		"""Stop the scheduler and flush the pending touches."""
+		if self._task is not None:
+			self._task.cancel()
+			self._task = None
+		await self.flush()
+
+TTL_HEARTBEAT = TTLHeartbeat()
@@ -9,7 +9,7 @@ from fastapi import HTTPException
 from pydantic import Field, ConfigDict
 from uuid_extensions import uuid7
 
-from chatbone.broker import UserData, UserToken, EncryptedTokenError
+from chatbone.broker import UserData, UserToken, EncryptedTokenError, TTL_HEARTBEAT, BROKER_METRICS
 from chatbone.chat.settings import CONFIG, AUTH
 from utilities.settings.clients.auth import *
 
@@ -236,6 +236,7 @@ class ChatApp:
 		else:
 			# Global mode
 			self.connections: list[UUID] = []
+			BROKER_METRICS.install()
 
 
 	# def __del__(self):
@@ -251,6 +252,7 @@ class ChatApp:
 		Returns:
 
 		"""
+		self.keep_alive()
 		routes = e.split('/') if isinstance(e,str) else e.route.split('/')
 		if routes[0]!="": # Ex: "ass" or "ass/hole". The correct one is "/ass/hole"
 			raise ValueError(f"Route must start with '/'. Got '{routes}'.")
@@ -290,9 +292,15 @@ class ChatApp:
 		if encrypted_token:
 			try:
 				self.userdata = await UserData.verify_encrypted_token(encrypted_token)
+				self.keep_alive()
 			except EncryptedTokenError:
 				await self.page.client_storage.remove_async("encrypted_token")
 
+	def keep_alive(self):
+		"""Extend the lifetime of the logged in user data on user activity, touches are batched by TTL_HEARTBEAT."""
+		if self.userdata is not None:
+			TTL_HEARTBEAT.touch(self.userdata, CONFIG.userdata_expire_seconds)
+
 	async def main(self, page: ft.Page):
 		app = self.__class__(page,self)
 		await app.login()
@@ -1,4 +1,4 @@
-from typing import Callable
+from typing import Callable, Literal
 
 from dotenv import find_dotenv
 from pydantic import Field, PositiveInt
@@ -25,6 +25,24 @@ class ChatboneConfig(Config):
 	redis_lock_timeout: PositiveInt|None=10
 	redis_acquire_lock_timeout:PositiveInt|None = 10
 	thread_acquire_lock_timeout: int = 10
+	signed_token_expire_seconds: PositiveInt = 86400
+	signed_token_cache_size: PositiveInt = 10000
+	session_messages_layout: Literal['document','list'] = 'document'
+	"""Where chat session messages are stored: 'document' is the 'messages' field of the user JSON document, 'list' is a capped list key per session."""
+	session_max_messages: PositiveInt|None = None
+	"""Latest messages kept per chat session by 'append_messages', None means no cap."""
+	stream_codec: Literal['fields','packed'] = 'fields'
+	"""Format of written stream entries. Readers decode both, switch to 'packed' once no reader of an older release is left."""
+	stream_resume_max_backlog: PositiveInt = 1000
+	"""Maximum stream entries replayed to a reconnecting client, see 'chatbone.broker.ResumableReadStream'."""
+	stream_broadcast_queue_size: PositiveInt = 1000
+	"""Entries buffered per broadcast subscriber, see 'chatbone.broker.StreamBroadcaster'."""
+	stream_broadcast_slow_consumer_policy: Literal['drop_oldest','drop_newest','disconnect'] = 'disconnect'
+	userdata_cache_size: int = 10000
+	"""Maximum UserData objects cached per process, 0 disables the cache."""
+	userdata_cache_ttl: PositiveInt = 60
+	metrics_enabled: bool = True
+	"""Record broker metrics, see 'chatbone.broker.BROKER_METRICS'."""
 
 class ChatboneSettings(Settings):
 	model_config = SettingsConfigDict(env_prefix='chatbone_', env_file=find_dotenv('.env.chatbone'),
@@ -37,6 +55,8 @@ class ChatboneSettings(Settings):
 	config: ChatboneConfig
 
 	user_secret_key:str = Field("abcxyz", description= "Used for encrypt.")
+	token_signing_key:str|None = Field(None, description="HMAC key of signed user tokens, at least 32 characters. "
+	                                                     "Signed tokens are refused if it is not set.")
 
 	# This is for redis_client is redis.asyncio.Redis type directly. But now use wrapper.
 	# @model_validator(mode="after")
@@ -51,4 +71,5 @@ chatbone_settings = ChatboneSettings()
 get_redis: Callable[...,Redis] = chatbone_settings.redis.new
 REDIS: Redis = get_redis()
 CONFIG = chatbone_settings.config
-SECRET_KEY= chatbone_settings.user_secret_key
\ No newline at end of file
+SECRET_KEY= chatbone_settings.user_secret_key
+TOKEN_SIGNING_KEY = chatbone_settings.token_signing_key
\ No newline at end of file
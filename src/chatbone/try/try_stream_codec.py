@@ -0,0 +1,56 @@
+import asyncio
+import time
+
+from uuid_extensions import uuid7
+
+from chatbone.broker import AS2CSData, ResultForm, TextUrlsFormat, FieldsStreamCodec, PackedStreamCodec, StreamCodec
+
+
+def token_data(i: int) -> AS2CSData:
+	return AS2CSData(result=ResultForm(phase_id=uuid7(), phase_info="thinking",
+	                                   stream_token=TextUrlsFormat(text_fmt=f"token {i} ")),
+	                 state='processing')
+
+
+def bench_codec(codec: StreamCodec, data: list[AS2CSData]) -> tuple[float, float, int]:
+	"""Returns (encode us/op, decode us/op, bytes/op)."""
+	_ = [StreamCodec.decode(AS2CSData, codec.encode(d)) for d in data[:1000]]  # warm up
+
+	start = time.perf_counter()
+	encoded = [codec.encode(d) for d in data]
+	encode_time = time.perf_counter() - start
+
+	start = time.perf_counter()
+	decoded = [StreamCodec.decode(AS2CSData, fields) for fields in encoded]
+	decode_time = time.perf_counter() - start
+
+	assert decoded == data
+	size = sum(len(k) + len(str(v)) for fields in encoded for k, v in fields.items())
+	n = len(data)
+	return encode_time / n * 1e6, decode_time / n * 1e6, size // n
+
+
+async def bench_thread_hop(data: list[AS2CSData]) -> tuple[float, float]:
+	"""The original path, each message is encoded and decoded through 'asyncio.to_thread'."""
+	start = time.perf_counter()
+	encoded = [await d.encode() for d in data]
+	encode_time = time.perf_counter() - start
+
+	start = time.perf_counter()
+	_ = [await AS2CSData.decode(fields) for fields in encoded]
+	decode_time = time.perf_counter() - start
+	n = len(data)
+	return encode_time / n * 1e6, decode_time / n * 1e6
+
+
+async def main(n: int = 20_000):
+	data = [token_data(i) for i in range(n)]
+	for codec in (FieldsStreamCodec(), PackedStreamCodec()):
+		enc, dec, size = bench_codec(codec, data)
+		print(f"{codec.__class__.__name__:<20} encode {enc:7.2f} us  decode {dec:7.2f} us  {size} bytes")
+	enc, dec = await bench_thread_hop(data)
+	print(f"{'to_thread (original)':<20} encode {enc:7.2f} us  decode {dec:7.2f} us")
+
+
+if __name__ == "__main__":
+	asyncio.run(main())
@@ -1,3 +1,6 @@
+import base64
+import hashlib
+import hmac
 import os
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
@@ -35,6 +38,33 @@ def encrypt(key:str)->tuple[str,str]:
 def decrypt(token:str, secret_key:str)->str:
 	return Fernet(secret_key.encode()).decrypt(token).decode()
 
+def _b64encode(data:bytes)->str:
+	return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+def _b64decode(data:str)->bytes:
+	return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def sign(payload:str, key:str)->str:
+	"""
+	Returns:
+		'base64url(payload).base64url(HMAC-SHA256(key, payload))'
+	"""
+	data = payload.encode()
+	return _b64encode(data) + "." + _b64encode(hmac.digest(key.encode(), data, hashlib.sha256))
+
+def unsign(token:str, key:str)->str:
+	"""Inverse of 'sign'.
+	Raises:
+		ValueError: malformed token or signature does not match.
+	"""
+	try:
+		data, signature = (_b64decode(part) for part in token.split("."))
+	except (ValueError, TypeError) as e:
+		raise ValueError("Malformed signed token.") from e
+	if not hmac.compare_digest(signature, hmac.digest(key.encode(), data, hashlib.sha256)):
+		raise ValueError("Signature does not match.")
+	return data.decode()
+
 def utc_now():
 	return datetime.now(timezone.utc)
 
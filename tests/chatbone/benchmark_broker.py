@@ -0,0 +1,350 @@
+"""Broker benchmark suite: throughput and latency of UserData, ChatSessionData and stream workloads.
+
+Run against a Redis Stack (RedisJSON and Redis Functions are required):
+
+	python tests/chatbone/benchmark_broker.py --redis-url redis://localhost:6379/15 --sessions 1,10 --messages 10,100
+	python tests/chatbone/benchmark_broker.py --docker --output results.json      # start a throwaway redis-stack container
+	python tests/chatbone/benchmark_broker.py --server-bin redis-stack-server      # start a local redis-stack binary
+
+Results are printed (or written to '--output') as JSON, one entry per workload and parameter combination, so that
+runs of different releases can be diffed. A failing workload is reported with an 'error' instead of numbers.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from importlib.metadata import version, PackageNotFoundError
+from typing import Any, Awaitable, Callable
+
+from redis.asyncio import Redis
+from uuid_extensions import uuid7
+
+from chatbone import broker
+from chatbone.broker import UserData, ChatSessionData, Message, WriteStream, ReadStream, AS2CSData, ResultForm, \
+	TextUrlsFormat, UserDataCache
+
+
+REDIS_STACK_IMAGE = "redis/redis-stack-server:latest"
+
+
+def _free_port() -> int:
+	with socket.socket() as s:
+		s.bind(("127.0.0.1", 0))
+		return s.getsockname()[1]
+
+
+async def _wait_ready(redis: Redis, timeout: float = 30):
+	start = time.monotonic()
+	while True:
+		try:
+			await redis.ping()
+			return
+		except Exception:
+			if time.monotonic() - start > timeout:
+				raise
+			await asyncio.sleep(0.2)
+
+
+@contextmanager
+def _docker_redis_stack():
+	if shutil.which("docker") is None:
+		raise RuntimeError("'docker' is not found, use '--redis-url' or '--server-bin' instead.")
+	port = _free_port()
+	container = subprocess.check_output(["docker", "run", "-d", "--rm", "-p", f"{port}:6379", REDIS_STACK_IMAGE],
+	                                    text=True).strip()
+	try:
+		yield f"redis://127.0.0.1:{port}/0"
+	finally:
+		subprocess.run(["docker", "stop", container], capture_output=True)
+
+
+@contextmanager
+def _local_redis_stack(server_bin: str):
+	port = _free_port()
+	process = subprocess.Popen([server_bin, "--port", str(port), "--save", "", "--appendonly", "no"],
+	                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	try:
+		yield f"redis://127.0.0.1:{port}/0"
+	finally:
+		process.terminate()
+		process.wait(10)
+
+
+def use_redis(new: Callable[[], Redis]):
+	"""Point the broker at another Redis, 'new' creates a client like 'chatbone.settings.get_redis'."""
+	broker.get_redis = new
+	broker.ChatboneData.redis = new()
+
+
+def _latency_stats(latencies: list[float], seconds: float) -> dict[str, Any]:
+	latencies = sorted(latencies)
+	q = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+	return dict(ops=len(latencies),
+	            seconds=round(seconds, 6),
+	            ops_per_sec=round(len(latencies) / seconds, 2) if seconds else None,
+	            latency_ms=dict(mean=round(statistics.fmean(latencies) * 1e3, 4),
+	                            p50=round(q[49] * 1e3, 4),
+	                            p95=round(q[94] * 1e3, 4),
+	                            p99=round(q[98] * 1e3, 4),
+	                            max=round(latencies[-1] * 1e3, 4)))
+
+
+async def _timed(calls: list[Callable[[], Awaitable[Any]]], concurrency: int = 1) -> dict[str, Any]:
+	"""Run calls with at most 'concurrency' in flight, returns throughput and latency percentiles."""
+	latencies: list[float] = []
+	semaphore = asyncio.Semaphore(concurrency)
+
+	async def run(call):
+		async with semaphore:
+			t = time.perf_counter()
+			await call()
+			latencies.append(time.perf_counter() - t)
+
+	start = time.perf_counter()
+	await asyncio.gather(*(run(call) for call in calls))
+	return _latency_stats(latencies, time.perf_counter() - start)
+
+
+def new_userdata(n_sessions: int) -> UserData:
+	"""User with empty sessions, messages are seeded after saving (see 'save_userdata'), like in both message layouts."""
+	uid = uuid7()
+	chat_sessions = {}
+	for _ in range(n_sessions):
+		csid = uuid7()
+		chat_sessions[csid] = {"id": csid}
+	return UserData.model_validate({"id": uid, "username": f"bench:{uid}", "password": "benchmark",
+	                                "chat_sessions": chat_sessions})
+
+
+async def save_userdata(user: UserData, n_messages: int) -> None:
+	"""Save the user and append 'n_messages' to each of its sessions."""
+	await user.save(refresh=False)
+	if not n_messages:
+		return
+	for csid, cs in user.chat_sessions.items():
+		cs.bind_rkey_and_json_path(user.rkey, f'.chat_sessions["{csid}"]')
+		await cs.append_messages([Message(role='user', content=f"benchmark message {i} of session {csid}")
+		                          for i in range(n_messages)])
+
+
+def stream_data(i: int) -> AS2CSData:
+	return AS2CSData(result=ResultForm(phase_id=uuid7(), phase_info="thinking",
+	                                   stream_token=TextUrlsFormat(text_fmt=f"token {i} ")),
+	                 state='processing')
+
+
+class BrokerBenchmark:
+	"""Workloads of one (sessions per user, messages per session) combination, each returns a result dict."""
+
+	def __init__(self, n_sessions: int, n_messages: int, *, users: int, concurrency: int, contenders: int,
+	             stream_messages: int, hold_ms: float):
+		self.n_sessions = n_sessions
+		self.n_messages = n_messages
+		self.users = users
+		self.concurrency = concurrency
+		self.contenders = contenders
+		self.stream_messages = stream_messages
+		self.hold_ms = hold_ms
+		self.saved: list[UserData] = []
+
+	async def _saved_users(self, n: int) -> list[UserData]:
+		users = [new_userdata(self.n_sessions) for _ in range(n)]
+		for user in users:
+			await save_userdata(user, self.n_messages)
+		self.saved.extend(users)
+		return users
+
+	async def _bound_session(self) -> ChatSessionData:
+		user = (await self._saved_users(1))[0]
+		csid = next(iter(user.chat_sessions))
+		cs = user.chat_sessions[csid]
+		cs.bind_rkey_and_json_path(user.rkey, f'.chat_sessions["{csid}"]')
+		return cs
+
+	async def userdata_save(self) -> dict[str, Any]:
+		users = [new_userdata(self.n_sessions) for _ in range(self.users)]
+		self.saved.extend(users)
+		return await _timed([lambda u=u: save_userdata(u, self.n_messages) for u in users], self.concurrency)
+
+	async def userdata_refresh(self) -> dict[str, Any]:
+		users = await self._saved_users(self.users)
+		return await _timed([lambda u=u: u.refresh(include={"chat_sessions"}) for u in users], self.concurrency)
+
+	async def userdata_load(self) -> dict[str, Any]:
+		"""Load of users with their chat sessions, what a 'userdata_cache_hit' saves."""
+		users = await self._saved_users(self.users)
+		return await _timed([lambda u=u: UserData.load_many([u.id], lazy_load_chat_sessions=False) for u in users],
+		                    self.concurrency)
+
+	async def userdata_cache_hit(self) -> dict[str, Any]:
+		"""Cache hits of the users of 'userdata_load'."""
+		users = await self._saved_users(self.users)
+		cache = UserDataCache(maxsize=len(users))
+		await cache.start()
+		try:
+			for user in await UserData.load_many([u.id for u in users], lazy_load_chat_sessions=False):
+				cache.put(user, complete=True, generation=cache.generation)
+
+			async def hit(user: UserData):
+				if cache.get(user.id, lazy_load_chat_sessions=False) is None:
+					raise KeyError(f"User '{user.id}' is not cached.")
+
+			return await _timed([lambda u=u: hit(u) for u in users], self.concurrency)
+		finally:
+			await cache.close()
+
+	async def session_append(self) -> dict[str, Any]:
+		cs = await self._bound_session()
+		messages = [Message(role='assistant', content=f"appended message {i}") for i in range(self.users)]
+		return await _timed([lambda m=m: cs.append_messages([m]) for m in messages])
+
+	async def cascade_expire(self) -> dict[str, Any]:
+		users = await self._saved_users(self.users)
+		return await _timed([lambda u=u: u.expire(3600) for u in users], self.concurrency)
+
+	async def cascade_delete(self) -> dict[str, Any]:
+		users = await self._saved_users(self.users)
+		for user in users:
+			self.saved.remove(user)
+		return await _timed([lambda u=u: u.delete() for u in users], self.concurrency)
+
+	async def stream_lock_contention(self) -> dict[str, Any]:
+		"""'contenders' tasks take turns holding the write streams of one session for 'hold_ms' each.
+		Latency is the wait to acquire the lease."""
+		cs = await self._bound_session()
+		waits: list[float] = []
+		rounds = max(1, self.stream_messages // 10)
+
+		async def contender(i: int):
+			for n in range(rounds):
+				t = time.perf_counter()
+				async with cs.get_streams(write_only=True, write_streams_acquire_timeout=60) as streams:
+					waits.append(time.perf_counter() - t)
+					await streams['as2cs'][0].write(stream_data(i * rounds + n))
+					await asyncio.sleep(self.hold_ms / 1000)
+
+		start = time.perf_counter()
+		await asyncio.gather(*(contender(i) for i in range(self.contenders)))
+		return _latency_stats(waits, time.perf_counter() - start) | dict(contenders=self.contenders)
+
+	async def stream_roundtrip(self) -> dict[str, Any]:
+		"""Latency from writing an entry to reading it back."""
+		cs = await self._bound_session()
+		await cs.init_stream_keys()
+		writer = WriteStream(cs.as2cs_stream_rkey, AS2CSData)
+		reader = ReadStream(cs.as2cs_stream_rkey, AS2CSData)
+		checkpoint = await writer.write(stream_data(-1))
+		latencies: list[float] = []
+		start = time.perf_counter()
+		for i in range(self.stream_messages):
+			t = time.perf_counter()
+			await writer.write(stream_data(i))
+			entries = await reader.read_entries(checkpoint, count=1, block=1000)
+			latencies.append(time.perf_counter() - t)
+			if not entries:
+				raise TimeoutError(f"Entry {i} was not read back within 1 second.")
+			checkpoint = entries[-1][0]
+		return _latency_stats(latencies, time.perf_counter() - start)
+
+	async def cleanup(self):
+		for user in self.saved:
+			try:
+				await user.delete()
+			except Exception:
+				pass
+		self.saved.clear()
+
+
+WORKLOADS = ["userdata_save", "userdata_refresh", "userdata_load", "userdata_cache_hit", "session_append",
+             "cascade_expire", "cascade_delete", "stream_lock_contention", "stream_roundtrip"]
+
+
+def _parse_ints(value: str) -> list[int]:
+	return [int(v) for v in value.split(",") if v]
+
+
+async def run(args: argparse.Namespace, redis_url: str | None) -> dict[str, Any]:
+	if redis_url is not None:
+		use_redis(lambda: Redis.from_url(redis_url, decode_responses=True))
+	await _wait_ready(broker.ChatboneData.redis)
+	info = await broker.ChatboneData.redis.info("server")
+	backend = f"redis {info.get('redis_version')}"
+	await UserData.load_functions()
+
+	try:
+		chatbone_version = version("chatbone")
+	except PackageNotFoundError:
+		chatbone_version = None
+	workloads = args.workloads or WORKLOADS
+	results = []
+	for n_sessions in args.sessions:
+		for n_messages in args.messages:
+			bench = BrokerBenchmark(n_sessions, n_messages, users=args.users, concurrency=args.concurrency,
+			                        contenders=args.contenders, stream_messages=args.stream_messages,
+			                        hold_ms=args.hold_ms)
+			for workload in workloads:
+				result: dict[str, Any] = dict(workload=workload, sessions_per_user=n_sessions,
+				                              messages_per_session=n_messages)
+				try:
+					result |= await getattr(bench, workload)()
+				except Exception as e:
+					result["error"] = repr(e)
+				results.append(result)
+			await bench.cleanup()
+	return dict(meta=dict(created_at=datetime.now(timezone.utc).isoformat(),
+	                      chatbone_version=chatbone_version,
+	                      python=platform.python_version(),
+	                      backend=backend,
+	                      messages_layout=broker.CONFIG.session_messages_layout,
+	                      params=dict(users=args.users, concurrency=args.concurrency, contenders=args.contenders,
+	                                  stream_messages=args.stream_messages, hold_ms=args.hold_ms)),
+	            results=results)
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+	target = parser.add_mutually_exclusive_group()
+	target.add_argument("--redis-url", help="Redis Stack to use, default is the chatbone settings.")
+	target.add_argument("--docker", action="store_true", help=f"Start a '{REDIS_STACK_IMAGE}' container.")
+	target.add_argument("--server-bin", help="Start this redis-stack-server binary on a free port.")
+	parser.add_argument("--sessions", type=_parse_ints, default=[1, 10], help="Sessions per user, comma separated.")
+	parser.add_argument("--messages", type=_parse_ints, default=[10, 100], help="Messages per session, comma separated.")
+	parser.add_argument("--users", type=int, default=200, help="Operations per user workload.")
+	parser.add_argument("--concurrency", type=int, default=10, help="Operations in flight per user workload.")
+	parser.add_argument("--contenders", type=int, default=4, help="Tasks competing for the write streams.")
+	parser.add_argument("--stream-messages", type=int, default=500, help="Entries of the stream workloads.")
+	parser.add_argument("--hold-ms", type=float, default=1, help="Time each contender holds the write streams.")
+	parser.add_argument("--messages-layout", choices=["document", "list"],
+	                    help="Override the 'session_messages_layout' setting.")
+	parser.add_argument("--workloads", type=lambda v: v.split(","), help=f"Subset of {','.join(WORKLOADS)}.")
+	parser.add_argument("--output", help="Write JSON results to this file instead of stdout.")
+	args = parser.parse_args()
+	if args.messages_layout:
+		broker.CONFIG.session_messages_layout = args.messages_layout
+
+	if args.docker:
+		server = _docker_redis_stack()
+	elif args.server_bin:
+		server = _local_redis_stack(args.server_bin)
+	else:
+		server = nullcontext(args.redis_url)
+	with server as redis_url:
+		report = asyncio.run(run(args, redis_url))
+
+	text = json.dumps(report, indent=2)
+	if args.output:
+		with open(args.output, "w") as f:
+			f.write(text)
+	else:
+		print(text)
+
+
+if __name__ == "__main__":
+	main()
@@ -1,7 +0,0 @@
-import pytest
-import pytest_asyncio
-from chatbone._broker import UserData
-
-
-
-# TODO TEST data, test stream.
\ No newline at end of file
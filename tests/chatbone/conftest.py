@@ -0,0 +1,27 @@
+import os
+
+import pytest
+import pytest_asyncio
+from redis.asyncio import Redis
+
+from chatbone import broker
+
+TEST_REDIS_URL = os.environ.get("CHATBONE_TEST_REDIS_URL", "redis://localhost:6379/15")
+"""Redis Stack (RedisJSON and Redis Functions) used by broker tests, the database is flushed by every test using it."""
+
+
+@pytest_asyncio.fixture(loop_scope="session")
+async def redis_stack():
+	"""Bind the broker to the test Redis Stack, skip if it is not available."""
+	redis = Redis.from_url(TEST_REDIS_URL, decode_responses=True)
+	try:
+		await redis.ping()
+		await redis.flushdb()
+		await broker.ChatboneData.load_functions(redis)
+	except Exception as e:
+		pytest.skip(f"Redis Stack is not available at '{TEST_REDIS_URL}'. {e!r}")
+	old = broker.get_redis, broker.ChatboneData.redis
+	broker.get_redis, broker.ChatboneData.redis = (lambda: redis), redis
+	yield redis
+	broker.get_redis, broker.ChatboneData.redis = old
+	await redis.aclose()
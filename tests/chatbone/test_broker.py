@@ -0,0 +1,477 @@
+"""Broker tests which run in process, without Redis."""
+import asyncio
+
+import pytest
+from uuid_extensions import uuid7
+
+from chatbone import broker
+from chatbone.broker import UserData, UserDataCache, EncryptedTokenError, SigningKeyError, StreamBroadcaster, AS2CSData
+from chatbone.broker import Histogram, BrokerMetrics, instrumented, ChatboneData, reload_functions_on_missing
+from chatbone.broker import ChatSessionData, Message
+from chatbone.broker import StreamCodec, FieldsStreamCodec, PackedStreamCodec, CS2ASData, ResultForm, TextUrlsFormat
+from chatbone.broker import PACKED_FIELD, PACKED_FIELD_PREFIX, BufferedWriteStream, RequestForm
+from chatbone.broker import ReadStream, MultiplexedReadStream, ResumableReadStream, BroadcastReadStream, StreamMultiplexer
+from redis.exceptions import ResponseError
+from utilities.func import sign
+
+
+@pytest.fixture
+def signing_key(monkeypatch):
+	key = "s" * 32
+	monkeypatch.setattr(broker, "TOKEN_SIGNING_KEY", key)
+	monkeypatch.setattr(UserData, "_signed_token_cache", broker.OrderedDict())
+	return key
+
+
+@pytest.fixture
+def userdata():
+	return UserData(id=uuid7(), username="user", password="password")
+
+
+def test_verify_signature(signing_key, userdata):
+	uid, nonce, expires_at = UserData._verify_signature(userdata.get_signed_token(60))
+	assert uid == userdata.id and nonce
+
+
+def test_verify_signature_rejects_tampered(signing_key, userdata):
+	payload, signature = userdata.get_signed_token(60).split(".")
+	forged = sign(f"{uuid7()}:9999999999:nonce", "x" * 32).split(".")[0] + "." + signature
+	with pytest.raises(EncryptedTokenError):
+		UserData._verify_signature(forged)
+
+
+@pytest.mark.parametrize("token", ["", "abc", "a.b", sign("no-colons", "s" * 32), sign("not-uuid:1:n", "s" * 32)])
+def test_verify_signature_rejects_malformed(signing_key, token):
+	with pytest.raises(EncryptedTokenError):
+		UserData._verify_signature(token)
+
+
+def test_verify_signature_rejects_expired(signing_key, userdata):
+	token = userdata.get_signed_token(-1)
+	with pytest.raises(EncryptedTokenError, match="expired"):
+		UserData._verify_signature(token)
+	assert token not in UserData._signed_token_cache
+
+
+def test_verify_signature_lru_eviction(signing_key, userdata, monkeypatch):
+	monkeypatch.setattr(broker.CONFIG, "signed_token_cache_size", 2)
+	tokens = [userdata.get_signed_token(60) for _ in range(3)]
+	UserData._verify_signature(tokens[0])
+	UserData._verify_signature(tokens[1])
+	UserData._verify_signature(tokens[0])  # most recently used
+	UserData._verify_signature(tokens[2])
+	assert list(UserData._signed_token_cache) == [tokens[0], tokens[2]]
+
+
+@pytest.mark.parametrize("key", [None, "", "abcxyz", "s" * 31])
+def test_signed_tokens_refused_without_strong_key(monkeypatch, userdata, key):
+	monkeypatch.setattr(broker, "TOKEN_SIGNING_KEY", key)
+	with pytest.raises(SigningKeyError):
+		userdata.get_signed_token()
+	with pytest.raises(SigningKeyError):
+		UserData._verify_signature(sign(f"{userdata.id}:9999999999:nonce", "abcxyz"))
+
+
+@pytest.fixture
+def cache():
+	cache = UserDataCache(maxsize=2, ttl=60)
+	cache._started = True # Invalidations are fed by '_on_changed' directly.
+	return cache
+
+
+def test_userdata_cache_get_put(cache, userdata):
+	assert cache.get(userdata.id) is None
+	cache.put(userdata, complete=False, generation=cache.generation)
+	cached = cache.get(userdata.id)
+	assert cached == userdata and cached is not userdata
+	assert cache.get(userdata.id, lazy_load_chat_sessions=False) is None
+	assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+
+def test_userdata_cache_copies(cache):
+	"""Hits copy the user and its sessions but share their field values, changes of a copy do not reach the cache."""
+	cs = ChatSessionData(id=uuid7(), messages=[Message(role="user", content="hi")])
+	user = UserData(id=uuid7(), username="user", password="password", chat_sessions={cs.id: cs})
+	user._bound_cs(user.chat_sessions)
+	cache.put(user, complete=True, generation=cache.generation)
+	hit = cache.get(user.id)
+	assert hit.chat_sessions[cs.id] is not cs and hit.chat_sessions[cs.id].messages is cs.messages
+	assert hit.chat_sessions[cs.id].rkey == cs.rkey
+	hit.username = "renamed"
+	hit.chat_sessions[cs.id].summaries = ["summary"]
+	hit.chat_sessions.clear()
+	assert cache.get(user.id) == user
+
+
+def test_userdata_cache_lru(cache):
+	users = [UserData(id=uuid7(), username=f"user{i}", password="password") for i in range(3)]
+	for user in users:
+		cache.put(user, complete=True, generation=cache.generation)
+	assert cache.get(users[0].id) is None
+	assert cache.get(users[1].id) and cache.get(users[2].id)
+
+
+def test_userdata_cache_expiry(cache, userdata, monkeypatch):
+	cache.put(userdata, complete=True, generation=cache.generation)
+	monkeypatch.setattr(broker.time, "monotonic", lambda: float("inf"))
+	assert cache.get(userdata.id) is None
+
+
+def test_userdata_cache_invalidation(cache, userdata):
+	cache.put(userdata, complete=True, generation=cache.generation)
+	cache._on_changed(userdata.rkey)
+	assert cache.get(userdata.id) is None
+
+
+def test_userdata_cache_put_after_invalidation(cache, userdata):
+	"""A load which raced with a write of the same user is not cached, writes of other users don't matter."""
+	other = UserData(id=uuid7(), username="other", password="password")
+	generation = cache.generation
+	cache._on_changed(other.rkey)
+	cache.put(userdata, complete=True, generation=generation)
+	assert cache.get(userdata.id) is not None
+
+	generation = cache.generation
+	cache._on_changed(userdata.rkey)
+	cache.put(userdata, complete=True, generation=generation)
+	assert cache.get(userdata.id) is None
+	cache.put(userdata, complete=True, generation=cache.generation)
+	assert cache.get(userdata.id) is not None
+
+
+def test_userdata_cache_put_after_clear(cache, userdata):
+	generation = cache.generation
+	cache._on_changed(None)
+	cache.put(userdata, complete=True, generation=generation)
+	assert cache.get(userdata.id) is None
+
+
+def test_userdata_cache_forgotten_invalidation(cache, userdata):
+	"""Invalidations beyond 'maxsize' are forgotten, loads older than them are refused for every user."""
+	generation = cache.generation
+	cache._on_changed(userdata.rkey)
+	for i in range(2):
+		cache._on_changed(UserData.make_rkey(uuid7()))
+	assert userdata.rkey not in cache._invalidated
+	cache.put(userdata, complete=True, generation=generation)
+	assert cache.get(userdata.id) is None
+
+
+
+class _FailingMultiplexer:
+	"""Serve readers which fail on their first read."""
+	count = 10
+
+	def __init__(self):
+		self.closed = []
+
+	async def subscribe(self, stream_key, datatype):
+		multiplexer = self
+		class Source:
+			key = stream_key
+			async def read_entries(self, count=None, block=None):
+				await asyncio.sleep(0)
+				raise ConnectionError("boom")
+			async def close(self):
+				multiplexer.closed.append(self.key)
+		return Source()
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_broadcaster_reader_failure():
+	"""Subscribers get the reader error, the channel is removed so that a new subscriber starts a new reader."""
+	multiplexer = _FailingMultiplexer()
+	broadcaster = StreamBroadcaster(multiplexer)
+	streams = [await broadcaster.subscribe("key", AS2CSData) for _ in range(2)]
+	for stream in streams:
+		with pytest.raises(ConnectionError):
+			await asyncio.wait_for(stream.read_entries(block=0), 1)
+	assert multiplexer.closed == ["key"] and broadcaster.num_subscribers == 0
+	stream = await broadcaster.subscribe("key", AS2CSData)
+	assert broadcaster.num_subscribers == 1
+	with pytest.raises(ConnectionError):
+		await asyncio.wait_for(stream.read_entries(block=0), 1)
+	for stream in streams:
+		await stream.close()
+	await broadcaster.close()
+
+
+
+def test_histogram():
+	h = Histogram((0.1, 1))
+	for value in (0.05, 0.1, 0.5, 2):
+		h.observe(value)
+	assert h.counts == [2, 1, 1] and h.count == 4 and h.sum == pytest.approx(2.65)
+	assert h.export("x", 'op="a"') == ['x_bucket{op="a",le="0.1"} 2', 'x_bucket{op="a",le="1"} 3',
+	                                   'x_bucket{op="a",le="+Inf"} 4', 'x_sum{op="a"} 2.65', 'x_count{op="a"} 4']
+
+
+@pytest.fixture
+def metrics(monkeypatch):
+	metrics = BrokerMetrics()
+	monkeypatch.setattr(broker, "BROKER_METRICS", metrics)
+	return metrics
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_instrumented(metrics):
+	@instrumented("outer")
+	async def outer():
+		metrics._record_commands((("get", "key"),))
+		await inner()
+
+	@instrumented("inner")
+	async def inner():
+		metrics._record_commands((("set", "key", "value"), ("expire", "key", 1)))
+		raise ValueError
+
+	with pytest.raises(ValueError):
+		await outer()
+	metrics._record_commands((("get", "key"),)) # outside operations, not recorded
+	assert metrics.commands == {("outer", "GET"): 1, ("inner", "SET"): 1, ("inner", "EXPIRE"): 1}
+	assert metrics.roundtrips == {"outer": 1, "inner": 1}
+	assert metrics.request_bytes == {"outer": 6, "inner": 28} # non-string arguments count 8 bytes
+	assert metrics.operation_errors == {"outer": 1, "inner": 1}
+	assert metrics.operation_seconds["outer"].count == metrics.operation_seconds["inner"].count == 1
+
+
+def test_export_prometheus(metrics):
+	metrics.operation_seconds["save"].observe(0.002)
+	metrics.commands[("save", "FCALL")] += 2
+	metrics.observe_lock("modify", wait=0.001, hold=0.01)
+	lines = metrics.export_prometheus().splitlines()
+	assert "# TYPE chatbone_broker_operation_seconds histogram" in lines
+	assert 'chatbone_broker_operation_seconds_bucket{op="save",le="0.0025"} 1' in lines
+	assert 'chatbone_broker_operation_seconds_count{op="save"} 1' in lines
+	assert 'chatbone_broker_redis_commands_total{op="save",command="FCALL"} 2' in lines
+	assert 'chatbone_broker_lock_hold_seconds_count{lock="modify"} 1' in lines
+
+
+def test_metrics_not_installed_on_import():
+	"""Importing the broker must not patch redis-py, 'install' is left to the application."""
+	from redis.asyncio import Redis
+	assert not broker.BROKER_METRICS._installed
+	assert Redis.execute_command.__module__.startswith("redis.")
+	BrokerMetrics(enabled=False).install()
+	assert Redis.execute_command.__module__.startswith("redis.")
+
+
+
+@pytest.fixture
+def loads(monkeypatch):
+	loads = []
+	async def load_functions(redis=None, skip_if_loaded=False):
+		loads.append(skip_if_loaded)
+	monkeypatch.setattr(ChatboneData, "load_functions", load_functions)
+	return loads
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_reload_functions_on_missing(loads):
+	"""A lost library is loaded again and the call retried once."""
+	calls = []
+	@reload_functions_on_missing
+	async def call(fail_times):
+		calls.append(1)
+		if len(calls) <= fail_times:
+			raise ResponseError("Function not found")
+		return len(calls)
+
+	assert await call(1) == 2 and loads == [False]
+	calls.clear()
+	with pytest.raises(ResponseError):
+		await call(2)
+	assert len(calls) == 2 and len(loads) == 2
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_reload_functions_on_other_error(loads):
+	@reload_functions_on_missing
+	async def call():
+		raise ResponseError("NOKEY main rkey")
+
+	with pytest.raises(ResponseError, match="NOKEY"):
+		await call()
+	assert loads == []
+
+
+
+@pytest.fixture
+def list_layout(monkeypatch):
+	monkeypatch.setattr(broker.CONFIG, "session_messages_layout", "list")
+
+
+def _session_with_messages():
+	return ChatSessionData(id=uuid7(), messages=[Message(role="user", content="hi")])
+
+
+@pytest.mark.asyncio(loop_scope="session")
+async def test_list_layout_refuses_document_messages(list_layout):
+	"""In 'list' layout, messages written into the user document would never be read."""
+	cs = _session_with_messages()
+	user = UserData(id=uuid7(), username="user", password="password", chat_sessions={cs.id: cs})
+	with pytest.raises(ValueError, match="append_messages"):
+		await user.save()
+	with pytest.raises(ValueError, match="append_messages"):
+		await user.update("chat_sessions", {cs.id: cs})
+	with pytest.raises(ValueError, match="append_messages"):
+		await cs.set("messages", cs.messages)
+
+
+def test_list_layout_accepts_documents_without_messages(list_layout):
+	cs = ChatSessionData(id=uuid7())
+	user = UserData(id=uuid7(), username="user", password="password", chat_sessions={cs.id: cs})
+	user._check_document()
+	user._validate_field("chat_sessions", {cs.id: cs})
+	cs._validate_field("messages", [])
+
+
+def test_document_layout_accepts_messages():
+	cs = _session_with_messages()
+	cs._validate_field("messages", cs.messages)
+	UserData(id=uuid7(), username="user", password="password", chat_sessions={cs.id: cs})._check_document()
+
+
+
+def _stream_data():
+	return [AS2CSData(result=ResultForm(phase_id=uuid7(), phase_info="thinking",
+	                                    stream_token=TextUrlsFormat(text_fmt="see {a}", fmt_data={"a": "https://a.b/c"})),
+	                  state='done', end=True),
+	        AS2CSData(state='processing'),
+	        CS2ASData(type='supply', response_id=uuid7(), response=TextUrlsFormat(text_fmt="ok"))]
+
+
+@pytest.mark.parametrize("codec", [FieldsStreamCodec(), PackedStreamCodec()], ids=["fields", "packed"])
+def test_stream_codec_round_trip(codec):
+	"""Any codec's entries are decoded by any reader, values are strings as read from Redis."""
+	for data in _stream_data():
+		fields = codec.encode(data)
+		assert not any(isinstance(v, bool) for v in fields.values()) # redis-py refuses bools
+		fields = {k: v if isinstance(v, (str, bytes)) else str(v) for k, v in fields.items()}
+		assert StreamCodec.decode(type(data), fields) == data
+
+
+def test_default_stream_codec_is_readable_by_older_releases():
+	"""Readers of older releases decode entries with 'StreamData._decode' only."""
+	for data in _stream_data():
+		fields = {k: v if isinstance(v, (str, bytes)) else str(v) for k, v in broker.DEFAULT_STREAM_CODEC.encode(data).items()}
+		assert type(data)._decode(fields) == data
+
+
+def test_stream_codec_packed_format():
+	data = _stream_data()[0]
+	assert list(PackedStreamCodec().encode(data)) == [PACKED_FIELD]
+	with pytest.raises(ValueError, match="schema version"):
+		StreamCodec.decode(AS2CSData, {f"{PACKED_FIELD_PREFIX}9__": "{}"})
+
+
+def test_stream_codec_is_abstract():
+	with pytest.raises(TypeError):
+		StreamCodec()
+
+
+def test_read_stream_bind():
+	stream = ReadStream("key", AS2CSData).bind(checkpoint="1-0", count=5)
+	assert (stream._checkpoint_id, stream._count) == ("1-0", 5)
+
+
+@pytest.mark.parametrize("stream", [
+	lambda: MultiplexedReadStream("key", AS2CSData, StreamMultiplexer()),
+	lambda: ResumableReadStream("key", AS2CSData, "client", ("a", "b", "c"), "as2cs"),
+	lambda: BroadcastReadStream("key", AS2CSData, StreamBroadcaster(StreamMultiplexer())),
+], ids=["multiplexed", "resumable", "broadcast"])
+def test_read_stream_bind_unsupported(stream):
+	"""Streams whose position is held elsewhere refuse 'bind' with TypeError, like any unsupported operation."""
+	with pytest.raises(TypeError):
+		stream().bind(count=5)
+
+
+class _Leaf(ChatboneData):
+	@property
+	def leaf_rkey(self)->str:
+		return f"leaf:{self.id}"
+
+
+class _Tree(ChatboneData):
+	one: _Leaf
+	maybe: _Leaf|None = None
+	many: list[_Leaf] = []
+	named: dict[str, _Leaf] = {}
+	names: list[str] = []
+
+
+def test_rkey_schema():
+	assert dict(_Leaf._rkey_schema) == {"leaf_rkey": "property"}
+	assert dict(_Tree._rkey_schema) == {"one": "model", "maybe": "model", "many": "sequence", "named": "dict"}
+	assert ("registry_rkey", "property") not in ChatSessionData._rkey_schema
+	assert {"cs2as_stream_rkey", "as2cs_stream_rkey", "messages_rkey"} <= dict(ChatSessionData._rkey_schema).keys()
+	assert dict(UserData._rkey_schema)["chat_sessions"] == "dict"
+
+
+def test_get_all_sub_rkeys():
+	leaves = [_Leaf(id=uuid7()) for _ in range(4)]
+	tree = _Tree(id=uuid7(), one=leaves[0], many=[leaves[1], leaves[2]], named={"x": leaves[3]})
+	assert tree.get_all_sub_rkeys() == [leaf.leaf_rkey for leaf in leaves]
+
+
+@pytest.mark.parametrize("annotation", [list, dict])
+def test_rkey_schema_refuses_implicit_containers(annotation):
+	with pytest.raises(SyntaxError, match="explicit"):
+		type("_Implicit", (ChatboneData,), {"__annotations__": {"items": annotation}, "items": annotation()})
+
+
+def _token(phase_id, text, state='processing', end=False, phase_info=None, **fmt_data):
+	return AS2CSData(result=ResultForm(phase_id=phase_id, phase_info=phase_info, stream_token=TextUrlsFormat(text_fmt=text, fmt_data=fmt_data)),
+	                 state=state, end=end)
+
+
+def test_buffered_write_stream_merge():
+	stream, phase_id = BufferedWriteStream("key", AS2CSData), uuid7()
+	merged = stream._merge(_token(phase_id, "Hel", a="http://a.com"), _token(phase_id, "lo", b="http://b.com"))
+	assert merged.result.stream_token.text_fmt == "Hello"
+	assert merged.result.stream_token.fmt_data.keys() == {"a", "b"}
+
+
+@pytest.mark.parametrize("last, data", [
+	(lambda p: _token(p, "a"), lambda p: _token(uuid7(), "b")),
+	(lambda p: _token(p, "a"), lambda p: _token(p, "b", phase_info="searching")),
+	(lambda p: _token(p, "a"), lambda p: _token(p, "b", 'done')),
+	(lambda p: _token(p, "a"), lambda p: _token(p, "b", end=True)),
+	(lambda p: _token(p, "a", end=True), lambda p: _token(p, "b")),
+	(lambda p: _token(p, "a"*8), lambda p: _token(p, "b")),
+	(lambda p: _token(p, "a"), lambda p: AS2CSData(request=RequestForm(request_id=uuid7()), state='processing')),
+], ids=["phase", "phase_info", "state", "end", "after_end", "max_chars", "request"])
+def test_buffered_write_stream_no_merge(last, data):
+	phase_id = uuid7()
+	assert BufferedWriteStream("key", AS2CSData, max_merged_chars=8)._merge(last(phase_id), data(phase_id)) is None
+
+
+@pytest.mark.parametrize("field, value", [
+	("username", "user"),
+	("summaries", ["a", "b"]),
+	("summaries", []),
+	("encrypted_secret_token", None),
+])
+def test_validate_field(userdata, field, value):
+	userdata._check_params(field, value)
+
+
+@pytest.mark.parametrize("field, value", [
+	("username", 1),
+	("summaries", "ab"),
+	("summaries", ["a", 1]),
+	("summaries", ("a", "b")),
+	("encrypted_secret_token", b"token"),
+])
+def test_validate_field_is_strict(userdata, field, value):
+	"""Values are not coerced, a value the model would convert is refused."""
+	with pytest.raises(ValueError, match=f"field '{field}'"):
+		userdata._check_params(field, value)
+
+
+def test_validate_field_kinds(userdata):
+	userdata._check_list_params("summaries", ["a"])
+	with pytest.raises(ValueError, match="must be a dict"):
+		userdata._check_dict_params("summaries", {"a": "b"})
+	with pytest.raises(ValueError, match="must be a Sequence"):
+		userdata._check_list_params("username", ["a"])
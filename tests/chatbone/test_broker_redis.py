@@ -0,0 +1,620 @@
+"""Broker tests against a Redis Stack, see 'redis_stack' fixture."""
+import asyncio
+import gc
+import time
+import weakref
+from datetime import timedelta
+from types import SimpleNamespace
+
+import pytest
+import pytest_asyncio
+
+from redis.exceptions import LockError
+from uuid_extensions import uuid7
+from utilities.func import encrypt
+
+from chatbone import broker
+from chatbone.broker import StreamLease, PubSubHub, UserData, UserToken, ChatSessionData, NoValidTokenError, LOCK_POSTFIX
+from chatbone.broker import UserNotFoundError
+from chatbone.broker import AS2CSData, ResultForm, TextUrlsFormat, StreamMaterializer, Message, StreamMultiplexer, TTLHeartbeat
+from chatbone.broker import BufferedWriteStream, StreamCodec, WriteStream, FencingTokenError, VersionConflictError, RedisKeyError
+from chatbone.broker import ResumableReadStream, function_name, ChatboneData, GroupReadStream
+
+pytestmark = pytest.mark.asyncio(loop_scope="session")
+
+
+@pytest.mark.parametrize("root_ttl", [3600, None])
+async def test_stream_lease_lock_keeps_lease_ttl(redis_stack, root_ttl):
+	"""Lock keys expire with the lease, not with the main rkey, so a crashed holder releases them."""
+	await redis_stack.set("root", "1", ex=root_ttl)
+	async with StreamLease("root", "registry", "fence", ["stream"], lease_ms=2000) as lease:
+		assert lease.token == 1
+		assert 0 < await redis_stack.pttl(f"stream:{LOCK_POSTFIX}") <= 2000
+		assert await redis_stack.smembers("registry") == {"fence"}
+		assert await redis_stack.pttl("fence") == (-1 if root_ttl is None else pytest.approx(root_ttl*1000, rel=0.01))
+	assert not await redis_stack.exists(f"stream:{LOCK_POSTFIX}")
+
+
+async def test_stream_lease_excludes_other_owner(redis_stack):
+	await redis_stack.set("root", "1")
+	async with StreamLease("root", "registry", "fence", ["stream"], lease_ms=2000):
+		with pytest.raises(LockError):
+			await StreamLease("root", "registry", "fence", ["stream"], blocking_timeout=0.2, sleep=0.05).acquire()
+	async with StreamLease("root", "registry", "fence", ["stream"], lease_ms=2000) as lease:
+		assert lease.token == 2
+
+
+async def test_pubsub_hub_starts_once(redis_stack, monkeypatch):
+	"""Concurrent first subscribers share one pub/sub connection and listener."""
+	pubsubs = []
+	def pubsub(**kwargs):
+		ps = redis_stack.pubsub(**kwargs)
+		subscribe = ps.subscribe
+		async def slow_subscribe(*channels):
+			await asyncio.sleep(0.01) # Widen the start-up window a real connection has.
+			return await subscribe(*channels)
+		ps.subscribe = slow_subscribe
+		pubsubs.append(ps)
+		return ps
+	monkeypatch.setattr(broker, "get_redis", lambda: SimpleNamespace(pubsub=pubsub))
+	hub = PubSubHub()
+	async def wait(channel):
+		async with hub.subscription(channel) as event:
+			await asyncio.wait_for(event.wait(), 5)
+
+	waiters = [asyncio.create_task(wait(f"channel:{i%3}")) for i in range(20)]
+	await asyncio.sleep(0.2)
+	for i in range(3):
+		await redis_stack.publish(f"channel:{i}", "x")
+	await asyncio.gather(*waiters)
+	await hub.close()
+	assert len(pubsubs) == 1
+
+
+async def test_verify_valid_user_notify_missed(redis_stack):
+	"""A token set without notification is still found, by the fallback check."""
+	user = await UserData(id=uuid7(), username="user", password="password").save(refresh=False)
+	async def set_token():
+		await asyncio.sleep(0.2)
+		token = UserToken(id=uuid7(), created_at=broker.utc_now(), expires_at=broker.utc_now()+timedelta(hours=1))
+		await redis_stack.json().set(user.rkey, ".user_token", token.model_dump(mode='json'))
+	task = asyncio.create_task(set_token())
+	start = time.time()
+	assert (await user.verify_valid_user(timeout=5, sleep=0.1, fallback=0.5)).expires_at > broker.utc_now()
+	assert time.time()-start < 2
+	await task
+
+
+async def test_verify_valid_user_checks_at_deadline(redis_stack, monkeypatch):
+	"""The token is checked once more at the deadline before giving up."""
+	checks = []
+	async def get_valid_user_token(self):
+		checks.append(time.time())
+		return "token" if len(checks) > 1 else None
+	monkeypatch.setattr(UserData, "_get_valid_user_token", get_valid_user_token)
+	user = UserData(id=uuid7(), username="user", password="password")
+	assert await user.verify_valid_user(timeout=1, sleep=0.1, fallback=5) == "token"
+	assert len(checks) == 2
+
+
+async def test_verify_valid_user_timeout(redis_stack):
+	user = await UserData(id=uuid7(), username="user", password="password").save(refresh=False)
+	with pytest.raises(NoValidTokenError):
+		await user.verify_valid_user(timeout=1, sleep=0.1, fallback=0.3)
+
+
+@pytest_asyncio.fixture(loop_scope="session")
+async def chat_session(redis_stack):
+	"""Chat session of a saved user, bound to the user document."""
+	cs = ChatSessionData(id=uuid7())
+	user = UserData(id=uuid7(), username="user", password="password", chat_sessions={cs.id: cs})
+	await user.save(refresh=False, expire_seconds=100)
+	cs.bind_rkey_and_json_path(user.rkey, f'.chat_sessions["{cs.id}"]')
+	return cs
+
+
+@pytest.fixture(params=["document", "list"])
+def layout(request, monkeypatch):
+	"""Run the test with both message layouts, see 'session_messages_layout'."""
+	monkeypatch.setattr(broker.CONFIG, "session_messages_layout", request.param)
+	return request.param
+
+
+def _result(phase_id, text, state='processing', end=False, **fmt_data):
+	return AS2CSData(result=ResultForm(phase_id=phase_id, stream_token=TextUrlsFormat(text_fmt=text, fmt_data=fmt_data)),
+	                 state=state, end=end)
+
+
+async def test_stream_materializer_end_marker(chat_session, layout):
+	"""The streamed 'done' phase is one message, persisted on the end marker with its place holder urls."""
+	think, answer = uuid7(), uuid7()
+	materializer = StreamMaterializer(chat_session, trim=False)
+	entries = [("1-0", _result(think, "hmm")),
+	           ("2-0", _result(answer, "Look {img}", 'done', img="https://a.b/1.png")),
+	           ("3-0", _result(answer, " and {doc}", 'done', doc="https://a.b/2.pdf"))]
+	assert await materializer.feed(entries) == []
+	[message] = await materializer.feed([("4-0", _result(answer, ".", 'done', end=True))])
+	assert message.content == "Look {img} and {doc}."
+	assert {k: str(v) for k, v in message.fmt_data.items()} == {"img": "https://a.b/1.png", "doc": "https://a.b/2.pdf"}
+	assert await chat_session.get_messages() == [message]
+
+
+async def test_stream_materializer_phase_change(chat_session, redis_stack, layout):
+	"""Without end marker, the reply ends at the next phase, the stream is trimmed up to its last entry."""
+	answer = uuid7()
+	writes = [_result(answer, "Hello", 'done'), _result(answer, "!", 'done'), _result(uuid7(), "next")]
+	ids = [await redis_stack.xadd(chat_session.as2cs_stream_rkey, {"n": i}) for i in range(len(writes))]
+	materializer = StreamMaterializer(chat_session)
+	[message] = await materializer.feed(list(zip(ids, writes)))
+	assert message.content == "Hello!"
+	assert [sid for sid, _ in await redis_stack.xrange(chat_session.as2cs_stream_rkey)] == ids[2:]
+	assert await materializer.flush() is None
+
+
+async def test_stream_materializer_flush(chat_session, layout):
+	materializer = StreamMaterializer(chat_session, trim=False)
+	assert await materializer.feed([("1-0", _result(uuid7(), "Hi", 'done'))]) == []
+	assert (await materializer.flush()).content == "Hi"
+	assert [m.content for m in await chat_session.get_messages()] == ["Hi"]
+
+
+
+async def _stream_texts(redis, key):
+	"""Texts of the stream entries, after the one which created the stream."""
+	return [StreamCodec.decode(AS2CSData, fields).result.stream_token.text_fmt for _, fields in (await redis.xrange(key))[1:]]
+
+
+async def test_buffered_write_stream_flush_order(redis_stack):
+	"""Merged chunks and unmerged entries are added in write order, the end entry is flushed at once."""
+	await redis_stack.xadd("stream", {"n": -1})
+	first, second = uuid7(), uuid7()
+	stream = BufferedWriteStream("stream", AS2CSData, flush_interval=3600)
+	for data in (_result(first, "a"), _result(first, "b"), _result(second, "c"), _result(first, "d")):
+		await stream.write(data)
+	assert await redis_stack.xlen("stream") == 1
+	await stream.write(_result(first, "e", end=True))
+	assert await _stream_texts(redis_stack, "stream") == ["ab", "c", "d", "e"]
+
+
+async def test_buffered_write_stream_flush_triggers(redis_stack):
+	"""Buffer is flushed when full, or in background after 'flush_interval'."""
+	await redis_stack.xadd("stream", {"n": -1})
+	async with BufferedWriteStream("stream", AS2CSData, flush_interval=0.05, max_buffered=2) as stream:
+		await stream.write(_result(uuid7(), "a"))
+		await stream.write(_result(uuid7(), "b"))
+		assert await _stream_texts(redis_stack, "stream") == ["a", "b"]
+		await stream.write(_result(uuid7(), "c"))
+		await asyncio.sleep(0.2)
+		assert await _stream_texts(redis_stack, "stream") == ["a", "b", "c"]
+
+
+async def test_append_messages_cap(chat_session, layout):
+	messages = [Message(role="user", content=str(i)) for i in range(15)]
+	assert await chat_session.append_messages(messages) == 15 # no cap by default
+	assert await chat_session.append_messages(messages[:1], max_messages=4) == 4
+	assert [m.content for m in await chat_session.get_messages()] == ["12", "13", "14", "0"]
+
+
+async def test_append_messages_configured_cap(chat_session, layout, monkeypatch):
+	"""The configured cap applies by default, an explicit 0 means no cap."""
+	monkeypatch.setattr(broker.CONFIG, "session_max_messages", 3)
+	messages = [Message(role="user", content=str(i)) for i in range(5)]
+	assert await chat_session.append_messages(messages) == 3
+	assert await chat_session.append_messages(messages, max_messages=0) == 8
+
+
+async def test_append_no_messages(chat_session, layout):
+	"""Appending nothing returns the current length, RPUSH and JSON.ARRAPPEND would fail without values."""
+	assert await chat_session.append_messages([]) == 0
+	await chat_session.append_messages([Message(role="user", content="hi")])
+	assert await chat_session.append_messages([]) == 1
+
+
+async def test_group_read_default_consumer_is_unique(chat_session):
+	"""Readers of the same group in one process must not share a consumer name, or they would share pending entries."""
+	async with chat_session.get_streams(read_only=True, read_group="group") as first, \
+			chat_session.get_streams(read_only=True, read_group="group") as second:
+		assert first["as2cs"][1].consumer != second["as2cs"][1].consumer
+	async with chat_session.get_streams(read_only=True, read_group="group", read_consumer="c") as streams:
+		assert streams["as2cs"][1].consumer == "c"
+
+
+
+async def test_multiplexed_stream_queue_is_bounded(redis_stack):
+	"""A slow reader holds at most 'queue_size' batches, the rest waits in Redis and is delivered in order."""
+	multiplexer = StreamMultiplexer(count=2, block_ms=100, queue_size=1)
+	await redis_stack.xadd("stream", {"n": -1})
+	stream = await multiplexer.subscribe("stream", AS2CSData)
+	try:
+		for n in range(10):
+			await redis_stack.xadd("stream", AS2CSData(state='processing', end=bool(n == 9))._encode())
+		await asyncio.sleep(0.3)
+		assert stream._queue.qsize() == 1 and len(stream._queue.get_nowait()) == 2
+		entries = await stream.read_entries(count=100, block=None)
+		while len(entries) < 8:
+			entries += await stream.read_entries(count=100, block=1000)
+		assert len(entries) == 8 and entries[-1][1].end
+	finally:
+		await multiplexer.close()
+
+
+
+async def test_multiplexer_closes_empty_shards(redis_stack):
+	"""A shard and its XREAD task are dropped with their last stream, new streams start a new one."""
+	multiplexer = StreamMultiplexer(max_keys=1, block_ms=100)
+	try:
+		streams = [await multiplexer.subscribe(f"stream:{i}", AS2CSData) for i in range(2)]
+		shards = list(multiplexer._shards)
+		assert len(shards) == 2
+		await streams[0].close()
+		assert multiplexer._shards == shards[1:] and shards[0]._task.done()
+		assert not await redis_stack.exists(shards[0].wake_key)
+		await streams[1].close()
+		assert multiplexer._shards == [] and multiplexer.num_streams == 0
+		stream = await multiplexer.subscribe("stream:0", AS2CSData)
+		await redis_stack.xadd("stream:0", AS2CSData(state='processing')._encode())
+		assert len(await stream.read_entries(count=10, block=1000)) == 1
+	finally:
+		await multiplexer.close()
+
+
+async def test_ttl_heartbeat(redis_stack):
+	"""Touches extend the lifetime and the activity index, without keeping the touched objects in memory."""
+	user = UserData(id=uuid7(), username="user", password="password")
+	await user.save(refresh=False, expire_seconds=10)
+	await redis_stack.zrem(UserData.active_users_rkey, "user")
+	heartbeat = TTLHeartbeat(interval=3600)
+	heartbeat.touch(user, 1000)
+	heartbeat.touch(user, 2000)
+	rkey, ref = user.rkey, weakref.ref(user)
+	del user
+	gc.collect()
+	assert ref() is None
+	try:
+		assert await heartbeat.flush() == 1
+	finally:
+		await heartbeat.close()
+	assert 1000 < await redis_stack.ttl(rkey) <= 2000
+	assert await redis_stack.zscore(UserData.active_users_rkey, "user") is not None
+
+
+
+async def test_versioned_set_notifies_fields(redis_stack):
+	"""Waiters of a notify field (see 'verify_valid_user') are woken by versioned writes too."""
+	user = UserData(id=uuid7(), username="user", password="password")
+	await user.save(refresh=False, expire_seconds=100)
+	hub = PubSubHub()
+	try:
+		async with hub.subscription(user.field_channel("user_token")) as event:
+			_, version = await user.refresh_versioned({"summaries"})
+			token = UserToken(id=uuid7(), created_at=broker.utc_now(), expires_at=broker.utc_now())
+			await user.versioned_set({"user_token": token}, version)
+			await asyncio.wait_for(event.wait(), 5)
+	finally:
+		await hub.close()
+
+
+async def _saved_user(expire_seconds:int|None=None, username:str="user")->UserData:
+	user = UserData(id=uuid7(), username=username, password="password")
+	await user.save(refresh=False, expire_seconds=expire_seconds)
+	return user
+
+
+async def test_cascade_expire_and_persist(redis_stack):
+	"""Main rkey, its registry, registered sub rkeys and the extra keys share one lifetime."""
+	user = await _saved_user()
+	await redis_stack.set("sub", 1)
+	await redis_stack.sadd(user.registry_rkey, "sub")
+	await redis_stack.set("extra", 1)
+	keys = (user.rkey, user.registry_rkey, "sub", "extra")
+	await user.expire_cascade(100, ["extra"])
+	assert [0 < await redis_stack.ttl(key) <= 100 for key in keys] == [True]*4
+	await user.expire_cascade(-1, ["extra"])
+	assert [await redis_stack.ttl(key) for key in keys] == [-1]*4
+
+
+async def test_cascade_delete(redis_stack):
+	user = await _saved_user(100)
+	await redis_stack.set("sub", 1)
+	await redis_stack.sadd(user.registry_rkey, "sub")
+	assert await user.delete() == 3
+	assert not await redis_stack.exists(user.rkey, user.registry_rkey, "sub")
+
+
+async def test_expire_sync(redis_stack):
+	"""Keys follow the main rkey lifetime, read on the server side. They are left untouched without main rkey."""
+	user = await _saved_user(100)
+	await redis_stack.set("sub", 1, ex=1000)
+	await user.expire_sync(["sub"])
+	assert 0 < await redis_stack.ttl("sub") <= 100
+	await user.expire(-1)
+	await user.expire_sync(["sub"])
+	assert await redis_stack.ttl("sub") == -1
+	await redis_stack.set("sub", 1, ex=1000)
+	await UserData(id=uuid7(), username="other", password="password").expire_sync(["sub"])
+	assert await redis_stack.ttl("sub") > 100
+
+
+async def test_register_sub_rkeys(redis_stack):
+	"""Registered keys take the main rkey lifetime and are removed with it, nothing is registered without main rkey."""
+	user = await _saved_user(100)
+	await redis_stack.set("sub", 1)
+	await user.register_sub_rkeys(["sub"])
+	assert await redis_stack.smembers(user.registry_rkey) == {"sub"}
+	assert 0 < await redis_stack.ttl("sub") <= 100 and 0 < await redis_stack.ttl(user.registry_rkey) <= 100
+	await user.delete()
+	assert not await redis_stack.exists("sub")
+
+	other = UserData(id=uuid7(), username="other", password="password")
+	await redis_stack.set("sub", 1)
+	await other.register_sub_rkeys(["sub"])
+	assert not await redis_stack.exists(other.registry_rkey)
+	assert await redis_stack.ttl("sub") == -1
+
+
+async def test_fenced_write_rejects_stale_token(redis_stack):
+	"""Once the lease is taken over, writes of the previous holder are rejected, the new holder's ones are added."""
+	await redis_stack.set("root", "1")
+	await redis_stack.xadd("stream", {"n": -1})
+	data = AS2CSData(state='processing')
+	async with StreamLease("root", "registry", "fence", ["stream"], lease_ms=2000) as lease:
+		stale = WriteStream("stream", AS2CSData, fence=("fence", lease.token))
+		await stale.write(data)
+	async with StreamLease("root", "registry", "fence", ["stream"], lease_ms=2000) as lease:
+		with pytest.raises(FencingTokenError):
+			await stale.write(data)
+		stream = WriteStream("stream", AS2CSData, fence=("fence", lease.token))
+		for _ in range(3):
+			await stream.write(data, maxlen=2, approximate=False)
+	assert await redis_stack.xlen("stream") == 2
+
+
+async def test_versioned_set_conflict(redis_stack):
+	"""A write based on an outdated version is refused and changes nothing."""
+	user = await _saved_user(100)
+	_, version = await user.refresh_versioned({"summaries"})
+	assert version == 0
+	assert await user.versioned_set({"summaries": ["a"]}, version) == 1
+	with pytest.raises(VersionConflictError) as e:
+		await user.versioned_set({"summaries": ["b"], "username": "other"}, version)
+	assert (e.value.expected_version, e.value.current_version) == (0, 1)
+	user, version = await user.refresh_versioned({"summaries"})
+	assert (user.summaries, version) == (["a"], 1)
+	assert await redis_stack.json().get(user.rkey, ".username") == "user"
+
+
+async def test_versioned_set_values_are_not_errors(redis_stack):
+	"""Error replies are told apart from the written values, which look like them here."""
+	user = UserData(id=uuid7(), username="user", password="password")
+	with pytest.raises(RedisKeyError):
+		await user.versioned_set({"summaries": ["VERSIONCONFLICT 7"]}, 0)
+
+
+async def test_versioned_set_conflict_notifies_nothing(redis_stack):
+	"""Waiters are not woken, nor caches invalidated, by a refused write."""
+	user = await _saved_user(100)
+	await user.versioned_set({"summaries": ["a"]}, 0)
+	pubsub = redis_stack.pubsub()
+	await pubsub.subscribe(broker.DATA_CHANGED_CHANNEL, user.field_channel("user_token"))
+	try:
+		token = UserToken(id=uuid7(), created_at=broker.utc_now(), expires_at=broker.utc_now())
+		with pytest.raises(VersionConflictError):
+			await user.versioned_set({"user_token": token}, 0)
+		await user.versioned_set({"user_token": token}, 1)
+		messages = []
+		for _ in range(10): # None is also returned for subscribe confirmations.
+			if (message := await pubsub.get_message(ignore_subscribe_messages=True, timeout=0.05)) is not None:
+				messages.append((message["channel"], message["data"]))
+		assert messages == [(broker.DATA_CHANGED_CHANNEL, user.rkey), (user.field_channel("user_token"), "1")]
+	finally:
+		await pubsub.aclose()
+
+
+async def test_versioned_set_missing(redis_stack):
+	with pytest.raises(RedisKeyError):
+		await UserData(id=uuid7(), username="user", password="password").versioned_set({"summaries": ["a"]}, 0)
+
+
+async def test_resumable_read_stream_resume(redis_stack):
+	"""Reconnecting client continues after the last delivered batch, checkpoints never move back."""
+	keys = ("root", "registry", "checkpoints")
+	await redis_stack.set("root", "1", ex=100)
+	await redis_stack.xadd("stream", {"n": -1})
+	stream = await ResumableReadStream("stream", AS2CSData, "client", keys, "as2cs").resume()
+	ids = [await redis_stack.xadd("stream", AS2CSData(state='processing')._encode()) for _ in range(5)]
+	assert [sid for sid, _ in await stream.read_entries(count=2)] == ids[:2]
+	assert not await redis_stack.exists("checkpoints") # Saved along with the next read.
+	assert [sid for sid, _ in await stream.read_entries(count=1)] == ids[2:3]
+	assert await redis_stack.hget("checkpoints", "client:as2cs") == ids[1]
+	await stream.commit()
+	assert await redis_stack.hget("checkpoints", "client:as2cs") == ids[2]
+	assert await redis_stack.smembers("registry") == {"checkpoints"}
+	assert 0 < await redis_stack.ttl("checkpoints") <= 100
+	assert await redis_stack.fcall(function_name("stream_checkpoint_save"), 3, *keys, "client:as2cs", ids[0]) == 0
+
+	resumed = await ResumableReadStream("stream", AS2CSData, "client", keys, "as2cs").resume()
+	assert [sid for sid, _ in await resumed.read_entries(count=10)] == ids[3:]
+	truncated = await ResumableReadStream("stream", AS2CSData, "client", keys, "as2cs", max_backlog=1).resume()
+	assert truncated.truncated
+	assert [sid for sid, _ in await truncated.read_entries(count=10)] == ids[4:]
+
+
+async def test_stream_checkpoint_without_main_rkey(redis_stack):
+	assert await redis_stack.fcall(function_name("stream_checkpoint_save"), 3, "root", "registry", "checkpoints", "client:as2cs", "1-0") == 0
+	assert not await redis_stack.exists("checkpoints", "registry")
+
+
+async def test_user_index(redis_stack):
+	"""Saved users are indexed by name and last seen time, deleted and long inactive ones are removed."""
+	user = await _saved_user(100)
+	other = await _saved_user(100, username="other")
+	assert await UserData.get_user_id("user") == user.id
+	assert {name for name, _, _ in await UserData.get_active_users()} == {"user", "other"}
+	await redis_stack.zadd(UserData.active_users_rkey, {"other": time.time()-1000})
+	assert await UserData.count_active_users(since_seconds=100) == 1
+	assert await UserData.evict_inactive_users(idle_seconds=100) == ["other"]
+	assert await UserData.get_user_id("other") is None
+	await other.expire(100)
+	assert await UserData.get_user_id("other") == other.id
+	await user.delete()
+	assert await UserData.get_user_id("user") is None
+	assert [name for name, _, _ in await UserData.get_active_users()] == ["other"]
+
+
+async def test_user_index_without_document(redis_stack):
+	"""Nothing is indexed for a user whose data does not exist."""
+	await UserData(id=uuid7(), username="user", password="password").expire(100)
+	assert await UserData.count_active_users() == 0
+	assert await UserData.get_user_id("user") is None
+
+
+class _Labels(ChatboneData):
+	embedding = False
+	labels: dict[str, str] = {}
+
+
+@pytest.mark.parametrize("mset", [True, False], ids=["mset", "per_key"])
+async def test_update(redis_stack, monkeypatch, mset):
+	monkeypatch.setattr(ChatboneData, "_json_mset_supported", mset)
+	obj = await _Labels(id=uuid7(), labels={"a": "0"}).save(refresh=False)
+	async with redis_stack.pipeline() as pipeline:
+		await obj.update("labels", {}, pipeline) # Queues nothing, the transaction is not aborted.
+		await obj.update("labels", {"a": "1", "b": "2"}, pipeline)
+		await pipeline.execute()
+	assert (await obj.refresh(include={"labels"})).labels == {"a": "1", "b": "2"}
+
+
+async def test_update_probes_json_mset_once(redis_stack, monkeypatch):
+	monkeypatch.setattr(ChatboneData, "_json_mset_supported", None)
+	probes = []
+	execute_command = redis_stack.execute_command
+	async def probe(*args, **kwargs):
+		if args == ("JSON.MSET",):
+			probes.append(args)
+		return await execute_command(*args, **kwargs)
+	monkeypatch.setattr(redis_stack, "execute_command", probe)
+	obj = await _Labels(id=uuid7()).save(refresh=False)
+	for i in range(2):
+		await obj.update("labels", {str(i): str(i)})
+	assert len(probes) == 1 and ChatboneData._json_mset_supported is not None
+	assert (await obj.refresh(include={"labels"})).labels == {"0": "0", "1": "1"}
+
+
+async def _changed_user()->UserData:
+	"""Saved user whose document was changed behind its back."""
+	user = await _saved_user(100)
+	for field, value in dict(summaries=["a"], username="renamed", encrypted_secret_token="token").items():
+		await user.redis.json().set(user.rkey, f".{field}", value)
+	return user
+
+
+async def test_refresh_inplace(redis_stack):
+	user = await _changed_user()
+	assert await user.refresh(include={"summaries"}, mode='inplace') is user
+	assert user.summaries == ["a"]
+
+
+async def test_refresh_copy(redis_stack):
+	user = await _changed_user()
+	copy = await user.refresh(include={"summaries"}, mode='copy')
+	assert copy is not user
+	assert copy.summaries == ["a"] and user.summaries == []
+
+
+@pytest.mark.parametrize("kwargs, expected", [
+	({}, ([], "user", "token")),
+	({"include": {"summaries", "username"}}, (["a"], "renamed", None)),
+	({"exclude": {"username"}}, (["a"], "user", "token")),
+	({"exclude": set()}, (["a"], "renamed", "token")),
+], ids=["default", "include", "exclude", "all"])
+async def test_refresh_modes_agree(redis_stack, kwargs, expected):
+	"""All modes refresh the same fields, the default ones are '_refresh_include_default'."""
+	user = await _changed_user()
+	for mode in ('rebuild', 'copy', 'inplace'):
+		obj = await UserData(id=user.id, username="user", password="password").refresh(mode=mode, **kwargs)
+		assert (obj.summaries, obj.username, obj.encrypted_secret_token) == expected, mode
+
+
+@pytest.mark.parametrize("lazy", [True, False], ids=["lazy", "whole"])
+async def test_load_many(redis_stack, lazy):
+	"""Users are returned in order of ids, None for the missing ones."""
+	cs = ChatSessionData(id=uuid7())
+	users = [await UserData(id=uuid7(), username=f"user{i}", password="password",
+	                        chat_sessions={cs.id: cs} if i == 0 else {}).save(refresh=False) for i in range(3)]
+	loaded = await UserData.load_many([users[0].id, uuid7(), str(users[2].id), users[1].id], lazy_load_chat_sessions=lazy)
+	assert [user and user.username for user in loaded] == ["user0", None, "user2", "user1"]
+	assert [user.id for user in loaded if user] == [users[0].id, users[2].id, users[1].id]
+	assert list(loaded[0].chat_sessions) == ([] if lazy else [cs.id])
+	assert await UserData.load_many([]) == []
+
+
+async def _encrypted_token(user:UserData)->str:
+	"""Like 'get_encrypted_token' for a new user."""
+	secret_key, token = await asyncio.to_thread(encrypt, f"{user.id}@{user.username}@{user.password}")
+	user.encrypted_secret_token = token
+	await user._store_encrypted_secret(secret_key, token)
+	return token
+
+
+async def test_verify_many_encrypted_tokens(redis_stack):
+	"""Unknown, expired and forged tokens, and tokens of missing users give None in place, the others their user."""
+	users = [await _saved_user(100, username=f"user{i}") for i in range(3)]
+	tokens = [await _encrypted_token(user) for user in users]
+	await redis_stack.delete(users[1].encrypted_secret_rkey) # Expired.
+	await redis_stack.delete(users[2].rkey)
+	await redis_stack.set(f"{UserData.rkey_prefix}:<encrypted_token>:forged", "not a secret key")
+	verified = await UserData.verify_many_encrypted_tokens([tokens[0], "unknown", tokens[1], "forged", tokens[2], tokens[0]])
+	assert [user and user.username for user in verified] == ["user0", None, None, None, None, "user0"]
+	assert verified[0].encrypted_secret_token == tokens[0]
+	assert await UserData.verify_many_encrypted_tokens([]) == []
+
+
+async def _group_stream(redis, n:int)->list[str]:
+	"""Stream of 'n' entries, returns their ids."""
+	return [await redis.xadd("stream", AS2CSData(state='processing')._encode()) for _ in range(n)]
+
+
+def _ids(entries)->list[str]:
+	return [sid for sid, _ in entries]
+
+
+async def test_group_read_stream_ack(redis_stack):
+	"""A delivered batch is pending until the next read (or 'ack')."""
+	ids = await _group_stream(redis_stack, 5)
+	stream = GroupReadStream("stream", AS2CSData, "group", "consumer")
+	assert _ids(await stream.read_entries(count=2)) == ids[:2]
+	assert (await redis_stack.xpending("stream", "group"))["pending"] == 2
+	assert _ids(await stream.read_entries(count=2)) == ids[2:4]
+	assert [p["message_id"] for p in await redis_stack.xpending_range("stream", "group", "-", "+", 10)] == ids[2:4]
+	assert await stream.ack() == 2
+	assert (await redis_stack.xpending("stream", "group"))["pending"] == 0
+
+
+async def test_group_read_stream_replays_own_pending(redis_stack):
+	"""A consumer restarted with the same name gets its unacknowledged entries again before the new ones."""
+	ids = await _group_stream(redis_stack, 3)
+	assert _ids(await GroupReadStream("stream", AS2CSData, "group", "consumer").read_entries(count=2)) == ids[:2]
+	restarted = GroupReadStream("stream", AS2CSData, "group", "consumer")
+	assert _ids(await restarted.read_entries(count=10)) == ids[:2]
+	assert _ids(await restarted.read_entries(count=10)) == ids[2:]
+
+
+async def test_group_read_stream_claims_idle_entries(redis_stack):
+	"""Pending entries of a dead consumer are taken over once idle for 'min_idle_ms'."""
+	ids = await _group_stream(redis_stack, 3)
+	assert _ids(await GroupReadStream("stream", AS2CSData, "group", "dead").read_entries(count=2)) == ids[:2]
+	other = GroupReadStream("stream", AS2CSData, "group", "other", min_idle_ms=100)
+	assert _ids(await other.read_entries(count=10)) == ids[2:] # Not idle long enough yet.
+	await asyncio.sleep(0.2)
+	assert _ids(await other.read_entries(count=10)) == ids[:2]
+	pending = await redis_stack.xpending_range("stream", "group", "-", "+", 10)
+	assert {p["message_id"]: p["consumer"] for p in pending} == dict.fromkeys(ids[:2], "other")
+
+
+async def test_get_chat_session_ids(redis_stack):
+	sessions = [ChatSessionData(id=uuid7()) for _ in range(3)]
+	user = UserData(id=uuid7(), username="user", password="password", chat_sessions={cs.id: cs for cs in sessions})
+	await user.save(refresh=False)
+	assert sorted(await UserData.get_chat_session_ids(user.id)) == sorted(cs.id for cs in sessions)
+	with pytest.raises(UserNotFoundError):
+		await UserData.get_chat_session_ids(uuid7())
@@ -0,0 +1,31 @@
+import pytest
+
+from utilities.func import sign, unsign
+
+KEY = "k" * 32
+
+
+def test_sign_round_trip():
+	token = sign("user:123:nonce", KEY)
+	assert unsign(token, KEY) == "user:123:nonce"
+
+
+@pytest.mark.parametrize("tamper", [
+	lambda t: "A" + t[1:],  # payload
+	lambda t: t[:-1] + ("A" if t[-1] != "A" else "B"),  # signature
+	lambda t: sign("user:999:nonce", KEY).split(".")[0] + "." + t.split(".")[1],  # swapped payload
+])
+def test_unsign_rejects_tampered(tamper):
+	with pytest.raises(ValueError):
+		unsign(tamper(sign("user:123:nonce", KEY)), KEY)
+
+
+def test_unsign_rejects_other_key():
+	with pytest.raises(ValueError):
+		unsign(sign("user:123:nonce", KEY), "x" * 32)
+
+
+@pytest.mark.parametrize("token", ["", "abc", "a.b.c", "!!!.???", "."])
+def test_unsign_rejects_malformed(token):
+	with pytest.raises(ValueError):
+		unsign(token, KEY)